@@ -8,11 +8,16 @@
 import Score
 import challenges
 import badges
+from RunningStat import RunningStat
 import requests
 import json
 
 
 class Person:
+    # Metrics kept in activity_stats, named like the Strava activity fields
+    STAT_METRICS = ["average_speed", "max_speed", "distance", "moving_time",
+                    "average_cadence", "average_heartrate", "elapsed_time", "total_elevation_gain"]
+
     def __init__(self):
         # User Information
         self.__name = "Default_Name"  # used for profile page and possible leaderboard name
@@ -68,6 +73,10 @@ class Person:
 
         self.rank = 0  # will be their index in leaderboard list + 1
 
+        # Running sums/variance per metric over every run added with add_activity,
+        # so baselines update in O(1) per activity instead of re-summing history
+        self.activity_stats = {metric: RunningStat() for metric in self.STAT_METRICS}
+
     # Setters for user customizable options
     def change_name(self, new_name):
         self.__name = new_name
@@ -104,6 +113,77 @@ class Person:
         self.elapsed_time = self.elapsed_time / self.total_workouts
         self.total_elevation = self.total_elevation / self.total_workouts
 
+    # Incremental baselines - the caller decides which activities count (runs only in StravaParser)
+    # activity_values is what one activity adds to each STAT_METRICS stat
+    @staticmethod
+    def activity_values(activity):
+        # Same defaults as StravaParser.parse_activities
+        moving_time = activity.get('moving_time', 0)
+        return {
+            "average_speed": activity.get('average_speed', 0),
+            "max_speed": activity.get('max_speed', 0),
+            "distance": activity.get('distance', 0),
+            "moving_time": moving_time,
+            "average_cadence": activity.get('average_cadence', 0) or 0,
+            "average_heartrate": activity.get('average_heartrate', 0) or 0,
+            "elapsed_time": activity.get('elapsed_time', 0) or moving_time,
+            "total_elevation_gain": activity.get('total_elevation_gain', 0),
+        }
+
+    def add_activity(self, activity):
+        for metric, value in self.activity_values(activity).items():
+            self.activity_stats[metric].add(value)
+        self.update_baseline_from_stats()
+
+    # Reverses add_activity for an activity that was added before
+    def remove_activity(self, activity):
+        for metric, value in self.activity_values(activity).items():
+            self.activity_stats[metric].remove(value)
+        self.update_baseline_from_stats()
+
+    # An edited activity (same Strava id, new values)
+    def replace_activity(self, old_activity, new_activity):
+        old_values = self.activity_values(old_activity)
+        for metric, value in self.activity_values(new_activity).items():
+            self.activity_stats[metric].replace(old_values[metric], value)
+        self.update_baseline_from_stats()
+
+    # Sets totals, baselines and current metrics the same way parse_activities does
+    def update_baseline_from_stats(self):
+        stats = self.activity_stats
+        self.total_workouts = stats["distance"].count
+        self.total_average_speed = stats["average_speed"].total
+        self.total_max_speed = stats["max_speed"].total
+        self.total_distance = stats["distance"].total
+        self.total_moving_time = stats["moving_time"].total
+        if self.total_workouts == 0:
+            return
+
+        self.baseline_average_speed = stats["average_speed"].get_average()
+        self.baseline_max_speed = stats["max_speed"].get_average()
+        self.baseline_distance = stats["distance"].get_average()
+        self.baseline_moving_time = stats["moving_time"].get_average()
+
+        self.baseline_average_cadence = self.average_cadence = stats["average_cadence"].get_average()
+        self.baseline_average_heartrate = self.average_heartrate = stats["average_heartrate"].get_average()
+        self.baseline_elapsed_time = self.elapsed_time = stats["elapsed_time"].get_average()
+        self.baseline_elevation = self.total_elevation = stats["total_elevation_gain"].get_average()
+
+        self.average_speed = self.baseline_average_speed
+        self.max_speed = self.baseline_max_speed
+        self.distance = self.baseline_distance
+        self.moving_time = self.baseline_moving_time
+
+    # Persisted with the user so the next sync can continue from these sums
+    def running_stats_to_dict(self):
+        return {metric: stat.to_dict() for metric, stat in self.activity_stats.items()}
+
+    def load_running_stats(self, data):
+        self.activity_stats = {
+            metric: RunningStat.from_dict(data.get(metric, {})) for metric in self.STAT_METRICS
+        }
+        self.update_baseline_from_stats()
+
     # Used in settings to change privacy to change which leaderboard name is shown
     def show_real_name(self, check):
         if check:
@@ -118,7 +198,7 @@ class Person:
     def populate_player_activities_by_day(self):
         API_URL = "http://127.0.0.1:5000/strava/activities"
         try:
-            response = requests.get(API_URL)
+            response = requests.get(API_URL, timeout=30)
             response.raise_for_status()
             self.player_activities_by_day = response.json()
         except requests.exceptions.RequestException as e:
@@ -0,0 +1,54 @@
+class RunningStat:
+    # Running count, sum, mean and variance of one metric (Welford's algorithm).
+    # Values can be added and removed again in O(1), so a baseline never needs
+    # the whole activity history re-summed.
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.mean = 0
+        self.m2 = 0  # sum of squared differences from the mean
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    # Reverses add(value); value must be one that was added before
+    def remove(self, value):
+        if self.count <= 1:
+            self.count = 0
+            self.total = 0
+            self.mean = 0
+            self.m2 = 0
+            return
+
+        old_mean = self.mean
+        self.count -= 1
+        self.total -= value
+        self.mean = (old_mean * (self.count + 1) - value) / self.count
+        self.m2 = max(self.m2 - (value - old_mean) * (value - self.mean), 0)
+
+    def replace(self, old_value, new_value):
+        self.remove(old_value)
+        self.add(new_value)
+
+    def get_average(self):
+        return self.total / self.count if self.count else 0
+
+    # Population variance of the values added so far
+    def get_variance(self):
+        return self.m2 / self.count if self.count else 0
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "mean": self.mean, "m2": self.m2}
+
+    @classmethod
+    def from_dict(cls, data):
+        stat = cls()
+        stat.count = data.get("count", 0)
+        stat.total = data.get("total", 0)
+        stat.mean = data.get("mean", 0)
+        stat.m2 = data.get("m2", 0)
+        return stat
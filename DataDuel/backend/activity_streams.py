@@ -0,0 +1,292 @@
+"""
+Activity Streams Module - per-second Strava streams stored as typed arrays
+Strava's streams endpoint returns every sample of an activity (an hour-long
+run is ~3600 samples per channel). Each activity's channels are kept in one
+binary file, data/streams/<athlete_id>/<activity_id>.streams:
+
+    b"DDST", format version, header length    (8 bytes)
+    JSON header: samples, and per channel its typecode, offset, count, encoding
+    channel data, each block 8-byte aligned, little-endian
+
+Floats are stored as float32, heart rate and cadence as uint16, latlng as
+interleaved lat/lng float32 pairs, and time as the uint16 (or uint32) gaps
+between samples. A time stream with gaps that do not fit (a null sample, or
+time running backwards) is kept as raw signed 64-bit values instead. Loading reads the file once and hands out memoryviews on it,
+so no JSON is parsed per sample; only time is decoded, on first access.
+"""
+import json
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+
+import requests
+
+from strava_client import StravaRateLimitError, strava_client
+
+# Channel -> (array typecode, values per sample)
+CHANNELS = {
+    "time": ("I", 1),
+    "distance": ("f", 1),
+    "latlng": ("f", 2),
+    "altitude": ("f", 1),
+    "heartrate": ("H", 1),
+    "cadence": ("H", 1),
+    "velocity_smooth": ("f", 1),
+}
+STREAM_KEYS = tuple(CHANNELS)
+
+MAGIC = b"DDST"
+VERSION = 1
+PREAMBLE = struct.Struct("<4sHH")  # magic, version, header length
+ALIGNMENT = 8
+WORKERS = 4
+
+
+class StreamsError(Exception):
+    """Strava answered a streams request with an error status"""
+
+
+def _pad(length):
+    return -length % ALIGNMENT
+
+
+def _to_array(typecode, values):
+    if typecode == "f":
+        return array("f", (float("nan") if value is None else value for value in values))
+    return array(typecode, (0 if value is None else int(round(value)) for value in values))
+
+
+def encode_streams(streams):
+    """
+    Serialize {channel: Strava data list} to the binary stream format.
+    Unknown channels are ignored; None samples become NaN (floats) or 0.
+    """
+    blocks = []
+    channels = {}
+    samples = 0
+    for name, (typecode, width) in CHANNELS.items():
+        values = streams.get(name)
+        if values is None:
+            continue
+        encoding = "raw"
+        if name == "time" and None not in values and all(b >= a for a, b in zip([0] + values[:-1], values)) \
+                and (not values or values[-1] <= 0xFFFFFFFF):
+            # Gaps between samples: mostly 1s, nearly always small enough for uint16
+            gaps = [b - a for a, b in zip([0] + values[:-1], values)]
+            typecode = "H" if all(gap <= 0xFFFF for gap in gaps) else "I"
+            data, encoding = _to_array(typecode, gaps), "delta"
+        elif name == "time":
+            typecode = "q"
+            data = _to_array(typecode, values)
+        elif width == 2:
+            data = _to_array(typecode, (value for pair in values for value in (pair or (None, None))))
+        else:
+            data = _to_array(typecode, values)
+        if sys.byteorder != "little":
+            data.byteswap()
+        raw = data.tobytes()
+        channels[name] = {"typecode": typecode, "count": len(data), "encoding": encoding}
+        blocks.append((name, raw))
+        samples = max(samples, len(values))
+
+    # Offsets are relative to the first block, which starts after the padded header
+    offset = 0
+    for name, raw in blocks:
+        channels[name]["offset"] = offset
+        offset += len(raw) + _pad(len(raw))
+
+    header = json.dumps({"samples": samples, "channels": channels}, separators=(",", ":")).encode("utf-8")
+    header += b" " * _pad(PREAMBLE.size + len(header))
+    parts = [PREAMBLE.pack(MAGIC, VERSION, len(header)), header]
+    for _, raw in blocks:
+        parts.append(raw)
+        parts.append(b"\0" * _pad(len(raw)))
+    return b"".join(parts)
+
+
+class ActivityStreams:
+    """
+    Read-only channels of one activity, backed by the file's bytes.
+
+    streams["heartrate"] is a memoryview of uint16, streams["latlng"] a flat
+    memoryview of float32 lat/lng pairs, streams["time"] an array of elapsed
+    seconds (decoded from the stored gaps once, then cached).
+    """
+
+    def __init__(self, buffer):
+        magic, version, header_length = PREAMBLE.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a DataDuel streams file")
+        header = json.loads(bytes(buffer[PREAMBLE.size:PREAMBLE.size + header_length]))
+        self.samples = header["samples"]
+        self._channels = header["channels"]
+        self._data_start = PREAMBLE.size + header_length
+        self._buffer = buffer
+        self._decoded = {}
+
+    def keys(self):
+        return list(self._channels)
+
+    def __contains__(self, name):
+        return name in self._channels
+
+    def __len__(self):
+        return len(self._channels)
+
+    def _view(self, name):
+        channel = self._channels[name]
+        itemsize = array(channel["typecode"]).itemsize
+        start = self._data_start + channel["offset"]
+        view = memoryview(self._buffer)[start:start + channel["count"] * itemsize]
+        if sys.byteorder != "little":
+            data = array(channel["typecode"], view.tobytes())
+            data.byteswap()
+            return memoryview(data)
+        return view.cast(channel["typecode"])
+
+    def __getitem__(self, name):
+        if name in self._decoded:
+            return self._decoded[name]
+        view = self._view(name)
+        if self._channels[name]["encoding"] == "delta":
+            view = self._decoded[name] = array("I", accumulate(view))
+        return view
+
+    def to_dict(self, keys=None):
+        """Plain lists in Strava's shape (latlng as [lat, lng] pairs), e.g. for JSON responses"""
+        result = {}
+        for name in keys or self.keys():
+            if name not in self:
+                continue
+            values = self[name].tolist()
+            if self._channels[name]["typecode"] == "f":
+                # float32 holds ~7 significant digits; drop the noise digits of the widening.
+                # Missing samples were stored as NaN and go back to None
+                values = [None if value != value else float(f"{value:.7g}") for value in values]
+            if name == "latlng":
+                values = [values[i:i + 2] for i in range(0, len(values), 2)]
+            result[name] = values
+        return result
+
+
+class StreamStore:
+    """Streams files under one directory, one subdirectory per athlete"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, athlete_id, activity_id):
+        return os.path.join(self.root, str(athlete_id), f"{activity_id}.streams")
+
+    def has(self, athlete_id, activity_id):
+        return os.path.exists(self.path(athlete_id, activity_id))
+
+    def stored_ids(self, athlete_id):
+        """Activity IDs with stored streams (including ones Strava had none for)"""
+        directory = os.path.join(self.root, str(athlete_id))
+        if not os.path.isdir(directory):
+            return set()
+        return {name[:-len(".streams")] for name in os.listdir(directory) if name.endswith(".streams")}
+
+    def save(self, athlete_id, activity_id, streams):
+        """
+        Store an activity's streams, replacing any stored ones.
+        An empty dict records that the activity has none (so it is not fetched again).
+
+        Returns:
+            Bytes written
+        """
+        filepath = self.path(athlete_id, activity_id)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        data = encode_streams(streams)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=f"{activity_id}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, filepath)
+        return len(data)
+
+    def load(self, athlete_id, activity_id):
+        """ActivityStreams for a stored activity, or None if its streams were never fetched"""
+        try:
+            with open(self.path(athlete_id, activity_id), "rb") as f:
+                return ActivityStreams(f.read())
+        except FileNotFoundError:
+            return None
+
+
+def fetch_streams(client, access_token, activity_id, keys=STREAM_KEYS):
+    """
+    An activity's streams as {channel: data list}; empty if Strava has none
+    (manual activities answer 404).
+    """
+    response = client.get(f"/activities/{activity_id}/streams", access_token,
+                          params={"keys": ",".join(keys), "key_by_type": "true"})
+    if response.status_code == 404:
+        return {}
+    if response.status_code == 429:
+        # Returned rather than retried: the wait is longer than the client will sleep
+        raise StravaRateLimitError(client.budget.wait_time())
+    if response.status_code != 200:
+        raise StreamsError(f"Streams of activity {activity_id} returned HTTP {response.status_code}")
+    data = response.json()
+    # key_by_type=true answers {type: stream}; without it Strava sends a list of streams
+    if isinstance(data, list):
+        data = {stream["type"]: stream for stream in data}
+    return {name: stream["data"] for name, stream in data.items() if name in CHANNELS}
+
+
+def ingest_streams(store, athlete_id, activity_ids, access_token, client=None, workers=WORKERS, limit=None):
+    """
+    Fetch and store the streams of activities that do not have them yet.
+
+    Args:
+        store: StreamStore
+        activity_ids: Candidate activities, highest priority first
+        access_token: Valid Strava access token for the athlete
+        client: StravaClient (default: the shared one)
+        workers: Activities fetched at the same time
+        limit: Fetch at most this many (one request each)
+
+    Returns:
+        Dictionary with "stored", "empty" (no streams on Strava), "failed",
+        "skipped" (already stored) and "rate_limited" activity counts, plus
+        the samples and bytes stored
+    """
+    client = client or strava_client
+    stored = store.stored_ids(athlete_id)
+    missing = [str(activity_id) for activity_id in activity_ids if str(activity_id) not in stored]
+    pending = missing[:limit] if limit is not None else missing
+    counts = {"stored": 0, "empty": 0, "failed": 0, "skipped": len(activity_ids) - len(missing),
+              "rate_limited": 0, "samples": 0, "bytes": 0}
+    print(f"[STREAMS] Athlete {athlete_id}: fetching streams of {len(pending)} activities ({workers} workers)")
+
+    def ingest_one(activity_id):
+        streams = fetch_streams(client, access_token, activity_id)
+        return streams, store.save(athlete_id, activity_id, streams)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(activity_id, pool.submit(ingest_one, activity_id)) for activity_id in pending]
+        for activity_id, future in futures:
+            try:
+                streams, written = future.result()
+            except StravaRateLimitError:
+                counts["rate_limited"] += 1
+                continue
+            except (StreamsError, requests.exceptions.RequestException, ValueError) as e:
+                print(f"[ERROR] Streams of activity {activity_id} failed: {str(e)}")
+                counts["failed"] += 1
+                continue
+            counts["stored" if streams else "empty"] += 1
+            counts["samples"] += max((len(values) for values in streams.values()), default=0)
+            counts["bytes"] += written
+
+    print(f"[STREAMS] Athlete {athlete_id}: {counts}")
+    return counts
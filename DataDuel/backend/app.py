@@ -10,9 +10,19 @@ import sys
 # Add parent directory to path to import Person, Score, etc.
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from data_storage import DataStorage
+from activity_streams import StreamStore, ingest_streams
+from athlete_locks import athlete_lock
+from backfill import backfill_activities
+from data_storage import create_storage, merge_activity_list
+from day_index import activity_timestamp, annotate_activity, epoch_day
+from window_metrics import WindowMetrics, recent_activities
 from friends_storage import FriendsStorage
-from strava_parser import StravaParser
+from json_stream import iter_response_json
+from strava_client import StravaRateLimitError, strava_client
+from strava_parser import ActivityAggregator, StravaParser
+from sync_jobs import SyncJobQueue
+from token_cache import TokenCache
+from webhook_queue import WebhookQueue, WebhookWorker
 from route_generator import SimpleRouteGenerator
 from Person import Person
 from Score import Score
@@ -52,8 +62,18 @@ CORS(app, origins=[
     os.getenv("FRONTEND_URL", ""),                               # Custom frontend URL (if set)
 ])
 
-# Initialize data storage
-storage = DataStorage()
+# Initialize data storage (STORAGE_BACKEND selects json, log or sqlite)
+storage = create_storage()
+
+# /api/sync pipelines run on this worker pool (SYNC_WORKERS threads); job state
+# is shared with the other worker processes through data/sync_jobs.db
+sync_jobs = SyncJobQueue(os.path.join(storage.data_dir, "sync_jobs.db"))
+
+# Strava push-subscription events wait here until the webhook worker applies them
+webhook_queue = WebhookQueue(os.path.join(storage.data_dir, "webhook_events.db"))
+
+# Per-second activity streams, one typed-array file per activity
+stream_store = StreamStore(os.path.join(storage.data_dir, "streams"))
 # friends_storage = FriendsStorage()  # DEPRECATED: Now using Supabase for friends
 
 CREDENTIALS_FILE = "credentials.json"
@@ -143,18 +163,10 @@ def auth_callback():
         print("[ERROR] Missing authorization code")
         return jsonify({"error": "Missing authorization code"}), 400
 
-    token_url = "https://www.strava.com/oauth/token"
-    payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "code": code,
-        "grant_type": "authorization_code",
-    }
-    
     print(f"[API] Requesting tokens from Strava...")
     print(f"   Client ID: {CLIENT_ID}")
 
-    response = requests.post(token_url, data=payload)
+    response = strava_client.exchange_code(CLIENT_ID, CLIENT_SECRET, code)
     data = response.json()
     
     print(f"[API] Token response status: {response.status_code}")
@@ -227,6 +239,14 @@ def auth_callback():
         except:
             pass  # File write not critical if Supabase worked
     
+    # The new athlete's tokens are what get_valid_token returns from now on
+    token_cache.put({
+        "access_token": data["access_token"],
+        "refresh_token": data["refresh_token"],
+        "expires_at": data["expires_at"],
+        "athlete_id": athlete_id
+    }, default=True)
+    
     # Create or update user in storage
     print(f"\n[PERSON] Creating Person object from athlete data...")
     print(f"   Passing athlete data to StravaParser.create_person_from_athlete()...")
@@ -301,9 +321,18 @@ def auth_callback():
     return redirect(f"{frontend_url}/index.html")
 
 def get_valid_token():
+    """
+    Access token and athlete ID of the authenticated athlete (tokens.json).
+    Served from token_cache while valid; see load_valid_token for the lookup.
+    """
+    tokens = token_cache.get()
+    return tokens["access_token"], tokens.get("athlete_id")
+
+def load_valid_token():
     """
     Load and refresh the access token if expired.
     Uses Supabase in production, falls back to file storage for local dev.
+    Returns the tokens dictionary (access_token, refresh_token, expires_at, athlete_id).
     
     Strategy:
     1. Try Supabase first (if USE_SUPABASE_STORAGE=true and athlete_id available)
@@ -340,7 +369,7 @@ def get_valid_token():
                     use_supabase = False
             else:
                 print("[TOKEN] Using valid token from Supabase")
-                return tokens["access_token"], tokens.get("athlete_id")
+                return tokens
     
     # Fallback to file storage (local development or if Supabase unavailable)
     if not os.path.exists(FILE_NAME):
@@ -352,41 +381,41 @@ def get_valid_token():
     # Check if expired
     if time.time() > tokens.get("expires_at", 0):
         print("[TOKEN] Access token expired — refreshing from file storage...")
+        tokens = refresh_file_tokens(tokens, use_supabase)
+
+    return tokens
+
+def refresh_file_tokens(tokens, use_supabase):
+    """Refresh the tokens.json tokens with Strava and save the new ones (also to Supabase if enabled)"""
+    response = strava_client.refresh_token(CLIENT_ID, CLIENT_SECRET, tokens["refresh_token"])
+    new_data = response.json()
+    if "access_token" not in new_data:
+        raise RuntimeError(f"Failed to refresh token: {new_data.get('message', 'Unknown error')}")
+
+    # Update stored tokens
+    tokens = dict(tokens)
+    tokens.update({
+        "access_token": new_data["access_token"],
+        "refresh_token": new_data["refresh_token"],
+        "expires_at": new_data["expires_at"],
+    })
 
-        refresh_payload = {
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "grant_type": "refresh_token",
-            "refresh_token": tokens["refresh_token"],
-        }
-
-        response = requests.post("https://www.strava.com/oauth/token", data=refresh_payload)
-        new_data = response.json()
-
-        # Update stored tokens
-        tokens.update({
-            "access_token": new_data["access_token"],
-            "refresh_token": new_data["refresh_token"],
-            "expires_at": new_data["expires_at"],
-        })
-
-        with open(FILE_NAME, "w") as f:
-            json.dump(tokens, f)
-        
-        # Also save to Supabase if enabled and we have athlete_id
-        if use_supabase and tokens.get("athlete_id"):
-            save_result, save_error = save_strava_tokens(
-                tokens["athlete_id"],
-                tokens["access_token"],
-                tokens["refresh_token"],
-                tokens["expires_at"]
-            )
-            if not save_error:
-                print("[TOKEN] Token also saved to Supabase")
-
-        print("[TOKEN] New access token saved.")
+    with open("tokens.json", "w") as f:
+        json.dump(tokens, f)
+    
+    # Also save to Supabase if enabled and we have athlete_id
+    if use_supabase and tokens.get("athlete_id"):
+        save_result, save_error = save_strava_tokens(
+            tokens["athlete_id"],
+            tokens["access_token"],
+            tokens["refresh_token"],
+            tokens["expires_at"]
+        )
+        if not save_error:
+            print("[TOKEN] Token also saved to Supabase")
 
-    return tokens["access_token"], tokens.get("athlete_id")
+    print("[TOKEN] New access token saved.")
+    return tokens
 
 @app.route("/api/add-user-info", methods=["POST"])
 def add_user_info():
@@ -410,13 +439,19 @@ def get_activities():
     except Exception as e:
         return jsonify({"error": f"Could not load or refresh token: {str(e)}"}), 500
 
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get("https://www.strava.com/api/v3/athlete/activities", headers=headers, params={"per_page": 30})
+    try:
+        response = strava_client.get_activities(access_token, stream=True, per_page=30)
+    except StravaRateLimitError as e:
+        return jsonify({"error": str(e), "retry_after": round(e.retry_after)}), 429
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": f"Could not reach Strava: {str(e)}"}), 502
 
     if response.status_code != 200:
         return jsonify({"error": "Failed to fetch activities", "details": response.json()}), response.status_code
 
-    data = response.json()
+    # Activities are parsed one at a time from the response stream and only the
+    # fields below are kept
+    data = iter_response_json(response)
     from datetime import datetime
 
     # Initialize map for all weekdays
@@ -488,17 +523,21 @@ def update_person_activities():
     # Create a new Person instance
     person = Person()
     
+    # One pass over the activities feeds metrics, streak and challenges
+    # (assume_runs: frontend activities may come without a type)
+    aggregator = ActivityAggregator(activities_list, assume_runs=True)
+    
     # Parse activities
-    StravaParser.parse_activities_new(activities_list, person)
+    aggregator.apply_metrics(person)
     
     # Calculate streak
-    person.streak = StravaParser.calculate_streak(activities_list)
+    person.streak = aggregator.streak()
     
     # Check badges
     StravaParser.check_badges(person)
     
     # Check weekly challenges
-    StravaParser.check_challenges(person, activities_list)
+    aggregator.apply_challenges(person)
     
     # Prepare response dictionary
     response_data = {
@@ -674,31 +713,84 @@ def get_user_leaderboards_route():
 
 @app.route("/api/sync", methods=["POST", "GET"])
 def sync_data():
-    """Sync Strava data and calculate scores"""
-    print("\n" + "="*80)
-    print("[SYNC] Starting activity sync process")
-    print("="*80)
-    
+    """
+    Queue a sync for the authenticated athlete and return its job id right away.
+    A job already queued or running for the athlete is returned instead of a new one.
+    Poll /api/sync/<job_id> for the state and, once done, the sync result.
+    """
     try:
         access_token, athlete_id = get_valid_token()
-        print(f"[SUCCESS] Token validated successfully")
-        print(f"   Athlete ID: {athlete_id}")
     except Exception as e:
         print(f"[ERROR] Token validation failed: {str(e)}")
         return jsonify({"error": f"Not authenticated: {str(e)}"}), 401
+    
+    job, created = sync_jobs.submit(str(athlete_id), lambda: run_sync(access_token, athlete_id))
+    print(f"[SYNC] {'Queued' if created else 'Joined in-flight'} sync job {job.id} for athlete {athlete_id}")
+    return jsonify({
+        "job_id": job.id,
+        "state": job.state,
+        "coalesced": not created,
+        "status_url": f"/api/sync/{job.id}"
+    }), 202
+
+@app.route("/api/sync/<job_id>")
+def sync_status(job_id):
+    """State and timings of a sync job, plus its result ("result", "status_code") once finished"""
+    job = sync_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown sync job"}), 404
+    return jsonify(job.to_dict())
+
+def run_sync(access_token, athlete_id):
+    """
+    Sync pipeline: fetch new Strava activities, update baselines, score and save.
+    Runs on a sync job worker thread, outside any request. The athlete's lock is
+    held throughout, so a webhook update or backfill page saved meanwhile is not
+    overwritten by the user record loaded here.
+    
+    Returns:
+        (response dict, HTTP status code)
+    """
+    with athlete_lock(storage, athlete_id):
+        return sync_athlete(access_token, athlete_id)
+
+def sync_athlete(access_token, athlete_id):
+    """run_sync's pipeline; call it with the athlete's lock held"""
+    print("\n" + "="*80)
+    print("[SYNC] Starting activity sync process")
+    print("="*80)
+    print(f"   Athlete ID: {athlete_id}")
 
-    # Fetch activities from Strava
+    # Fetch activities from Strava. After the first sync only activities that
+    # started after the newest one already synced (the watermark) are requested
+    watermark = storage.get_sync_watermark(athlete_id)
+    params = {"per_page": 30} if watermark is None else {"after": watermark, "per_page": 200}
     print(f"\n[API] Fetching activities from Strava API...")
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get("https://www.strava.com/api/v3/athlete/activities", headers=headers, params={"per_page": 30})
+    print(f"   Watermark: {watermark}" if watermark is not None else "   First sync: fetching latest activities")
+    try:
+        response = strava_client.get_activities(access_token, stream=True, **params)
+    except StravaRateLimitError as e:
+        print(f"[ERROR] {str(e)}")
+        return {"error": str(e), "retry_after": round(e.retry_after)}, 429
+    except requests.exceptions.RequestException as e:
+        print(f"[ERROR] Could not reach Strava: {str(e)}")
+        return {"error": "Could not reach Strava"}, 502
     
     print(f"[API] Strava API response status: {response.status_code}")
 
     if response.status_code != 200:
         print(f"[ERROR] Failed to fetch activities from Strava")
-        return jsonify({"error": "Failed to fetch activities"}), response.status_code
+        return {"error": "Failed to fetch activities"}, response.status_code
 
-    activities = response.json()
+    # Activities are parsed one at a time from the response stream. Each one is
+    # annotated with its local epoch day / ISO week (stored with it)
+    activities = []
+    try:
+        for activity in iter_response_json(response):
+            activities.append(annotate_activity(activity))
+    except ValueError as e:
+        print(f"[ERROR] Malformed activities response from Strava: {str(e)}")
+        return {"error": "Malformed response from Strava"}, 502
     print(f"[SUCCESS] Fetched {len(activities)} activities from Strava")
     if activities:
         print(f"   First activity: {activities[0].get('name')} ({activities[0].get('type')})")
@@ -709,12 +801,38 @@ def sync_data():
     user_data = storage.get_user(athlete_id)
     if not user_data:
         print(f"[ERROR] User not found in storage (ID: {athlete_id})")
-        return jsonify({"error": "User not found. Please authenticate first."}), 404
+        return {"error": "User not found. Please authenticate first."}, 404
     
     print(f"[SUCCESS] User data loaded:")
     print(f"   Name: {user_data.get('name')}")
     print(f"   Username: {user_data.get('username')}")
     
+    # Streak and weekly challenges depend on the day, so a sync on a new local
+    # day rescores even when Strava has nothing new
+    today = datetime.now().date()
+    today_day = epoch_day(today)
+    
+    # Nothing new since the last sync (and no webhook changes) today: the saved metrics and score still stand
+    if (watermark is not None and not activities and user_data.get('running_stats')
+            and not user_data.get('rescore_pending') and user_data.get('scored_day') == today_day):
+        print(f"[SUCCESS] No new activities since the last sync, skipping scoring")
+        storage.save_user(athlete_id, dict(user_data, last_synced_at=time.time()))
+        score_data = storage.get_score(athlete_id) or {}
+        total_distance = user_data.get('total_distance', 0)
+        print("="*80 + "\n")
+        return {
+            "message": "Already up to date",
+            "activities": {"inserted": 0, "updated": 0, "unchanged": 0},
+            "metrics": {
+                "total_workouts": user_data.get('total_workouts', 0),
+                "total_distance_km": round(total_distance / 1000, 2),
+                "average_pace_per_km": round(user_data.get('total_moving_time', 0) / (total_distance / 1000) / 60, 2) if total_distance > 0 else 0,
+                "streak": user_data.get('streak', 0),
+                "score": score_data.get('score', 0),
+                "improvement": round(score_data.get('improvement', 0), 2)
+            }
+        }, 200
+    
     # Create Person object
     print(f"\n[PERSON] Creating Person object...")
     person = Person()
@@ -722,13 +840,27 @@ def sync_data():
     person.change_username(user_data.get('username', 'unknown'))
     print(f"[SUCCESS] Person object created")
     
-    # Parse activities and update person
-    print(f"\n[PARSER] Parsing activities with StravaParser...")
-    metrics = StravaParser.parse_activities(activities, person)
-    
-    if not metrics:
+    # Baselines cover the athlete's whole stored history. They are kept as running
+    # sums saved with the user, so only activities this page adds or changes cost anything
+    running_stats = user_data.get('running_stats')
+    if running_stats:
+        person.load_running_stats(running_stats)
+        activity_ids = [activity['id'] for activity in activities if activity.get('id') is not None]
+        previous = storage.get_activities_by_id(athlete_id, activity_ids)
+        changed = StravaParser.apply_activity_changes(person, previous, activities)
+        print(f"[SUCCESS] Running baselines updated from {changed} new/changed activities")
+    else:
+        # No running sums saved yet: seed them once from stored history plus this page
+        history, _, _ = merge_activity_list(storage.get_activities(athlete_id), activities)
+        for activity in history:
+            if activity.get('type') in ActivityAggregator.RUN_TYPES:
+                person.add_activity(activity)
+        person.update_baseline_from_stats()
+        print(f"[SUCCESS] Running baselines seeded from {len(history)} activities")
+    
+    if person.total_workouts == 0:
         print(f"[WARNING] No running activities found in {len(activities)} activities")
-        return jsonify({"message": "No running activities found"}), 200
+        return {"message": "No running activities found"}, 200
     
     print(f"[SUCCESS] Activities parsed successfully:")
     print(f"   Total workouts: {person.total_workouts}")
@@ -738,9 +870,16 @@ def sync_data():
     print(f"   Baseline average speed: {person.baseline_average_speed:.2f} m/s")
     print(f"   Baseline distance: {person.baseline_distance:.0f} meters")
     
+    # Streak, challenges and the scoring windows use the last 90 days of stored
+    # history plus this sync's activities (an incremental sync may bring only a few)
+    week_start_day = today_day - today.weekday()
+    recent = recent_activities(storage.get_activities(athlete_id), activities, week_start_day - 90)
+    print(f"\n[PARSER] Aggregating {len(recent)} recent activities with ActivityAggregator...")
+    aggregator = ActivityAggregator(recent, today=today)
+    
     # Calculate streak
     print(f"\n[STREAK] Calculating streak...")
-    person.streak = StravaParser.calculate_streak(activities)
+    person.streak = aggregator.streak()
     print(f"[SUCCESS] Streak calculated: {person.streak} days")
     
     # Check badges and challenges
@@ -754,7 +893,7 @@ def sync_data():
     print(f"   Total badge points: {badge_points}")
     
     print(f"\n[CHALLENGES] Checking challenges...")
-    StravaParser.check_challenges(person, activities)
+    aggregator.apply_challenges(person)
     challenge_points = person.weekly_challenges.get_points()
     print(f"[SUCCESS] Challenges checked:")
     print(f"   Challenge 1: {person.weekly_challenges.first_challenge}")
@@ -762,23 +901,42 @@ def sync_data():
     print(f"   Challenge 3: {person.weekly_challenges.third_challenge}")
     print(f"   Total challenge points: {challenge_points}")
     
+    # Current metrics are this week's runs; the scoring baseline is the trailing
+    # 28 days before the week (90 if those were empty, else the lifetime baseline)
+    print(f"\n[WINDOWS] Computing rolling window metrics...")
+    windows = WindowMetrics(recent, week_start_day - 90, today_day)
+    current, baseline, baseline_days = windows.week_vs_baseline(week_start_day, today_day)
+    person.average_speed = current['average_speed']
+    person.max_speed = current['max_speed']
+    person.distance = current['distance']
+    person.moving_time = current['moving_time']
+    if baseline is None:
+        baseline = {
+            'average_speed': person.baseline_average_speed,
+            'max_speed': person.baseline_max_speed,
+            'distance': person.baseline_distance,
+            'moving_time': person.baseline_moving_time
+        }
+    print(f"[SUCCESS] {current['count']} runs this week vs "
+          f"{f'trailing {baseline_days}-day' if baseline_days else 'lifetime'} baseline")
+    
     # Calculate score
     print(f"\n[SCORE] Calculating score...")
     print(f"   Input metrics:")
-    print(f"     Average speed: {person.average_speed:.2f} vs baseline {person.baseline_average_speed:.2f}")
-    print(f"     Max speed: {person.max_speed:.2f} vs baseline {person.baseline_max_speed:.2f}")
-    print(f"     Distance: {person.distance:.0f} vs baseline {person.baseline_distance:.0f}")
-    print(f"     Moving time: {person.moving_time:.0f} vs baseline {person.baseline_moving_time:.0f}")
+    print(f"     Average speed: {person.average_speed:.2f} vs baseline {baseline['average_speed']:.2f}")
+    print(f"     Max speed: {person.max_speed:.2f} vs baseline {baseline['max_speed']:.2f}")
+    print(f"     Distance: {person.distance:.0f} vs baseline {baseline['distance']:.0f}")
+    print(f"     Moving time: {person.moving_time:.0f} vs baseline {baseline['moving_time']:.0f}")
     
     person.score.calculate_score(
         person.average_speed,
         person.max_speed,
         person.distance,
         person.moving_time,
-        person.baseline_average_speed,
-        person.baseline_max_speed,
-        person.baseline_distance,
-        person.baseline_moving_time,
+        baseline['average_speed'],
+        baseline['max_speed'],
+        baseline['distance'],
+        baseline['moving_time'],
         badge_points,
         challenge_points,
         person.streak
@@ -786,43 +944,57 @@ def sync_data():
     print(f"[SUCCESS] Score calculated: {person.score.score}")
     print(f"   Improvement: {person.score.improvement:.2f}")
     
-    # Save activities
+    # Save activities, user metrics and score as one unit of work:
+    # each file is written once, and nothing is written if any step fails
     print(f"\n[STORAGE] Saving data to storage...")
-    print(f"   Saving {len(activities)} activities...")
-    storage.save_activities(athlete_id, activities)
-    print(f"[SUCCESS] Activities saved")
-    
-    # Update user data with metrics
-    print(f"   Updating user data with metrics...")
-    user_data.update({
-        'total_workouts': person.total_workouts,
-        'total_distance': person.total_distance,
-        'total_moving_time': person.total_moving_time,
-        'average_speed': person.average_speed,
-        'max_speed': person.max_speed,
-        'streak': person.streak
-    })
-    storage.save_user(athlete_id, user_data)
-    print(f"[SUCCESS] User data updated")
-    
-    # Save score data
-    print(f"   Saving score data...")
-    score_data = {
-        'user_id': athlete_id,
-        'username': person.display_name,
-        'score': person.score.score,
-        'improvement': person.score.improvement,
-        'total_workouts': person.total_workouts,
-        'badge_points': badge_points,
-        'challenge_points': challenge_points,
-        'streak': person.streak
-    }
-    storage.save_score(athlete_id, score_data)
-    print(f"[SUCCESS] Score data saved")
+    with storage.transaction():
+        # Upsert by activity id so older history is kept and re-synced activities aren't duplicated
+        print(f"   Merging {len(activities)} activities...")
+        activity_counts = storage.merge_activities(athlete_id, activities)
+        print(f"   Activities inserted: {activity_counts['inserted']}, updated: {activity_counts['updated']}, "
+              f"unchanged: {activity_counts['unchanged']}")
+        
+        # Advance the watermark to the newest start time seen
+        newest = max(filter(None, map(activity_timestamp, activities)), default=None)
+        if newest is not None and (watermark is None or newest > watermark):
+            storage.save_sync_watermark(athlete_id, newest)
+            print(f"   Sync watermark: {newest}")
+        
+        # Update user data with metrics
+        print(f"   Updating user data with metrics...")
+        user_data.pop('rescore_pending', None)
+        user_data.update({
+            'total_workouts': person.total_workouts,
+            'total_distance': person.total_distance,
+            'total_moving_time': person.total_moving_time,
+            'average_speed': person.average_speed,
+            'max_speed': person.max_speed,
+            'streak': person.streak,
+            'running_stats': person.running_stats_to_dict(),
+            'scored_day': today_day,
+            'last_synced_at': time.time()
+        })
+        storage.save_user(athlete_id, user_data)
+        
+        # Save score data
+        print(f"   Saving score data...")
+        score_data = {
+            'user_id': athlete_id,
+            'username': person.display_name,
+            'score': person.score.score,
+            'improvement': person.score.improvement,
+            'total_workouts': person.total_workouts,
+            'badge_points': badge_points,
+            'challenge_points': challenge_points,
+            'streak': person.streak
+        }
+        storage.save_score(athlete_id, score_data)
+    print(f"[SUCCESS] Activities, user data and score saved")
     
     print(f"\n[RESPONSE] Preparing response...")
     response_data = {
         "message": "Sync successful!",
+        "activities": activity_counts,
         "metrics": {
             "total_workouts": person.total_workouts,
             "total_distance_km": round(person.total_distance / 1000, 2),
@@ -836,7 +1008,149 @@ def sync_data():
     print(f"   {json.dumps(response_data, indent=2)}")
     print("="*80 + "\n")
     
-    return jsonify(response_data)
+    return response_data, 200
+
+def get_athlete_token(athlete_id):
+    """
+    Access token for any stored athlete (the webhook worker acts for every athlete,
+    not just the one in tokens.json). Served from token_cache while valid.
+    """
+    return token_cache.get(athlete_id)["access_token"]
+
+def load_athlete_token(athlete_id):
+    """Tokens of any athlete from Supabase (refreshed when expired), else tokens.json if it is theirs"""
+    if os.getenv("USE_SUPABASE_STORAGE", "true").lower() == "true":
+        tokens, error = get_strava_tokens(athlete_id)
+        if not error and tokens and tokens.get("access_token"):
+            if time.time() <= tokens.get("expires_at", 0):
+                return tokens
+            refreshed, refresh_error = refresh_strava_token(athlete_id, CLIENT_ID, CLIENT_SECRET)
+            if not refresh_error:
+                return refreshed
+    
+    tokens = token_cache.get()
+    if str(tokens.get("athlete_id")) != str(athlete_id):
+        raise RuntimeError(f"No Strava token for athlete {athlete_id}")
+    return tokens
+
+def refresh_cached_token(athlete_id, tokens):
+    """Early refresh for token_cache, saved where the token came from (Supabase or tokens.json)"""
+    use_supabase = os.getenv("USE_SUPABASE_STORAGE", "true").lower() == "true"
+    if use_supabase:
+        refreshed, error = refresh_strava_token(athlete_id, CLIENT_ID, CLIENT_SECRET)
+        if not error:
+            return refreshed
+        print(f"[TOKEN] Supabase refresh failed: {error}, falling back to file")
+    
+    with open("tokens.json", "r") as f:
+        file_tokens = json.load(f)
+    if str(file_tokens.get("athlete_id")) != str(athlete_id):
+        raise RuntimeError(f"No Strava token for athlete {athlete_id}")
+    return refresh_file_tokens(file_tokens, use_supabase)
+
+# Tokens are served from memory while valid and refreshed shortly before they expire
+token_cache = TokenCache(
+    lambda athlete_id: load_valid_token() if athlete_id is None else load_athlete_token(athlete_id),
+    refresh_cached_token
+)
+
+webhook_worker = WebhookWorker(webhook_queue, storage, get_athlete_token)
+# Started now rather than on the first event, so events queued before a restart
+# (and ones a crashed worker left claimed) are drained without a new delivery
+if os.getenv("WEBHOOK_WORKER", "true").lower() == "true":
+    webhook_worker.wake()
+
+@app.route("/api/webhook", methods=["GET"])
+def verify_webhook():
+    """Strava's subscription check: echo hub.challenge if the verify token matches"""
+    verify_token = os.getenv("STRAVA_WEBHOOK_VERIFY_TOKEN", "dataduel")
+    if request.args.get("hub.mode") != "subscribe" or request.args.get("hub.verify_token") != verify_token:
+        print(f"[WEBHOOK] Subscription verification rejected")
+        return jsonify({"error": "Verification failed"}), 403
+    
+    print(f"[WEBHOOK] Subscription verified")
+    return jsonify({"hub.challenge": request.args.get("hub.challenge")})
+
+@app.route("/api/webhook", methods=["POST"])
+def receive_webhook():
+    """
+    Queue a Strava event and answer right away; the webhook worker applies it.
+    Events of any subscription other than STRAVA_SUBSCRIPTION_ID are refused.
+    """
+    event = request.get_json(silent=True)
+    try:
+        webhook_queue.validate(event)
+    except ValueError as e:
+        print(f"[WEBHOOK] Rejected event: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+    
+    # The endpoint is public, so only our own subscription's events are taken
+    subscription_id = os.getenv("STRAVA_SUBSCRIPTION_ID")
+    if not subscription_id or str(event.get("subscription_id")) != subscription_id:
+        print(f"[WEBHOOK] Rejected event of subscription {event.get('subscription_id')}")
+        return jsonify({"error": "Unknown subscription"}), 403
+    
+    queued = webhook_queue.enqueue(event)
+    print(f"[WEBHOOK] {event['object_type']} {event['object_id']} {event['aspect_type']} "
+          f"(athlete {event['owner_id']}){'' if queued else ' - duplicate'}")
+    if os.getenv("WEBHOOK_WORKER", "true").lower() == "true":
+        webhook_worker.wake()
+    return jsonify({"queued": queued}), 200
+
+@app.route("/api/sync/backfill", methods=["POST"])
+def backfill_history():
+    """
+    Import the athlete's full Strava history into storage.
+    Resumes where an interrupted backfill stopped; {"restart": true} starts over.
+    The next /api/sync re-seeds the baselines from the imported history.
+    """
+    try:
+        access_token, athlete_id = get_valid_token()
+    except Exception as e:
+        return jsonify({"error": f"Not authenticated: {str(e)}"}), 401
+    
+    if not storage.get_user(athlete_id):
+        return jsonify({"error": "User not found. Please authenticate first."}), 404
+    
+    payload = request.get_json(silent=True) or {}
+    result = backfill_activities(storage, athlete_id, access_token, restart=bool(payload.get("restart")))
+    return jsonify(result), 429 if result['stopped'] == 'rate_limited' else 200
+
+@app.route("/api/streams/sync", methods=["POST"])
+def sync_streams():
+    """
+    Fetch per-second streams for the athlete's newest stored activities that
+    do not have them yet. {"limit": n} caps the Strava requests (default 20).
+    """
+    try:
+        access_token, athlete_id = get_valid_token()
+    except Exception as e:
+        return jsonify({"error": f"Not authenticated: {str(e)}"}), 401
+    
+    payload = request.get_json(silent=True) or {}
+    # Stored activities are in start-date order; newest first here
+    activity_ids = [a['id'] for a in reversed(storage.get_activities(athlete_id)) if a.get('id') is not None]
+    result = ingest_streams(stream_store, athlete_id, activity_ids, access_token,
+                            limit=int(payload.get("limit", 20)))
+    return jsonify(result), 429 if result['rate_limited'] else 200
+
+@app.route("/api/activities/<activity_id>/streams")
+def get_activity_streams(activity_id):
+    """Stored streams of one activity; ?keys=time,heartrate selects channels"""
+    try:
+        _, athlete_id = get_valid_token()
+    except Exception as e:
+        return jsonify({"error": f"Not authenticated: {str(e)}"}), 401
+    
+    streams = stream_store.load(athlete_id, activity_id)
+    if streams is None:
+        return jsonify({"error": "Streams not fetched yet. Call /api/streams/sync first."}), 404
+    keys = request.args.get("keys")
+    return jsonify({
+        "activity_id": activity_id,
+        "samples": streams.samples,
+        "streams": streams.to_dict(keys.split(",") if keys else None),
+    })
 
 @app.route("/register", methods=["POST"])
 def register_route():
@@ -930,15 +1244,12 @@ def get_profile():
 
 @app.route("/api/leaderboard")
 def get_leaderboard():
-    """Get leaderboard data"""
-    all_scores = storage.get_all_scores()
-    all_users = storage.get_all_users()
+    """Get leaderboard data (optional ?limit=N for the top N only)"""
+    limit = request.args.get("limit", type=int)
     
-    # Build leaderboard entries
+    # Rows come back already sorted by score (highest first)
     leaderboard = []
-    for user_id, score_data in all_scores.items():
-        user_data = all_users.get(user_id, {})
-        
+    for user_id, score_data, user_data in storage.get_leaderboard(limit):
         leaderboard.append({
             "user_id": user_id,
             "username": score_data.get('username', user_data.get('username', 'Unknown')),
@@ -948,9 +1259,6 @@ def get_leaderboard():
             "streak": score_data.get('streak', 0)
         })
     
-    # Sort by score (highest first)
-    leaderboard.sort(key=lambda x: x['score'], reverse=True)
-    
     # Add ranks
     for i, entry in enumerate(leaderboard):
         entry['rank'] = i + 1
@@ -961,6 +1269,20 @@ def get_leaderboard():
         "updated_at": time.time()
     })
 
+@app.route("/api/leaderboard/rank/<user_id>")
+def get_leaderboard_rank(user_id):
+    """Get one user's leaderboard rank without building the whole leaderboard"""
+    rank = storage.get_rank(user_id)
+    if rank is None:
+        return jsonify({"error": "User has no score yet"}), 404
+    
+    score_data = storage.get_score(user_id) or {}
+    return jsonify({
+        "user_id": str(user_id),
+        "rank": rank,
+        "score": score_data.get('score', 0)
+    })
+
 @app.route("/api/friends")
 def get_friends():
     """Get friends list (placeholder - returns sample data)"""
@@ -972,11 +1294,12 @@ def get_friends():
     # For MVP, return sample friends data
     # In future, this would query actual friendships
     all_users = storage.get_all_users()
+    all_scores = storage.get_scores(list(all_users.keys()))
     friends = []
     
     for user_id, user_data in all_users.items():
         if user_id != athlete_id:  # Don't include self
-            score_data = storage.get_score(user_id)
+            score_data = all_scores.get(user_id)
             friends.append({
                 "user_id": user_id,
                 "username": user_data.get('username', 'Unknown'),
@@ -1008,7 +1331,11 @@ def api_status():
         "api_online": True,
         "authenticated": authenticated,
         "athlete_id": athlete_id,
-        "storage_initialized": True
+        "storage_initialized": True,
+        "storage_cache": storage.cache_stats() if hasattr(storage, "cache_stats") else None,
+        "strava_rate_limit": strava_client.budget.snapshot(),
+        "sync_jobs": sync_jobs.counts(),
+        "token_cache": token_cache.metrics()
     })
 
 # ============================================================================
@@ -1111,6 +1438,9 @@ def search_users():
         print(f"   [ERROR] Search failed: {error}")
         return jsonify({"error": error}), 500
     
+    # Get additional data from storage for avatar, location, etc. in one batch
+    stored_users = storage.get_users([user.get('user_id') for user in users if user.get('user_id') != athlete_id])
+    
     results = []
     for user in users:
         user_id = user.get('user_id')
@@ -1120,8 +1450,7 @@ def search_users():
         # Check friendship status
         status, _ = supabase_get_status(athlete_id, user_id)
         
-        # Get additional data from storage for avatar, location, etc.
-        user_data = storage.get_user(user_id) or {}
+        user_data = stored_users.get(str(user_id), {})
         
         results.append({
             "user_id": user_id,
@@ -1250,12 +1579,12 @@ def get_friends_list_endpoint():
         print(f"   [ERROR] Failed to get friends: {error}")
         return jsonify({"error": error}), 500
     
-    all_users = storage.get_all_users()
+    # User and score data for every friend in one batch
+    summaries = storage.get_user_summaries(friend_ids)
     
     friends = []
     for friend_id in friend_ids:
-        user_data = all_users.get(friend_id, {})
-        score_data = storage.get_score(friend_id)
+        user_data = summaries[str(friend_id)]
         
         # Calculate average run distance
         total_workouts = user_data.get('total_workouts', 0)
@@ -1270,9 +1599,9 @@ def get_friends_list_endpoint():
             "location": user_data.get('location', ''),
             "total_workouts": total_workouts,
             "last_run_distance": round(avg_distance, 1),
-            "improvement": round(score_data.get('improvement', 0), 1) if score_data else 0,
+            "improvement": round(user_data['improvement'], 1),
             "streak": user_data.get('streak', 0),
-            "score": score_data.get('score', 0) if score_data else 0
+            "score": user_data['score']
         })
     
     print(f"   [SUCCESS] Returning {len(friends)} friends")
@@ -1296,12 +1625,12 @@ def get_friend_requests_endpoint():
         print(f"   [ERROR] Failed to get pending requests: {error}")
         return jsonify({"error": error}), 500
     
-    all_users = storage.get_all_users()
+    stored_users = storage.get_users([req.get('from_user_id') for req in pending_requests])
     
     requests = []
     for req in pending_requests:
         user_id = req.get('from_user_id')
-        user_data = all_users.get(user_id, {})
+        user_data = stored_users.get(str(user_id), {})
         requests.append({
             "user_id": user_id,
             "name": user_data.get('name', 'Unknown'),
@@ -1333,12 +1662,12 @@ def get_sent_requests_endpoint():
         print(f"   [ERROR] Failed to get sent requests: {error}")
         return jsonify({"error": error}), 500
     
-    all_users = storage.get_all_users()
+    stored_users = storage.get_users([req.get('to_user_id') for req in sent_requests])
     
     sent = []
     for req in sent_requests:
         user_id = req.get('to_user_id')
-        user_data = all_users.get(user_id, {})
+        user_data = stored_users.get(str(user_id), {})
         sent.append({
             "user_id": user_id,
             "name": user_data.get('name', 'Unknown'),
@@ -1470,6 +1799,14 @@ def test_login():
             tokens = refreshed
             print(f"[SUCCESS] Token refreshed")
         
+        # The test athlete's tokens are what get_valid_token returns from now on
+        token_cache.put({
+            "access_token": tokens["access_token"],
+            "refresh_token": tokens["refresh_token"],
+            "expires_at": tokens["expires_at"],
+            "athlete_id": str(athlete_id)
+        }, default=True)
+        
         print(f"[SUCCESS] Test login successful")
         print("="*80 + "\n")
         
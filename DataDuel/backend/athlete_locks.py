@@ -0,0 +1,51 @@
+"""
+Athlete Locks Module - one read-modify-write of an athlete's record at a time
+The sync pipeline, the webhook worker and backfill each load a user record,
+work from it and save it back. Holding athlete_lock() around that keeps one
+from overwriting what another saved in between (a webhook's running_stats
+update or its rescore_pending flag, say).
+
+The lock is a flock'd file per athlete under <data_dir>/locks, so worker
+processes sharing the data directory are serialized too (without fcntl only
+threads of this process are). Take it before a storage transaction, never
+inside one, and never while holding another athlete's lock.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows - only in-process locking is available
+    fcntl = None
+
+_guard = threading.Lock()
+_thread_locks = {}  # (lock directory, athlete_id) -> [Lock, threads holding or waiting]
+
+
+@contextmanager
+def athlete_lock(storage, athlete_id):
+    """Hold an athlete's lock for storage's data directory (not reentrant)"""
+    athlete_id = str(athlete_id)
+    lock_dir = os.path.join(storage.data_dir, "locks")
+    key = (lock_dir, athlete_id)
+    with _guard:
+        entry = _thread_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(lock_dir, exist_ok=True)
+            fd = os.open(os.path.join(lock_dir, f"{athlete_id}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)  # Releases the flock
+    finally:
+        with _guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _thread_locks[key]
@@ -0,0 +1,135 @@
+"""
+Backfill Module - import an athlete's full Strava activity history
+/api/sync only looks at the latest page of activities. A backfill pages
+through the whole history (per_page=200) with a small pool of concurrent page
+fetches, merges each page into storage as soon as it and every page before it
+have arrived, and keeps a cursor in the user record so an interrupted backfill
+(rate limit, error, restart) resumes at the first page not yet stored.
+
+The page sequence is pinned with before=<backfill start time>, so activities
+uploaded while a backfill runs do not shift later pages.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from athlete_locks import athlete_lock
+from day_index import annotate_activity
+from json_stream import iter_response_json
+from strava_client import StravaRateLimitError, strava_client
+
+PER_PAGE = 200
+WORKERS = 4
+
+
+class BackfillError(Exception):
+    """Strava answered a page request with an error status"""
+
+
+def fetch_page(client, access_token, before, page, per_page=PER_PAGE):
+    """One page of activities older than `before`, annotated for storage"""
+    response = client.get_activities(access_token, stream=True, before=before, page=page, per_page=per_page)
+    if response.status_code != 200:
+        response.close()
+        raise BackfillError(f"Page {page} returned HTTP {response.status_code}")
+    return [annotate_activity(activity) for activity in iter_response_json(response)]
+
+
+def new_cursor():
+    return {'before': int(time.time()), 'next_page': 1, 'activities': 0, 'complete': False}
+
+
+def backfill_activities(storage, athlete_id, access_token, client=None, per_page=PER_PAGE,
+                        workers=WORKERS, max_pages=None, restart=False):
+    """
+    Fetch and store an athlete's activity history, resuming a saved cursor.
+
+    Args:
+        storage: Storage backend (any of create_storage's)
+        athlete_id: Strava athlete ID (the user must exist)
+        access_token: Valid Strava access token
+        client: StravaClient (default: the shared one)
+        workers: Pages fetched at the same time
+        max_pages: Stop after storing this many pages (the cursor is saved)
+        restart: Start over even if a previous backfill finished
+
+    Returns:
+        Dictionary with the pages and activities stored by this call, the saved
+        cursor, and "stopped": None, "rate_limited", "error" or "max_pages"
+    """
+    client = client or strava_client
+    athlete_id = str(athlete_id)
+    user_data = storage.get_user(athlete_id) or {}
+    cursor = user_data.get('backfill')
+    if restart or not cursor:
+        cursor = new_cursor()
+    if cursor['complete']:
+        print(f"[BACKFILL] History of athlete {athlete_id} already imported")
+        return {'pages': 0, 'activities': 0, 'cursor': cursor, 'stopped': None}
+
+    first_page = cursor['next_page']
+    last_page = first_page + max_pages - 1 if max_pages else None
+    print(f"[BACKFILL] Athlete {athlete_id}: fetching from page {first_page} ({workers} workers, {per_page} per page)")
+
+    pages = activities = 0
+    stopped = None
+    in_flight = {}  # page -> future; pages are stored strictly in order
+    next_submit = first_page
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # Keep up to `workers` pages in flight, holding back when the rate
+            # budget would not cover the requests already sent
+            while len(in_flight) < workers and (last_page is None or next_submit <= last_page):
+                remaining = client.budget.remaining()
+                if in_flight and remaining is not None and min(remaining) <= len(in_flight):
+                    break
+                in_flight[next_submit] = pool.submit(
+                    fetch_page, client, access_token, cursor['before'], next_submit, per_page
+                )
+                next_submit += 1
+
+            page = cursor['next_page']
+            future = in_flight.pop(page, None)
+            if future is None:
+                stopped = 'max_pages'
+                break
+            try:
+                batch = future.result()
+            except StravaRateLimitError as e:
+                print(f"[BACKFILL] {str(e)} - stopping at page {page}")
+                stopped = 'rate_limited'
+                break
+            except (BackfillError, requests.exceptions.RequestException, ValueError) as e:
+                print(f"[ERROR] Backfill page {page} failed: {str(e)}")
+                stopped = 'error'
+                break
+
+            cursor = dict(cursor, next_page=page + 1, activities=cursor['activities'] + len(batch))
+            # A short page is the last one; no need to fetch the empty page after it
+            cursor['complete'] = len(batch) < per_page
+
+            # Page and cursor are saved together, so a resumed backfill never skips a page
+            with athlete_lock(storage, athlete_id), storage.transaction():
+                counts = storage.merge_activities(athlete_id, batch) if batch else None
+                user_data = storage.get_user(athlete_id) or {}
+                user_data['backfill'] = cursor
+                if counts and (counts['inserted'] or counts['updated']):
+                    # The saved sums no longer cover the stored history; the next
+                    # sync re-seeds them from it
+                    user_data.pop('running_stats', None)
+                storage.save_user(athlete_id, user_data)
+            pages += 1
+            activities += len(batch)
+
+            if cursor['complete']:
+                break
+
+        # Pages fetched past the end or after a stop are dropped
+        for future in in_flight.values():
+            future.cancel()
+
+    status = "complete" if cursor['complete'] else f"next page {cursor['next_page']}"
+    print(f"[BACKFILL] Athlete {athlete_id}: stored {activities} activities from {pages} pages ({status})")
+    return {'pages': pages, 'activities': activities, 'cursor': cursor, 'stopped': stopped}
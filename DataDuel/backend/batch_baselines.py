@@ -0,0 +1,170 @@
+"""
+Batch Baselines Module - recompute every athlete's baselines in one go
+Used after scoring rules change. All athletes' runs are loaded into flat
+columns with an athlete-index column, and per-athlete counts, sums, means and
+squared deviations come from grouped reductions (np.bincount) instead of a
+Person per athlete. The results are saved as each athlete's running_stats, the
+sums sync_data continues from, and the athlete is flagged rescore_pending so
+their next sync rescores against them.
+
+NumPy is optional: without it the same numbers come from Person.add_activity.
+
+Run with: python batch_baselines.py [data_dir]
+"""
+import os
+import sys
+
+# Add parent directory to path to import Person
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Person import Person
+from athlete_locks import athlete_lock
+from strava_parser import ActivityAggregator
+
+try:
+    import numpy as np
+except ImportError:  # Pure-Python fallback below
+    np = None
+
+METRICS = Person.STAT_METRICS
+
+
+def _user_fields(running_stats):
+    """User fields for one athlete, named and derived like the ones sync_data saves"""
+    # average_speed/max_speed are this week's values (set by sync), not all-time ones
+    return {
+        'total_workouts': running_stats['distance']['count'],
+        'total_distance': running_stats['distance']['total'],
+        'total_moving_time': running_stats['moving_time']['total'],
+        'running_stats': running_stats,
+    }
+
+
+def load_columns(activities_by_athlete):
+    """
+    Flatten every athlete's runs into NumPy columns.
+
+    Returns:
+        (athlete_ids, athlete_index, columns) - athlete_index[i] is the position in
+        athlete_ids of the athlete who ran row i; columns maps metric name to values
+        (as Person.activity_values gives them)
+    """
+    athlete_ids = list(activities_by_athlete)
+    run_types = ActivityAggregator.RUN_TYPES
+
+    runs = []
+    athlete_index = []
+    for position, athlete_id in enumerate(athlete_ids):
+        athlete_runs = [a for a in activities_by_athlete[athlete_id] if a.get('type') in run_types]
+        runs.extend(athlete_runs)
+        athlete_index.extend([position] * len(athlete_runs))
+
+    values = [Person.activity_values(run) for run in runs]
+    columns = {
+        metric: np.fromiter((row[metric] or 0 for row in values), dtype=np.float64, count=len(values))
+        for metric in METRICS
+    }
+    return athlete_ids, np.array(athlete_index, dtype=np.intp), columns
+
+
+def numpy_baselines(activities_by_athlete):
+    """Grouped reductions over all athletes at once (requires NumPy)"""
+    athlete_ids, athlete_index, columns = load_columns(activities_by_athlete)
+    groups = len(athlete_ids)
+
+    counts = np.bincount(athlete_index, minlength=groups)
+    present = counts > 0
+    stats = {}
+    for metric, column in columns.items():
+        totals = np.bincount(athlete_index, weights=column, minlength=groups)
+        means = np.divide(totals, counts, out=np.zeros(groups), where=present)
+        # Two-pass m2: squared deviations from each athlete's own mean
+        m2 = np.bincount(athlete_index, weights=(column - means[athlete_index]) ** 2, minlength=groups)
+        stats[metric] = (totals, means, m2)
+
+    baselines = {}
+    for position in np.flatnonzero(counts):
+        running_stats = {
+            metric: {"count": int(counts[position]), "total": float(totals[position]),
+                     "mean": float(means[position]), "m2": float(m2[position])}
+            for metric, (totals, means, m2) in stats.items()
+        }
+        baselines[athlete_ids[position]] = _user_fields(running_stats)
+    return baselines
+
+
+def python_baselines(activities_by_athlete):
+    """Same results as numpy_baselines, one Person.add_activity per run"""
+    run_types = ActivityAggregator.RUN_TYPES
+    baselines = {}
+    for athlete_id, activities in activities_by_athlete.items():
+        runs = [a for a in activities if a.get('type') in run_types]
+        if not runs:
+            continue
+        person = Person()
+        for run in runs:
+            person.add_activity(run)
+        baselines[athlete_id] = _user_fields(person.running_stats_to_dict())
+    return baselines
+
+
+def compute_baselines(activities_by_athlete, use_numpy=None):
+    """
+    Per-athlete running_stats and run totals for {athlete_id: activities}.
+    Athletes without runs are left out (sync_data skips them too).
+    """
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy and np is None:
+        raise RuntimeError("NumPy is not installed (pip install numpy)")
+    return numpy_baselines(activities_by_athlete) if use_numpy else python_baselines(activities_by_athlete)
+
+
+def recompute_all_baselines(storage, use_numpy=None):
+    """
+    Recompute baselines for every stored user and save them athlete by athlete.
+    Saved running_stats are replaced and the user is flagged rescore_pending, so
+    the next sync scores against the recomputed baselines.
+
+    Each save holds the athlete's lock, re-reads the user and changes only the
+    fields this job owns, so a sync or webhook that saved since the snapshot keeps
+    its fields. An athlete whose activities changed since the snapshot is
+    recomputed from the current ones under the lock.
+
+    Returns:
+        Number of users updated
+    """
+    users = storage.get_all_users()
+    activities_by_athlete = {user_id: storage.get_activities(user_id) for user_id in users}
+
+    engine = "numpy" if (np is not None if use_numpy is None else use_numpy) else "python"
+    print(f"[BASELINES] Recomputing baselines for {len(users)} users ({engine} engine)...")
+    baselines = compute_baselines(activities_by_athlete, use_numpy)
+
+    updated = 0
+    for user_id, fields in baselines.items():
+        with athlete_lock(storage, user_id), storage.transaction():
+            user_data = storage.get_user(user_id)
+            if not user_data:
+                continue
+            activities = storage.get_activities(user_id)
+            if activities != activities_by_athlete[user_id]:
+                fields = python_baselines({user_id: activities}).get(user_id)
+                if fields is None:
+                    continue
+            user_data.update(fields)
+            user_data['rescore_pending'] = True
+            for key in [key for key in user_data if key.startswith('baseline_')]:
+                user_data.pop(key)  # Written by earlier versions of this job, never read
+            storage.save_user(user_id, user_data)
+        updated += 1
+
+    print(f"[BASELINES] Updated {updated} users")
+    return updated
+
+
+if __name__ == "__main__":
+    # Usage: python batch_baselines.py [data_dir]
+    from data_storage import create_storage
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else "data"
+    recompute_all_baselines(create_storage(data_dir=data_dir))
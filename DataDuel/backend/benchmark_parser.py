@@ -0,0 +1,84 @@
+"""
+Parser Benchmark - separate StravaParser scans vs one ActivityAggregator pass
+
+Times what one sync computes from an athlete's history: parse_activities +
+calculate_streak + check_badges + check_challenges, against ActivityAggregator.apply().
+
+Run with: python benchmark_parser.py [activity_count ...]   (default: 10000)
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Person lives in the parent directory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Person import Person
+from strava_parser import ActivityAggregator, StravaParser
+
+REPEATS = 10
+
+
+def make_history(count):
+    """Build a Strava-like history: roughly one activity a day, most of them runs"""
+    now = datetime.now()
+    types = ["Run", "Run", "TrailRun", "Ride", "VirtualRun"]
+    return [
+        {
+            "id": i,
+            "type": types[i % len(types)],
+            "start_date_local": (now - timedelta(hours=20 * i)).isoformat(),
+            "distance": 5000.0 + i % 700,
+            "moving_time": 1800 + i % 300,
+            "elapsed_time": 1900 + i % 300,
+            "total_elevation_gain": 25.0,
+            "average_speed": 2.8,
+            "max_speed": 4.1,
+            "average_cadence": 170.0,
+            "average_heartrate": 150.0
+        }
+        for i in range(count)
+    ]
+
+
+def separate_scans(activities):
+    person = Person()
+    StravaParser.parse_activities(activities, person)
+    person.streak = StravaParser.calculate_streak(activities)
+    StravaParser.check_badges(person)
+    StravaParser.check_challenges(person, activities)
+    return person
+
+
+def single_pass(activities):
+    person = Person()
+    ActivityAggregator(activities).apply(person)
+    return person
+
+
+def best_time(func, activities):
+    timings = []
+    # parse_activities logs every call - keep the output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            func(activities)
+            timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000]
+
+    print("\n" + "="*60)
+    print(f"{'activities':>12} {'separate ms':>14} {'single pass ms':>16} {'speedup':>10}")
+    print("="*60)
+    for count in counts:
+        activities = make_history(count)
+        separate = best_time(separate_scans, activities)
+        single = best_time(single_pass, activities)
+        print(f"{count:>12} {separate*1000:>14.2f} {single*1000:>16.2f} {separate/single:>9.1f}x")
+    print("="*60)
@@ -0,0 +1,87 @@
+"""
+Storage Benchmark - sync-write latency of monolithic vs sharded activity files
+
+Simulates the /api/sync write (save_activities for one athlete) against a
+data directory already holding N athletes' activities.
+
+Run with: python benchmark_storage.py [athlete_count ...]   (default: 1000 10000)
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from data_storage import DataStorage
+
+ACTIVITIES_PER_ATHLETE = 30
+WRITES_PER_RUN = 20
+
+
+def make_activities(athlete_id, count=ACTIVITIES_PER_ATHLETE):
+    """Build Strava-like activity summaries for one athlete"""
+    return [
+        {
+            "id": athlete_id * 1000 + i,
+            "name": f"Run {i}",
+            "type": "Run",
+            "start_date": f"2025-01-{(i % 28) + 1:02d}T07:00:00Z",
+            "distance": 5000.0 + i,
+            "moving_time": 1800 + i,
+            "elapsed_time": 1900 + i,
+            "total_elevation_gain": 25.0,
+            "average_speed": 2.8,
+            "max_speed": 4.1,
+            "average_cadence": 170.0,
+            "average_heartrate": 150.0
+        }
+        for i in range(count)
+    ]
+
+
+def time_writes(storage, athlete_count):
+    """Average seconds per save_activities call for random athletes"""
+    rng = random.Random(42)
+    timings = []
+    for _ in range(WRITES_PER_RUN):
+        athlete_id = rng.randrange(athlete_count)
+        batch = make_activities(athlete_id)
+        start = time.perf_counter()
+        storage.save_activities(str(athlete_id), batch)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return sum(timings) / len(timings), timings[len(timings) // 2], timings[-1]
+
+
+def run(athlete_count):
+    data_dir = tempfile.mkdtemp(prefix="dataduel_bench_")
+    try:
+        print(f"[BENCH] Populating {athlete_count} athletes x {ACTIVITIES_PER_ATHLETE} activities...")
+        with open(os.path.join(data_dir, "activities.json"), 'w') as f:
+            json.dump({str(i): make_activities(i) for i in range(athlete_count)}, f, indent=2)
+
+        results = {}
+        results["monolithic"] = time_writes(DataStorage(data_dir, shard_activities=False), athlete_count)
+        # Creating the sharded storage runs the one-time migration
+        results["sharded"] = time_writes(DataStorage(data_dir, shard_activities=True), athlete_count)
+        return results
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+
+    rows = []
+    for count in counts:
+        for layout, (mean, median, worst) in run(count).items():
+            rows.append((count, layout, mean, median, worst))
+
+    print("\n" + "="*70)
+    print(f"{'athletes':>10} {'layout':>12} {'mean ms':>10} {'median ms':>10} {'max ms':>10}")
+    print("="*70)
+    for count, layout, mean, median, worst in rows:
+        print(f"{count:>10} {layout:>12} {mean*1000:>10.2f} {median*1000:>10.2f} {worst*1000:>10.2f}")
+    print("="*70)
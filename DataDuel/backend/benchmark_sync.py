@@ -0,0 +1,128 @@
+"""
+Sync benchmark - end-to-end sync throughput and tail latency, offline
+The app runs unchanged against the local Strava simulator (strava_simulator),
+with injected latency, 429s and 5xx errors, in a scratch data directory:
+
+1. Interactive: POST /api/sync for the tokens.json athlete, waiting for the
+   job each time. The stored token starts out expired, so get_valid_token's
+   refresh runs too. New activities appear on "Strava" between rounds.
+2. Fleet: app.run_sync for every athlete from a thread pool, round after
+   round, the same pipeline the sync jobs and bulk sync use.
+
+Reports p50/p95/p99 latency per sync and syncs per second for both.
+
+Run with: python benchmark_sync.py [athletes] [rounds] [workers]
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    pick = lambda fraction: round(ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] * 1000, 1)
+    return {"p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 1)}
+
+
+def report(label, latencies, elapsed):
+    stats = percentiles(latencies)
+    print(f"{label:<12} {len(latencies):>6} syncs  {len(latencies) / elapsed:>8.1f} syncs/s  "
+          f"p50 {stats['p50_ms']:>7.1f}ms  p95 {stats['p95_ms']:>7.1f}ms  "
+          f"p99 {stats['p99_ms']:>7.1f}ms  max {stats['max_ms']:>7.1f}ms")
+    return dict(stats, syncs=len(latencies), syncs_per_second=round(len(latencies) / elapsed, 2))
+
+
+def run(athletes=20, rounds=5, workers=8, latency=0.02, latency_jitter=0.02,
+        error_rate=0.02, throttle_rate=0.01, seed=0):
+    # Scratch directory and local storage so real data and Supabase are untouched
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, backend_dir)
+    os.chdir(tempfile.mkdtemp(prefix="dataduel-bench-"))
+    os.environ["USE_SUPABASE_STORAGE"] = "false"
+    os.environ["WEBHOOK_WORKER"] = "false"
+
+    import app
+    from strava_simulator import StravaSimulator, install
+
+    simulator = StravaSimulator(
+        athletes=athletes, activities_per_athlete=150, seed=seed,
+        latency=latency, latency_jitter=latency_jitter,
+        error_rate=error_rate, throttle_rate=throttle_rate,
+        limit=(10 ** 6, 10 ** 7),
+    )
+    install(app.strava_client, simulator)
+    # Injected errors are retried as usual, just with a shorter backoff
+    app.strava_client.backoff = 0.01
+    rng = random.Random(seed)
+
+    tokens = {}
+    for athlete_id in simulator.athletes:
+        tokens[athlete_id] = simulator.issue_tokens(athlete_id)["access_token"]
+        app.storage.save_user(str(athlete_id), {"id": athlete_id, "username": f"athlete{athlete_id}"})
+
+    # tokens.json with an already expired token: the first /api/sync refreshes it
+    expired = simulator.issue_tokens(1, expires_at=int(time.time()) - 60)
+    with open("tokens.json", "w") as f:
+        json.dump({"access_token": expired["access_token"], "refresh_token": expired["refresh_token"],
+                   "expires_at": expired["expires_at"], "athlete_id": 1}, f)
+
+    print(f"Simulated Strava: {athletes} athletes, latency {latency * 1000:.0f}ms + "
+          f"~{latency_jitter * 1000:.0f}ms, {error_rate:.0%} 5xx, {throttle_rate:.0%} 429")
+    results = {}
+    log = io.StringIO()  # the pipeline's progress prints would dominate the timings
+
+    client = app.app.test_client()
+    latencies = []
+    failed = 0
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        for _ in range(rounds * 4):
+            simulator.add_activities(1, rng.randint(0, 2))
+            request_started = time.perf_counter()
+            job = app.sync_jobs.get(client.post("/api/sync").get_json()["job_id"])
+            job.finished.wait()
+            latencies.append(time.perf_counter() - request_started)
+            failed += job.status_code >= 400
+    if failed:
+        print(f"[WARNING] {failed} /api/sync jobs failed")
+    results["interactive"] = report("/api/sync", latencies, time.perf_counter() - started)
+
+    latencies = []
+    elapsed = 0.0
+    for round_number in range(rounds):
+        for athlete_id in rng.sample(list(simulator.athletes), max(1, athletes // 2)):
+            simulator.add_activities(athlete_id, rng.randint(1, 3))
+
+        def sync_one(athlete_id):
+            sync_started = time.perf_counter()
+            _, status = app.run_sync(tokens[athlete_id], str(athlete_id))
+            return time.perf_counter() - sync_started, status
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(log), ThreadPoolExecutor(max_workers=workers) as pool:
+            outcomes = list(pool.map(sync_one, simulator.athletes))
+        elapsed += time.perf_counter() - started
+        latencies.extend(seconds for seconds, _ in outcomes)
+        failed = sum(1 for _, status in outcomes if status >= 400)
+        if failed:
+            print(f"[WARNING] Round {round_number + 1}: {failed} syncs failed")
+    results["fleet"] = report("run_sync", latencies, elapsed)
+
+    print(f"Simulator responses: {dict(sorted(simulator.statuses.items()))}")
+    results["simulator_statuses"] = simulator.statuses
+    return results
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark_sync.py [athletes] [rounds] [workers]
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 8,
+    )
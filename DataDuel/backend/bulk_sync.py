@@ -0,0 +1,231 @@
+"""
+Bulk Sync Module - nightly "sync everyone" run under the global Strava quota
+Every stored athlete is synced through the same pipeline as /api/sync
+(app.run_sync), stalest first, by a fixed number of asyncio workers. Before
+each Strava fetch a worker waits on a RequestPacer, which spreads requests
+evenly over what is left of the 15-minute window and stops the run before
+the daily limit is used up; athletes that did not fit are reported as deferred.
+
+The pipeline itself is blocking (requests, storage writes), so each sync runs
+in a thread via asyncio.to_thread and shares the pooled StravaClient.
+
+Run with: python bulk_sync.py [concurrency] [max_athletes]
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime, timezone
+
+from strava_client import SHORT_WINDOW, rate_limit_budget
+
+# Strava's default read limits, used until a response reports the real ones
+DEFAULT_LIMIT = (100, 1000)
+
+
+def _utc_day(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).date()
+
+
+class RequestPacer:
+    """
+    Hands out request slots that fit the 15-minute and daily limits.
+
+    Usage comes from the shared RateLimitBudget when Strava has reported it,
+    and from the pacer's own count of slots handed out otherwise (whichever is
+    higher). Within a window, slots are spaced evenly over the time left.
+    """
+
+    def __init__(self, budget=None, default_limit=DEFAULT_LIMIT, reserve=(5, 50),
+                 clock=time.time, sleep=asyncio.sleep):
+        """
+        Args:
+            budget: RateLimitBudget (default: the process-wide one)
+            default_limit: (short, daily) limits until a response reports them
+            reserve: (short, daily) requests left unused for interactive syncs
+        """
+        self.budget = budget or rate_limit_budget
+        self.default_limit = default_limit
+        self.reserve = reserve
+        self.clock = clock
+        self.sleep = sleep
+        self._window = None
+        self._day = None
+        self._short_sent = 0
+        self._daily_sent = 0
+        self._next_at = 0
+        self.waited = 0.0
+
+    def _used(self, now):
+        """(short, daily) requests used so far in the current windows"""
+        window = int(now // SHORT_WINDOW)
+        if window != self._window:
+            self._window, self._short_sent = window, 0
+        day = _utc_day(now)
+        if day != self._day:
+            self._day, self._daily_sent = day, 0
+
+        short_used, daily_used = self._short_sent, self._daily_sent
+        remaining = self.budget.remaining()
+        if remaining is not None:
+            short_used = max(short_used, self.budget.limit[0] - remaining[0])
+            daily_used = max(daily_used, self.budget.limit[1] - remaining[1])
+        return short_used, daily_used
+
+    async def acquire(self):
+        """
+        Wait for a request slot.
+
+        Returns:
+            True when a request may be sent, False once the daily budget
+            (minus the reserve) is used up
+        """
+        while True:
+            now = self.clock()
+            limit = self.budget.limit or self.default_limit
+            short_used, daily_used = self._used(now)
+            if daily_used >= limit[1] - self.reserve[1]:
+                return False
+
+            window_end = (int(now // SHORT_WINDOW) + 1) * SHORT_WINDOW
+            short_left = limit[0] - self.reserve[0] - short_used
+            if short_left <= 0:
+                wait = window_end - now
+            else:
+                wait = self._next_at - now
+            if wait > 0:
+                self.waited += wait
+                await self.sleep(wait)
+                continue
+
+            # Spread the rest of this window's budget over the time left in it
+            self._next_at = now + (window_end - now) / short_left
+            self._short_sent += 1
+            self._daily_sent += 1
+            return True
+
+
+def stalest_first(storage, athlete_ids):
+    """
+    Athletes ordered by staleness: never synced first, then by when they were
+    last synced (last_synced_at, saved by run_sync), longest ago first. Athletes
+    synced before last_synced_at was recorded fall back to their watermark, the
+    start of their newest synced activity, which is no later than that sync.
+    """
+    users = storage.get_users(athlete_ids)
+
+    def staleness(athlete_id):
+        synced_at = users.get(str(athlete_id), {}).get('last_synced_at')
+        if synced_at is None:
+            synced_at = storage.get_sync_watermark(athlete_id)
+        return (synced_at is not None, synced_at or 0)
+    return sorted(athlete_ids, key=staleness)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(int(len(ordered) * fraction), len(ordered) - 1)], 3)
+
+
+async def bulk_sync(athlete_ids, sync_one, pacer=None, concurrency=8, report_every=25):
+    """
+    Sync athletes in the given order with `concurrency` workers.
+
+    Args:
+        athlete_ids: Athletes to sync, highest priority first
+        sync_one: Blocking athlete_id -> (result dict, HTTP status); one Strava fetch
+        pacer: RequestPacer gating each sync (default: one on the shared budget)
+        report_every: Print progress after this many athletes
+
+    Returns:
+        Metrics dictionary: counts per outcome, elapsed seconds, athletes per
+        minute, per-sync latency p50/p95 and time spent waiting for the pacer
+    """
+    pacer = pacer or RequestPacer()
+    queue = asyncio.Queue()
+    for athlete_id in athlete_ids:
+        queue.put_nowait(athlete_id)
+
+    outcomes = {"synced": 0, "up_to_date": 0, "failed": 0, "deferred": 0}
+    latencies = []
+    started = time.monotonic()
+    total = len(athlete_ids)
+
+    def report(final=False):
+        elapsed = time.monotonic() - started
+        done = sum(outcomes.values())
+        rate = done / elapsed * 60 if elapsed > 0 else 0
+        print(f"[BULK SYNC] {'Finished' if final else 'Progress'}: {done}/{total} athletes "
+              f"({outcomes}), {rate:.1f} athletes/min, {pacer.waited:.0f}s paced")
+
+    async def worker():
+        while True:
+            try:
+                athlete_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if not await pacer.acquire():
+                # Daily budget reached: everything still queued waits for tomorrow
+                outcomes["deferred"] += 1 + queue.qsize()
+                while not queue.empty():
+                    queue.get_nowait()
+                return
+
+            sync_started = time.monotonic()
+            try:
+                result, status = await asyncio.to_thread(sync_one, athlete_id)
+            except Exception as e:
+                result, status = {"error": str(e)}, 500
+            latencies.append(time.monotonic() - sync_started)
+
+            if status >= 400:
+                print(f"[BULK SYNC] Athlete {athlete_id} failed ({status}): {result.get('error')}")
+                outcomes["failed"] += 1
+            elif result.get("message") == "Already up to date":
+                outcomes["up_to_date"] += 1
+            else:
+                outcomes["synced"] += 1
+
+            if report_every and sum(outcomes.values()) % report_every == 0:
+                report()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, total)))))
+    report(final=True)
+
+    elapsed = time.monotonic() - started
+    attempted = total - outcomes["deferred"]
+    return dict(
+        outcomes,
+        total=total,
+        elapsed_seconds=round(elapsed, 3),
+        athletes_per_minute=round(attempted / elapsed * 60, 2) if elapsed > 0 else None,
+        latency_p50=_percentile(latencies, 0.5),
+        latency_p95=_percentile(latencies, 0.95),
+        paced_seconds=round(pacer.waited, 3),
+    )
+
+
+def main(concurrency=8, max_athletes=None):
+    # The per-athlete pipeline and token lookup are the ones the API uses
+    from app import get_athlete_token, run_sync, storage
+
+    athlete_ids = stalest_first(storage, list(storage.get_all_users()))
+    if max_athletes:
+        athlete_ids = athlete_ids[:max_athletes]
+    print(f"[BULK SYNC] Syncing {len(athlete_ids)} athletes with {concurrency} workers")
+
+    def sync_one(athlete_id):
+        return run_sync(get_athlete_token(athlete_id), athlete_id)
+
+    metrics = asyncio.run(bulk_sync(athlete_ids, sync_one, concurrency=concurrency))
+    print(f"[BULK SYNC] Metrics: {metrics}")
+    return metrics
+
+
+if __name__ == "__main__":
+    # Usage: python bulk_sync.py [concurrency] [max_athletes]
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+        int(sys.argv[2]) if len(sys.argv) > 2 else None,
+    )
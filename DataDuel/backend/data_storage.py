@@ -2,18 +2,73 @@
 Data Storage Module - JSON-based temporary storage for MVP
 This will be replaced with a database in the future.
 """
+import hashlib
 import json
 import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
+from day_index import annotate_activity
+from score_index import ScoreIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows - only in-process locking is available
+    fcntl = None
+
 class DataStorage:
     """Manages JSON file storage for users, activities, and scores"""
     
-    def __init__(self, data_dir="data"):
+    def __init__(self, data_dir="data", shard_activities=None, multiprocess=None):
         self.data_dir = data_dir
         self.users_file = os.path.join(data_dir, "users.json")
         self.activities_file = os.path.join(data_dir, "activities.json")
         self.scores_file = os.path.join(data_dir, "scores.json")
+        # Per-athlete incremental sync state: {athlete_id: {"watermark": epoch seconds}}
+        self.sync_state_file = os.path.join(data_dir, "sync_state.json")
+        
+        # Sharded layout: data/activities/<bucket>/<athlete_id>.json plus index.json
+        if shard_activities is None:
+            shard_activities = os.getenv("SHARD_ACTIVITIES", "true").lower() == "true"
+        self.shard_activities = shard_activities
+        self.activities_dir = os.path.join(data_dir, "activities")
+        self.activities_index_file = os.path.join(self.activities_dir, "index.json")
+        
+        # Multi-process mode: flock-serialized writers, fsync'd writes, generation counters
+        if multiprocess is None:
+            multiprocess = os.getenv("STORAGE_MULTIPROCESS", "false").lower() == "true"
+        if multiprocess and fcntl is None:
+            print("[STORAGE] WARNING: fcntl unavailable, multi-process mode disabled")
+            multiprocess = False
+        self.multiprocess = multiprocess
+        self._write_lock = threading.RLock()
+        self._lock_fds = {}
+        self._lock_pid = os.getpid()
+        # The shared collection files get a lock file each. Activity shards are
+        # merged read-modify-write too, so they are locked as well, through one
+        # lock file per hash bucket (at most 256 open lock files)
+        self._shared_files = {self.users_file, self.activities_file, self.scores_file, self.activities_index_file,
+                              self.sync_state_file}
+        
+        # Parsed file cache: filepath -> ((generation, inode, mtime_ns, size), data)
+        self._cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        
+        # Leaderboard order, kept in step with scores.json by every write to it
+        self._score_index = None
+        self._score_index_version = None
+        
+        # athlete_id -> (activity list object, {activity_id: position}) for merge_activities
+        self._activity_positions = {}
+        
+        # Per-thread unit of work: filepath -> buffered replacement/key updates
+        self._local = threading.local()
         
         # Create data directory if it doesn't exist
         os.makedirs(data_dir, exist_ok=True)
@@ -22,22 +77,240 @@ class DataStorage:
         self._init_file(self.users_file, {})
         self._init_file(self.activities_file, {})
         self._init_file(self.scores_file, {})
+        self._init_file(self.sync_state_file, {})
+        
+        if self.shard_activities and not os.path.exists(self.activities_index_file):
+            self.migrate_activities_to_shards()
+        
+        with self._write_lock:
+            self._current_score_index()
     
     def _init_file(self, filepath, default_data):
         """Initialize a JSON file with default data if it doesn't exist"""
-        if not os.path.exists(filepath):
-            with open(filepath, 'w') as f:
+        try:
+            # 'x' fails if another worker created the file first
+            with open(filepath, 'x') as f:
                 json.dump(default_data, f, indent=2)
+        except FileExistsError:
+            pass
     
-    def _read_file(self, filepath):
-        """Read and return data from a JSON file"""
+    # Locking and generations (multi-process mode)
+    def _lock_fd(self, filepath):
+        """
+        File descriptor of <file>.lock, which holds the file's generation counter.
+        Descriptors are reopened after a fork so each worker gets its own flock.
+        """
+        if self._lock_pid != os.getpid():
+            self._lock_fds = {}
+            self._lock_pid = os.getpid()
+        fd = self._lock_fds.get(filepath)
+        if fd is None:
+            fd = os.open(filepath + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+            self._lock_fds[filepath] = fd
+        return fd
+    
+    def _lock_path(self, filepath):
+        """Path whose .lock guards filepath: the file itself, or an activity shard's bucket"""
+        if filepath in self._shared_files:
+            return filepath
+        bucket = os.path.dirname(filepath)
+        if os.path.dirname(bucket) == self.activities_dir:
+            return bucket
+        return None
+    
+    def _generation(self, filepath):
+        """Read a file's generation counter (0 when multi-process mode is off or for shards)"""
+        if not self.multiprocess or filepath not in self._shared_files:
+            return 0
+        raw = os.pread(self._lock_fd(filepath), 8, 0)
+        return struct.unpack('<Q', raw)[0] if len(raw) == 8 else 0
+    
+    def _bump_generation(self, filepath):
+        if self.multiprocess and filepath in self._shared_files:
+            os.pwrite(self._lock_fd(filepath), struct.pack('<Q', self._generation(filepath) + 1), 0)
+    
+    @contextmanager
+    def _locked(self, filepaths):
+        """Hold exclusive locks on files (sorted to avoid deadlocks) for a read-modify-write"""
+        with self._write_lock:
+            shared = sorted({self._lock_path(path) for path in filepaths} - {None}) if self.multiprocess else []
+            fds = [self._lock_fd(path) for path in shared]
+            for fd in fds:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                for fd in reversed(fds):
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+    
+    # Reading
+    def _load(self, filepath):
+        """
+        Return the parsed contents of a file on disk.
+        The parsed data is cached until the file's generation, inode, mtime or
+        size changes, so repeated reads in one request cost a dict lookup. Readers
+        never lock: writers replace files atomically, and the generation is
+        read before the file so a racing write only causes an extra re-read.
+        """
+        generation = self._generation(filepath)
+        stat = os.stat(filepath)
+        cached = self._cache.get(filepath)
+        version = (generation, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if cached and cached[0] == version:
+            self.cache_hits += 1
+            return cached[1]
+        
+        self.cache_misses += 1
         with open(filepath, 'r') as f:
-            return json.load(f)
+            data = json.load(f)
+        self._cache[filepath] = (version, data)
+        return data
+    
+    def _read_file(self, filepath):
+        """
+        Read and return data from a JSON file, including this thread's
+        uncommitted transaction writes. Treat it as read-only.
+        """
+        pending = self._pending()
+        if pending is None or filepath not in pending:
+            return self._load(filepath)
+        return self._apply_pending(filepath, pending[filepath])
     
+    def _has_file(self, filepath):
+        pending = self._pending()
+        return (pending is not None and filepath in pending) or os.path.exists(filepath)
+    
+    # Writing
     def _write_file(self, filepath, data):
-        """Write data to a JSON file"""
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2)
+        """
+        Replace a JSON file's contents.
+        Inside transaction() the write is buffered until the transaction commits.
+        """
+        pending = self._pending()
+        if pending is not None:
+            pending[filepath] = {"data": data, "updates": {}}
+            return
+        
+        with self._locked([filepath]):
+            self._replace_file(self._write_temp(filepath, data), filepath, data)
+    
+    def _update_file(self, filepath, updates):
+        """
+        Set top-level keys of a JSON object file.
+        The file is re-read under an exclusive lock, so concurrent workers
+        updating different keys never lose each other's writes.
+        """
+        pending = self._pending()
+        if pending is not None:
+            pending.setdefault(filepath, {"data": None, "updates": {}})["updates"].update(updates)
+            return
+        
+        with self._locked([filepath]):
+            data = dict(self._load(filepath))
+            data.update(updates)
+            self._replace_file(self._write_temp(filepath, data), filepath, data, updates.keys())
+    
+    def _apply_pending(self, filepath, entry):
+        """Current file data (or its buffered replacement) with buffered key updates and merges applied"""
+        if entry["data"] is not None:
+            data = entry["data"]
+        elif entry.get("merges") and not os.path.exists(filepath):
+            data = []
+        else:
+            data = self._load(filepath)
+        if entry["updates"]:
+            data = dict(data)
+            data.update(entry["updates"])
+        for batch in entry.get("merges", ()):
+            data = merge_activity_list(data, batch)[0]
+        return data
+    
+    def _write_temp(self, filepath, data):
+        """Serialize data to a temp file next to filepath and return its path"""
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(filepath) or ".",
+            prefix=os.path.basename(filepath) + ".",
+            suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2)
+                if self.multiprocess:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+    
+    def _replace_file(self, tmp_path, filepath, data, updated_keys=None):
+        """
+        Atomically move a temp file over filepath, then bump its generation and cache it.
+        updated_keys names the keys changed relative to the cached (just loaded) contents;
+        None means the whole file was replaced.
+        """
+        base_version = self._cache.get(filepath, (None, None))[0]
+        os.replace(tmp_path, filepath)
+        self._bump_generation(filepath)
+        stat = os.stat(filepath)
+        version = (self._generation(filepath), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self._cache[filepath] = (version, data)
+        
+        if filepath == self.scores_file:
+            self._score_index_written(base_version, version, data, updated_keys)
+    
+    # Transactions
+    def _pending(self):
+        return getattr(self._local, "pending", None)
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work: buffer every write made in this thread and flush them on exit.
+        
+        Each touched file is written once, however many saves hit it. Buffered
+        key updates are re-applied to the latest file contents under exclusive
+        locks, all temp files are written before any is renamed into place, and
+        nothing is written if the block raises. Nested transactions join the outer one.
+        """
+        if self._pending() is not None:
+            yield self
+            return
+        
+        self._local.pending = {}
+        try:
+            yield self
+            pending = self._local.pending
+        finally:
+            # Rollback is just dropping the buffer
+            self._local.pending = None
+        
+        if not pending:
+            return
+        
+        with self._locked(pending.keys()):
+            written = []
+            try:
+                for filepath, entry in pending.items():
+                    data = self._apply_pending(filepath, entry)
+                    updated_keys = entry["updates"].keys() if entry["data"] is None else None
+                    written.append((self._write_temp(filepath, data), filepath, data, updated_keys))
+            except Exception:
+                for tmp_path, _, _, _ in written:
+                    os.remove(tmp_path)
+                raise
+            
+            for tmp_path, filepath, data, updated_keys in written:
+                self._replace_file(tmp_path, filepath, data, updated_keys)
+        print(f"      [STORAGE] Transaction committed: {len(written)} file(s) written")
+    
+    def cache_stats(self):
+        """Get read cache hit/miss counters"""
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "cached_files": len(self._cache)
+        }
     
     # User operations
     def get_user(self, user_id):
@@ -46,10 +319,12 @@ class DataStorage:
         print(f"         User ID: {user_id}")
         
         users = self._read_file(self.users_file)
-        print(f"         Available users in storage: {list(users.keys())}")
+        print(f"         Users in storage: {len(users)}")
         
+        # Copy so callers can edit it without touching the cached file data
         user_data = users.get(str(user_id))
         if user_data:
+            user_data = dict(user_data)
             print(f"         [SUCCESS] User found, keys: {list(user_data.keys())}")
         else:
             print(f"         [ERROR] User NOT found")
@@ -62,39 +337,162 @@ class DataStorage:
         print(f"         User ID: {user_id}")
         print(f"         User data keys: {list(user_data.keys())}")
         
-        users = self._read_file(self.users_file)
-        print(f"         Existing users in storage: {list(users.keys())}")
-        
-        users[str(user_id)] = user_data
-        users[str(user_id)]['updated_at'] = datetime.now().isoformat()
+        user_data['updated_at'] = datetime.now().isoformat()
+        self._update_file(self.users_file, {str(user_id): user_data})
         
-        self._write_file(self.users_file, users)
         print(f"         [SUCCESS] User data written to {self.users_file}")
-        print(f"         Total users in storage: {len(users)}")
+    
+    def save_users(self, users):
+        """Save or update many users with one write of users.json"""
+        now = datetime.now().isoformat()
+        for user_data in users.values():
+            user_data['updated_at'] = now
+        self._update_file(self.users_file, {str(user_id): user_data for user_id, user_data in users.items()})
+        print(f"      [STORAGE] Saved {len(users)} users to {self.users_file}")
     
     def get_all_users(self):
         """Get all users"""
         return self._read_file(self.users_file)
     
+    def get_users(self, user_ids):
+        """Get {user_id: user_data} for many users with one file read (missing users are skipped)"""
+        users = self._read_file(self.users_file)
+        print(f"      [STORAGE] DataStorage.get_users() called for {len(user_ids)} IDs")
+        return {str(user_id): dict(users[str(user_id)]) for user_id in user_ids if str(user_id) in users}
+    
+    def get_user_summaries(self, user_ids):
+        """Get user data merged with score/improvement for many users (see build_user_summaries)"""
+        return build_user_summaries(user_ids, self.get_users(user_ids), self.get_scores(user_ids))
+    
     # Activity operations
     def get_activities(self, user_id):
         """Get activities for a specific user"""
+        if self.shard_activities:
+            shard_file = self._shard_file(user_id)
+            if not self._has_file(shard_file):
+                return []
+            return self._read_file(shard_file)
+        
         activities = self._read_file(self.activities_file)
         return activities.get(str(user_id), [])
     
     def save_activities(self, user_id, activities_data):
         """Save activities for a user"""
-        activities = self._read_file(self.activities_file)
-        activities[str(user_id)] = activities_data
-        self._write_file(self.activities_file, activities)
+        if self.shard_activities:
+            self._write_shard(user_id, activities_data)
+            return
+        
+        self._update_file(self.activities_file, {str(user_id): activities_data})
     
     def add_activity(self, user_id, activity_data):
-        """Add a single activity to user's activities"""
+        """Add a single activity to user's activities (replaces one with the same id)"""
+        self.merge_activities(user_id, [activity_data])
+    
+    def get_activities_by_id(self, user_id, activity_ids):
+        """Get {activity_id: activity} for the given ids of one user (unknown ids are skipped)"""
+        user_id = str(user_id)
+        with self._write_lock:
+            activities = self.get_activities(user_id)
+            cached = self._activity_positions.get(user_id)
+            if cached is not None and cached[0] is activities:
+                positions = cached[1]
+            else:
+                positions = index_activities(activities)
+                self._activity_positions[user_id] = (activities, positions)
+        
+        found = {}
+        for activity_id in activity_ids:
+            position = positions.get(str(activity_id))
+            if position is not None:
+                found[str(activity_id)] = activities[position]
+        return found
+    
+    def merge_activities(self, user_id, batch):
+        """
+        Upsert activities by Strava id, keeping the list sorted by start date.
+        Nothing is written when the batch changes nothing, so re-syncing a page is cheap.
+        
+        Returns:
+            Dictionary with "inserted", "updated" and "unchanged" counts
+        """
+        user_id = str(user_id)
+        with self._write_lock:
+            existing = self.get_activities(user_id)
+            # The id -> position index stays valid while the stored list object is unchanged
+            cached = self._activity_positions.get(user_id)
+            positions = cached[1] if cached is not None and cached[0] is existing else None
+            
+            merged, positions, counts = merge_activity_list(existing, batch, positions)
+            if merged is not existing:
+                if self.shard_activities:
+                    self._merge_shard(user_id, batch)
+                else:
+                    self.save_activities(user_id, merged)
+            self._activity_positions[user_id] = (merged, positions)
+        
+        print(f"[STORAGE] Merged activities for user {user_id}: {counts}")
+        return counts
+    
+    def get_activity_user_ids(self):
+        """Get IDs of every user with saved activities"""
+        if self.shard_activities:
+            return list(self._read_file(self.activities_index_file).keys())
+        return list(self._read_file(self.activities_file).keys())
+    
+    # Sharded activity layout
+    @staticmethod
+    def _shard_path(user_id):
+        """Relative path of a user's shard: <2-char hash bucket>/<user_id>.json"""
+        user_id = str(user_id)
+        if not re.fullmatch(r"[\w-]+", user_id):
+            raise ValueError(f"Invalid user ID for activity shard: {user_id!r}")
+        bucket = hashlib.md5(user_id.encode('utf-8')).hexdigest()[:2]
+        return os.path.join(bucket, f"{user_id}.json")
+    
+    def _shard_file(self, user_id):
+        return os.path.join(self.activities_dir, self._shard_path(user_id))
+    
+    def _write_shard(self, user_id, activities_data):
+        """Write one user's activities, registering them in the index if new"""
+        shard_file = self._shard_file(user_id)
+        os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+        self._write_file(shard_file, activities_data)
+        
+        # The index only changes when a new athlete shows up
+        if str(user_id) not in self._read_file(self.activities_index_file):
+            self._update_file(self.activities_index_file, {str(user_id): self._shard_path(user_id)})
+    
+    def _merge_shard(self, user_id, batch):
+        """
+        Merge a batch into a user's shard. The merge is buffered like a key update
+        and re-applied to the shard's latest contents under its lock at commit, so
+        a concurrent merge from another thread or worker is never overwritten.
+        """
+        shard_file = self._shard_file(user_id)
+        os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+        with self.transaction():
+            entry = self._pending().setdefault(shard_file, {"data": None, "updates": {}})
+            entry.setdefault("merges", []).append(batch)
+            if str(user_id) not in self._read_file(self.activities_index_file):
+                self._update_file(self.activities_index_file, {str(user_id): self._shard_path(user_id)})
+    
+    def migrate_activities_to_shards(self):
+        """
+        One-time migration: split activities.json into one file per athlete.
+        activities.json is left untouched so SHARD_ACTIVITIES=false still works.
+        """
         activities = self._read_file(self.activities_file)
-        if str(user_id) not in activities:
-            activities[str(user_id)] = []
-        activities[str(user_id)].append(activity_data)
-        self._write_file(self.activities_file, activities)
+        os.makedirs(self.activities_dir, exist_ok=True)
+        
+        index = {}
+        for user_id, activities_data in activities.items():
+            shard_file = self._shard_file(user_id)
+            os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+            self._write_file(shard_file, activities_data)
+            index[str(user_id)] = self._shard_path(user_id)
+        self._write_file(self.activities_index_file, index)
+        
+        print(f"[STORAGE] Migrated activities for {len(index)} users to {self.activities_dir}")
     
     # Score operations
     def get_score(self, user_id):
@@ -106,6 +504,7 @@ class DataStorage:
         score_data = scores.get(str(user_id))
         
         if score_data:
+            score_data = dict(score_data)
             print(f"         [SUCCESS] Score found: {score_data.get('score')}")
         else:
             print(f"         [ERROR] Score NOT found")
@@ -119,10 +518,8 @@ class DataStorage:
         print(f"         Score: {score_data.get('score')}")
         print(f"         Improvement: {score_data.get('improvement')}")
         
-        scores = self._read_file(self.scores_file)
-        scores[str(user_id)] = score_data
-        scores[str(user_id)]['updated_at'] = datetime.now().isoformat()
-        self._write_file(self.scores_file, scores)
+        score_data['updated_at'] = datetime.now().isoformat()
+        self._update_file(self.scores_file, {str(user_id): score_data})
         
         print(f"         [SUCCESS] Score data written to {self.scores_file}")
     
@@ -130,9 +527,245 @@ class DataStorage:
         """Get all scores for leaderboard"""
         return self._read_file(self.scores_file)
     
+    # Sync state operations
+    def get_sync_watermark(self, user_id):
+        """Start time (epoch seconds) of the newest activity synced for a user, or None"""
+        state = self._read_file(self.sync_state_file).get(str(user_id))
+        return state.get('watermark') if state else None
+    
+    def save_sync_watermark(self, user_id, watermark):
+        """Record the newest synced start time; the next sync asks Strava for activities after it"""
+        self._update_file(self.sync_state_file, {
+            str(user_id): {'watermark': watermark, 'updated_at': datetime.now().isoformat()}
+        })
+    
+    def get_scores(self, user_ids):
+        """Get {user_id: score_data} for many users with one file read (missing scores are skipped)"""
+        scores = self._read_file(self.scores_file)
+        return {str(user_id): dict(scores[str(user_id)]) for user_id in user_ids if str(user_id) in scores}
+    
+    def get_leaderboard(self, limit=None):
+        """
+        Get (user_id, score_data, user_data) rows sorted by score, highest first.
+        Order comes from the maintained score index, so only the returned rows are touched.
+        """
+        with self._write_lock:
+            index, scores = self._current_score_index()
+            user_ids = index.top(limit)
+        users = self._read_file(self.users_file)
+        return [(user_id, dict(scores[user_id]), users.get(user_id, {})) for user_id in user_ids]
+    
+    def get_rank(self, user_id):
+        """Get a user's 1-based leaderboard rank (binary search), or None if they have no score"""
+        with self._write_lock:
+            index, _ = self._current_score_index()
+            return index.rank(user_id)
+    
+    # Score index
+    def _current_score_index(self):
+        """
+        Return (ScoreIndex, scores) for the current scores.json (call with _write_lock held).
+        The index is only rebuilt when scores.json changed without going through
+        this instance, e.g. another worker process wrote it.
+        """
+        scores = self._read_file(self.scores_file)
+        pending = self._pending()
+        if pending is not None and self.scores_file in pending:
+            # Uncommitted scores in this transaction - build a throwaway index
+            return ScoreIndex.from_scores(scores), scores
+        
+        version = self._cache[self.scores_file][0]
+        if self._score_index is None or self._score_index_version != version:
+            self._score_index = ScoreIndex.from_scores(scores)
+            self._score_index_version = version
+            print(f"[STORAGE] Built score index for {len(self._score_index)} users")
+        return self._score_index, scores
+    
+    def _score_index_written(self, base_version, version, data, updated_keys):
+        """Apply a scores.json write to the index, or drop the index if it can't be patched"""
+        if self._score_index is None:
+            return
+        if updated_keys is None or self._score_index_version != base_version:
+            self._score_index = None
+            return
+        for user_id in updated_keys:
+            self._score_index.update(user_id, data[user_id].get('score', 0))
+        self._score_index_version = version
+    
     def clear_all_data(self):
         """Clear all data (for testing/reset)"""
         self._write_file(self.users_file, {})
         self._write_file(self.activities_file, {})
         self._write_file(self.scores_file, {})
+        self._write_file(self.sync_state_file, {})
+        
+        if self.shard_activities:
+            shutil.rmtree(self.activities_dir, ignore_errors=True)
+            self._cache.clear()
+            os.makedirs(self.activities_dir, exist_ok=True)
+            self._write_file(self.activities_index_file, {})
+
+
+def load_json_data(data_dir="data"):
+    """
+    Read everything DataStorage saved in data_dir without creating any files.
+    Activities come from the per-athlete shards when present, else activities.json.
+    
+    Returns:
+        Dictionary with "users", "activities", "scores" and "sync_state" collections
+    """
+    def load(filepath):
+        if not os.path.exists(filepath):
+            return {}
+        with open(filepath, 'r') as f:
+            return json.load(f)
+    
+    activities_dir = os.path.join(data_dir, "activities")
+    index = load(os.path.join(activities_dir, "index.json"))
+    if index:
+        activities = {
+            user_id: load(os.path.join(activities_dir, shard_path)) or []
+            for user_id, shard_path in index.items()
+        }
+    else:
+        activities = load(os.path.join(data_dir, "activities.json"))
+    
+    return {
+        "users": load(os.path.join(data_dir, "users.json")),
+        "activities": activities,
+        "scores": load(os.path.join(data_dir, "scores.json")),
+        "sync_state": load(os.path.join(data_dir, "sync_state.json"))
+    }
+
+
+def build_user_summaries(user_ids, users, scores):
+    """
+    Merge user and score data for the friends/search endpoints.
+    
+    Returns:
+        {user_id: user_data plus 'score' and 'improvement'} for every requested ID;
+        unknown users get an empty summary with score and improvement of 0
+    """
+    summaries = {}
+    for user_id in user_ids:
+        user_id = str(user_id)
+        score_data = scores.get(user_id) or {}
+        summary = dict(users.get(user_id, {}))
+        summary['score'] = score_data.get('score', 0)
+        summary['improvement'] = score_data.get('improvement', 0)
+        summaries[user_id] = summary
+    return summaries
+
+
+def activity_sort_key(activity):
+    """Stored activities are kept in start-date order (ISO strings sort chronologically)"""
+    return activity.get('start_date_local') or activity.get('start_date') or ''
+
+
+def index_activities(activities):
+    """Build the {activity_id: position} index of an athlete's activity list"""
+    return {str(activity['id']): position for position, activity in enumerate(activities) if activity.get('id') is not None}
+
+
+def merge_activity_list(existing, batch, positions=None):
+    """
+    Upsert a batch of Strava activities into an athlete's list, keyed by activity id.
+    
+    Args:
+        existing: Current activity list (re-sorted by start date if it isn't already)
+        batch: Activities to insert or update; ones without an id are always inserted.
+            Each is stored with its local epoch day / ISO week (see day_index.py)
+        positions: {activity_id: position} index of existing, built if omitted
+        
+    Returns:
+        (merged, positions, counts) - merged is existing itself when nothing changed,
+        counts is {"inserted", "updated", "unchanged"}
+    """
+    batch = [annotate_activity(activity) for activity in batch]
+    merged = existing
+    resort = False
+    if positions is None:
+        keys = [activity_sort_key(activity) for activity in existing]
+        resort = any(keys[i] > keys[i + 1] for i in range(len(keys) - 1))
+        positions = index_activities(existing)
+    
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    new_by_id = {}
+    new_without_id = []
+    for activity in batch:
+        activity_id = activity.get('id')
+        if activity_id is None:
+            new_without_id.append(activity)
+            counts["inserted"] += 1
+            continue
+        
+        key = str(activity_id)
+        position = positions.get(key)
+        if position is None:
+            if key not in new_by_id:
+                counts["inserted"] += 1
+            new_by_id[key] = activity
+        elif merged[position] == activity:
+            counts["unchanged"] += 1
+        else:
+            if merged is existing:
+                merged = list(existing)
+            resort = resort or activity_sort_key(activity) != activity_sort_key(merged[position])
+            merged[position] = activity
+            counts["updated"] += 1
+    
+    additions = sorted(list(new_by_id.values()) + new_without_id, key=activity_sort_key)
+    if additions:
+        if merged is existing:
+            merged = list(existing)
+        # Incremental syncs only bring newer activities - append without re-sorting
+        if not resort and (not merged or activity_sort_key(additions[0]) >= activity_sort_key(merged[-1])):
+            positions = dict(positions)
+            for activity in additions:
+                if activity.get('id') is not None:
+                    positions[str(activity['id'])] = len(merged)
+                merged.append(activity)
+        else:
+            merged.extend(additions)
+            resort = True
+    
+    if resort:
+        merged = sorted(merged, key=activity_sort_key)
+        positions = index_activities(merged)
+    return merged, positions, counts
+
+
+def sort_leaderboard(all_scores, all_users, limit=None):
+    """Join scores with users and sort by score, highest first (ties keep insertion order)"""
+    rows = [
+        (user_id, score_data, all_users.get(user_id, {}))
+        for user_id, score_data in all_scores.items()
+    ]
+    rows.sort(key=lambda row: row[1].get('score', 0), reverse=True)
+    return rows if limit is None else rows[:limit]
+
+
+def create_storage(backend=None, data_dir="data"):
+    """
+    Build the storage backend selected by the STORAGE_BACKEND env variable.
+
+    Backends:
+    - json (default): DataStorage, one JSON file per collection
+    - log: LogStorage, append-only segment logs with background compaction
+    - sqlite: SQLiteStorage, indexed tables in data/dataduel.db
+
+    Every backend exposes the same methods as DataStorage.
+    """
+    backend = (backend or os.getenv("STORAGE_BACKEND", "json")).lower()
+
+    if backend == "json":
+        return DataStorage(data_dir)
+    if backend == "log":
+        from log_storage import LogStorage
+        return LogStorage(data_dir)
+    if backend == "sqlite":
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(data_dir)
+
+    raise ValueError(f"Unknown storage backend: {backend}")
 
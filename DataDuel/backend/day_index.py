@@ -0,0 +1,121 @@
+"""
+Day Index Module - integer calendar days for streak and week calculations
+Each activity carries its local start date as an epoch day (days since
+1970-01-01) and an ISO week key, computed once when it is stored. Streaks and
+week windows are then integer operations over a sorted array of days.
+"""
+from bisect import bisect_right
+from datetime import date, datetime, timezone
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def epoch_day(day):
+    """date -> days since 1970-01-01"""
+    return day.toordinal() - EPOCH_ORDINAL
+
+
+def day_from_epoch(day_number):
+    """Days since 1970-01-01 -> date"""
+    return date.fromordinal(day_number + EPOCH_ORDINAL)
+
+
+def iso_week_key(day_number):
+    """ISO week of an epoch day as an int, e.g. 202503 for 2025-W03"""
+    iso_year, iso_week, _ = day_from_epoch(day_number).isocalendar()
+    return iso_year * 100 + iso_week
+
+
+def activity_epoch_day(activity):
+    """Local start day of an activity (pre-computed if annotated), or None if it has no date"""
+    day_number = activity.get('local_epoch_day')
+    if day_number is not None:
+        return day_number
+    start_date_str = activity.get('start_date_local') or activity.get('start_date')
+    if not start_date_str:
+        return None
+    # The local calendar date is the first 10 characters of the ISO timestamp
+    return date.fromisoformat(start_date_str[:10]).toordinal() - EPOCH_ORDINAL
+
+
+def activity_timestamp(activity):
+    """UTC start time of an activity in epoch seconds (the unit of Strava's after=), or None"""
+    start_date_str = activity.get('start_date')
+    if not start_date_str:
+        return None
+    start = datetime.fromisoformat(start_date_str.replace('Z', '+00:00'))
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    return int(start.timestamp())
+
+
+def annotate_activity(activity):
+    """
+    Return the activity with 'local_epoch_day' and 'local_iso_week' set.
+    The same dict comes back if it is already up to date, otherwise a copy.
+    """
+    start_date_str = activity.get('start_date_local') or activity.get('start_date')
+    if not start_date_str:
+        return activity
+    day_number = date.fromisoformat(start_date_str[:10]).toordinal() - EPOCH_ORDINAL
+    if activity.get('local_epoch_day') == day_number and 'local_iso_week' in activity:
+        return activity
+    annotated = dict(activity)
+    annotated['local_epoch_day'] = day_number
+    annotated['local_iso_week'] = iso_week_key(day_number)
+    return annotated
+
+
+class DayIndex:
+    """
+    Sorted distinct activity days with the start of each consecutive run of days,
+    so "streak as of day X" is one binary search and the longest streak is stored.
+    """
+
+    def __init__(self, day_numbers=()):
+        self.days = sorted(set(day_numbers))
+        self.run_starts = []
+
+        run_start = previous = None
+        append = self.run_starts.append
+        for day_number in self.days:
+            if previous is None or day_number != previous + 1:
+                run_start = day_number
+            append(run_start)
+            previous = day_number
+
+        self.longest_streak = max(
+            (day_number - start + 1 for day_number, start in zip(self.days, self.run_starts)), default=0
+        )
+
+    @classmethod
+    def from_activities(cls, activities):
+        return cls(day for day in map(activity_epoch_day, activities) if day is not None)
+
+    def __len__(self):
+        return len(self.days)
+
+    def is_active(self, day_number):
+        position = bisect_right(self.days, day_number) - 1
+        return position >= 0 and self.days[position] == day_number
+
+    def streak_ending(self, day_number):
+        """Consecutive active days ending exactly on day_number (0 if it was a rest day)"""
+        position = bisect_right(self.days, day_number) - 1
+        if position < 0 or self.days[position] != day_number:
+            return 0
+        return day_number - self.run_starts[position] + 1
+
+    def streak_as_of(self, day_number):
+        """
+        Streak as calculate_streak counts it on day_number: the run of days ending
+        that day or the day before (today's activity may not have happened yet).
+        Days after day_number are ignored.
+        """
+        return self.streak_ending(day_number) or self.streak_ending(day_number - 1)
+
+    def current_streak(self, today_number):
+        """calculate_streak's rule: 0 if the latest activity is not today or yesterday"""
+        if not self.days or self.days[-1] not in (today_number, today_number - 1):
+            return 0
+        return self.streak_as_of(today_number)
@@ -0,0 +1,106 @@
+"""
+JSON Stream Module - incremental parsing of JSON array responses
+Strava list endpoints return one JSON array. Instead of reading the whole body
+and calling response.json(), the array is decoded chunk by chunk as it arrives
+and each element is yielded as soon as it is complete, so only the element
+being parsed (plus one network chunk) is held in memory.
+"""
+import codecs
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(chunks):
+    """
+    Yield the elements of a JSON array split across text chunks.
+
+    Args:
+        chunks: Iterable of str pieces that together form one JSON array
+
+    Raises:
+        ValueError: The text is not a single JSON array (json.JSONDecodeError
+            for malformed elements)
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    state = "start"  # start -> first -> (separator -> item)* -> end
+
+    def parse(final):
+        nonlocal position, state
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                return
+            char = buffer[position]
+            if state == "start":
+                if char != "[":
+                    raise ValueError(f"Expected a JSON array, got {char!r}")
+                position += 1
+                state = "first"
+            elif state == "separator":
+                if char == ",":
+                    state = "item"
+                elif char == "]":
+                    state = "end"
+                else:
+                    raise ValueError(f"Expected ',' or ']' at offset {position}, got {char!r}")
+                position += 1
+            elif state == "end":
+                raise ValueError(f"Unexpected data after the JSON array: {char!r}")
+            elif state == "first" and char == "]":
+                position += 1
+                state = "end"
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    return  # element continues in the next chunk
+                if not final and buffer[end - 1] not in '}]"':
+                    # A number (or literal) is only complete once the ',' or ']'
+                    # after it has arrived: "2" may still become "2.5"
+                    following = _WHITESPACE.match(buffer, end).end()
+                    if following == len(buffer) or buffer[following] not in ",]":
+                        return
+                yield value
+                position = end
+                state = "separator"
+
+    for chunk in chunks:
+        # Drop what has been parsed so the buffer stays about one element long
+        buffer = buffer[position:] + chunk
+        position = 0
+        yield from parse(final=False)
+    yield from parse(final=True)
+
+    if state != "end":
+        raise ValueError("Truncated JSON array")
+
+
+def iter_response_json(response, chunk_size=CHUNK_SIZE):
+    """
+    Yield the elements of a JSON array HTTP response as they arrive.
+    Request with stream=True so the body is not read up front. The response is
+    closed when the generator finishes or is closed.
+    """
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+
+    def text_chunks():
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+    try:
+        yield from iter_json_array(text_chunks())
+    finally:
+        response.close()
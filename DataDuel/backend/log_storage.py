@@ -0,0 +1,447 @@
+"""
+Log-Structured Storage Module - append-only alternative to the JSON files
+Every write appends one record to a segment log instead of rewriting the whole
+file, so saving one athlete costs O(record) rather than O(all athletes).
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from data_storage import build_user_summaries, index_activities, load_json_data, merge_activity_list, sort_leaderboard
+
+
+class LogSegment:
+    """One append-only log file plus an in-memory key -> (offset, length) index"""
+
+    # Compact once at least this many stale records exist and they outnumber live ones
+    COMPACT_MIN_STALE = 100
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.RLock()
+        self.index = {}
+        self.stale_records = 0
+        self.generation = 0
+        self._compacting = False
+        self._compact_lock = threading.Lock()
+
+        # 'a+b' keeps every write at the end of the file while still allowing seeks for reads
+        self._file = open(filepath, 'a+b')
+        self._load_index()
+
+    def _load_index(self):
+        """Scan the log once and rebuild the key -> offset index"""
+        self.index = {}
+        self.stale_records = 0
+
+        self._file.seek(0)
+        offset = 0
+        for line in self._file:
+            if not line.endswith(b'\n'):
+                break  # Torn write from a crash - drop the partial record
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            self._apply(record, offset, len(line), self.index)
+            offset += len(line)
+
+        # Cut off anything after the last complete record
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() > offset:
+            print(f"[LOG STORAGE] Truncating partial record at end of {self.filepath}")
+            self._file.truncate(offset)
+
+    def _apply(self, record, offset, length, index):
+        """Replay one record onto an index, counting records it makes stale"""
+        key = record['k']
+        if key in index:
+            self.stale_records += 1
+        if record.get('deleted'):
+            index.pop(key, None)
+            self.stale_records += 1
+        else:
+            index[key] = (offset, length)
+
+    @staticmethod
+    def _encode(record):
+        return (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+    def _append(self, record):
+        """Append a record and return its (offset, length)"""
+        data = self._encode(record)
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        self._file.write(data)
+        self._file.flush()
+        return offset, len(data)
+
+    def _read_record(self, entry):
+        self._file.seek(entry[0])
+        return json.loads(self._file.read(entry[1]))
+
+    def get(self, key, default=None):
+        """Return the latest value for a key"""
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return default
+            return self._read_record(entry)['v']
+
+    def put(self, key, value):
+        """Append a new value for a key"""
+        with self.lock:
+            offset, length = self._append({'k': key, 'v': value})
+            self._apply({'k': key}, offset, length, self.index)
+        self._maybe_compact()
+
+    def put_many(self, values):
+        """Append a batch of {key: value} records with a single write"""
+        if not values:
+            return
+        with self.lock:
+            encoded = [(key, self._encode({'k': key, 'v': value})) for key, value in values.items()]
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(b''.join(data for _, data in encoded))
+            self._file.flush()
+            for key, data in encoded:
+                self._apply({'k': key}, offset, len(data), self.index)
+                offset += len(data)
+        self._maybe_compact()
+
+    def delete(self, key):
+        """Append a tombstone for a key"""
+        with self.lock:
+            if key not in self.index:
+                return
+            offset, length = self._append({'k': key, 'deleted': True})
+            self._apply({'k': key, 'deleted': True}, offset, length, self.index)
+        self._maybe_compact()
+
+    def items(self):
+        """Return a {key: value} dict of every live record"""
+        with self.lock:
+            # Read in file order so the scan is sequential
+            entries = sorted(self.index.items(), key=lambda item: item[1][0])
+            return {key: self._read_record(entry)['v'] for key, entry in entries}
+
+    def clear(self):
+        """Drop every record"""
+        with self.lock:
+            self._file.truncate(0)
+            self.index = {}
+            self.stale_records = 0
+            self.generation += 1
+
+    def close(self):
+        with self.lock:
+            self._file.close()
+
+    # Compaction
+    def _maybe_compact(self):
+        with self.lock:
+            if self._compacting:
+                return
+            if self.stale_records < self.COMPACT_MIN_STALE or self.stale_records <= len(self.index):
+                return
+            self._compacting = True
+        threading.Thread(target=self._compact_in_background, daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"[LOG STORAGE] Compaction of {self.filepath} failed: {str(e)}")
+        finally:
+            with self.lock:
+                self._compacting = False
+
+    def compact(self):
+        """
+        Rewrite the log keeping only the latest record per key.
+
+        Live records are copied without holding the lock, so reads and writes
+        continue meanwhile; records appended during the copy are replayed onto
+        the new segment before it replaces the old one.
+        """
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        with self.lock:
+            snapshot = sorted(self.index.items(), key=lambda item: item[1][0])
+            self._file.seek(0, os.SEEK_END)
+            snapshot_end = self._file.tell()
+            generation = self.generation
+            stale_before = self.stale_records
+
+        tmp_path = self.filepath + '.compact'
+        new_index = {}
+        with open(self.filepath, 'rb') as src, open(tmp_path, 'wb') as dst:
+            for key, (offset, length) in snapshot:
+                src.seek(offset)
+                new_index[key] = (dst.tell(), length)
+                dst.write(src.read(length))
+
+            with self.lock:
+                if generation != self.generation:
+                    # Log was cleared while copying - the snapshot is meaningless now
+                    dst.close()
+                    os.remove(tmp_path)
+                    return
+
+                # Replay records appended after the snapshot (tombstones included)
+                self.stale_records = 0
+                src.seek(snapshot_end)
+                for line in src:
+                    offset = dst.tell()
+                    dst.write(line)
+                    self._apply(json.loads(line), offset, len(line), new_index)
+
+                dst.flush()
+                os.fsync(dst.fileno())
+                dst.close()
+                src.close()
+
+                self._file.close()
+                os.replace(tmp_path, self.filepath)
+                self._file = open(self.filepath, 'a+b')
+                self.index = new_index
+
+        print(f"[LOG STORAGE] Compacted {self.filepath}: dropped {stale_before} stale records, "
+              f"{len(new_index)} live")
+
+
+class LogStorage:
+    """Manages users, activities, and scores as append-only logs (same API as DataStorage)"""
+
+    def __init__(self, data_dir="data"):
+        self.data_dir = data_dir
+
+        # Create data directory if it doesn't exist
+        os.makedirs(data_dir, exist_ok=True)
+
+        self.users = LogSegment(os.path.join(data_dir, "users.log"))
+        self.activities = LogSegment(os.path.join(data_dir, "activities.log"))
+        self.scores = LogSegment(os.path.join(data_dir, "scores.log"))
+        self.sync_state = LogSegment(os.path.join(data_dir, "sync_state.log"))
+        self._seed_from_json()
+
+        # Per-thread unit of work: segment -> {key: value} buffered by transaction(),
+        # plus the segment locks merges took, held until those writes are appended
+        self._local = threading.local()
+
+        print(f"[LOG STORAGE] Initialized in {data_dir}: {len(self.users.index)} users, "
+              f"{len(self.scores.index)} scores")
+
+    def _seed_from_json(self):
+        """Fill brand-new logs from the data DataStorage left in data_dir"""
+        segments = {"users": self.users, "activities": self.activities, "scores": self.scores,
+                    "sync_state": self.sync_state}
+        fresh = {
+            name: segment for name, segment in segments.items()
+            if not segment.index and segment.stale_records == 0
+        }
+        if not fresh:
+            return
+
+        existing = load_json_data(self.data_dir)
+        for name, segment in fresh.items():
+            for key, value in existing[name].items():
+                segment.put(str(key), value)
+            if existing[name]:
+                print(f"[LOG STORAGE] Seeded {name}.log with {len(existing[name])} records")
+
+    # Transactions
+    def _pending(self):
+        return getattr(self._local, "pending", None)
+
+    def _get(self, segment, key, default=None):
+        pending = self._pending()
+        if pending is not None and key in pending.get(segment, {}):
+            return pending[segment][key]
+        return segment.get(key, default)
+
+    def _put(self, segment, key, value):
+        pending = self._pending()
+        if pending is not None:
+            pending.setdefault(segment, {})[key] = value
+        else:
+            segment.put(key, value)
+
+    def _get_many(self, segment, keys):
+        found = {}
+        for key in keys:
+            value = self._get(segment, str(key))
+            if value is not None:
+                found[str(key)] = value
+        return found
+
+    def _items(self, segment):
+        items = segment.items()
+        pending = self._pending()
+        if pending is not None:
+            items.update(pending.get(segment, {}))
+        return items
+
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work: buffer every write made in this thread and flush them on exit.
+        Each segment gets one appended batch; nothing is written if the block raises.
+        """
+        if self._pending() is not None:
+            yield self
+            return
+
+        self._local.pending = {}
+        self._local.held = []
+        try:
+            yield self
+            pending = self._local.pending
+            self._local.pending = None
+            for segment, values in pending.items():
+                segment.put_many(values)
+        finally:
+            self._local.pending = None
+            held, self._local.held = self._local.held, []
+            for lock in reversed(held):
+                lock.release()
+
+    # User operations
+    def get_user(self, user_id):
+        """Get user data by ID"""
+        return self._get(self.users, str(user_id))
+
+    def save_user(self, user_id, user_data):
+        """Save or update user data"""
+        user_data['updated_at'] = datetime.now().isoformat()
+        self._put(self.users, str(user_id), user_data)
+
+    def save_users(self, users):
+        """Save or update many users with one appended batch"""
+        now = datetime.now().isoformat()
+        for user_data in users.values():
+            user_data['updated_at'] = now
+        values = {str(user_id): user_data for user_id, user_data in users.items()}
+        pending = self._pending()
+        if pending is not None:
+            pending.setdefault(self.users, {}).update(values)
+        else:
+            self.users.put_many(values)
+    
+    def get_all_users(self):
+        """Get all users"""
+        return self._items(self.users)
+
+    def get_users(self, user_ids):
+        """Get {user_id: user_data} for many users, one index lookup each (missing users are skipped)"""
+        return self._get_many(self.users, user_ids)
+
+    def get_user_summaries(self, user_ids):
+        """Get user data merged with score/improvement for many users (see build_user_summaries)"""
+        return build_user_summaries(user_ids, self.get_users(user_ids), self.get_scores(user_ids))
+
+    # Activity operations
+    def get_activities(self, user_id):
+        """Get activities for a specific user"""
+        return self._get(self.activities, str(user_id), [])
+
+    def save_activities(self, user_id, activities_data):
+        """Save activities for a user"""
+        self._put(self.activities, str(user_id), activities_data)
+
+    def add_activity(self, user_id, activity_data):
+        """Add a single activity to user's activities (replaces one with the same id)"""
+        self.merge_activities(user_id, [activity_data])
+    
+    def get_activities_by_id(self, user_id, activity_ids):
+        """Get {activity_id: activity} for the given ids of one user (unknown ids are skipped)"""
+        activities = self.get_activities(user_id)
+        positions = index_activities(activities)
+        return {
+            str(activity_id): activities[positions[str(activity_id)]]
+            for activity_id in activity_ids if str(activity_id) in positions
+        }
+    
+    def merge_activities(self, user_id, batch):
+        """
+        Upsert activities by Strava id (see merge_activity_list); appends nothing if unchanged.
+        Inside a transaction the activities lock stays held until the merged list is
+        appended, so no other thread merges from the state this merge replaces.
+        """
+        self.activities.lock.acquire()
+        try:
+            existing = self.get_activities(user_id)
+            merged, _, counts = merge_activity_list(existing, batch)
+            if merged is not existing:
+                self._put(self.activities, str(user_id), merged)
+        finally:
+            if self._pending() is not None:
+                self._local.held.append(self.activities.lock)
+            else:
+                self.activities.lock.release()
+        return counts
+
+    # Score operations
+    def get_score(self, user_id):
+        """Get score data for a specific user"""
+        return self._get(self.scores, str(user_id))
+
+    def save_score(self, user_id, score_data):
+        """Save score data for a user"""
+        score_data['updated_at'] = datetime.now().isoformat()
+        self._put(self.scores, str(user_id), score_data)
+
+    def get_all_scores(self):
+        """Get all scores for leaderboard"""
+        return self._items(self.scores)
+
+    def get_scores(self, user_ids):
+        """Get {user_id: score_data} for many users, one index lookup each (missing scores are skipped)"""
+        return self._get_many(self.scores, user_ids)
+
+    def get_leaderboard(self, limit=None):
+        """Get (user_id, score_data, user_data) rows sorted by score, highest first"""
+        return sort_leaderboard(self.get_all_scores(), self.get_all_users(), limit)
+    
+    def get_rank(self, user_id):
+        """Get a user's 1-based leaderboard rank, or None if they have no score"""
+        ranked = sort_leaderboard(self.get_all_scores(), {})
+        for rank, (ranked_user_id, _, _) in enumerate(ranked, start=1):
+            if ranked_user_id == str(user_id):
+                return rank
+        return None
+
+    # Sync state operations
+    def get_sync_watermark(self, user_id):
+        """Start time (epoch seconds) of the newest activity synced for a user, or None"""
+        state = self._get(self.sync_state, str(user_id))
+        return state.get('watermark') if state else None
+
+    def save_sync_watermark(self, user_id, watermark):
+        """Record the newest synced start time; the next sync asks Strava for activities after it"""
+        self._put(self.sync_state, str(user_id), {'watermark': watermark, 'updated_at': datetime.now().isoformat()})
+
+    def clear_all_data(self):
+        """Clear all data (for testing/reset)"""
+        self.users.clear()
+        self.activities.clear()
+        self.scores.clear()
+        self.sync_state.clear()
+
+    def compact(self):
+        """Compact every segment now (maintenance / tests)"""
+        self.users.compact()
+        self.activities.compact()
+        self.scores.compact()
+        self.sync_state.compact()
+
+    def close(self):
+        self.users.close()
+        self.activities.close()
+        self.scores.close()
+        self.sync_state.close()
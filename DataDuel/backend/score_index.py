@@ -0,0 +1,71 @@
+"""
+Score Index Module - scores kept in leaderboard order as they are saved
+Top-k reads are a slice and one user's rank is a binary search, instead of
+sorting every score on each leaderboard request.
+"""
+from bisect import bisect_left, insort
+
+
+class ScoreIndex:
+    """
+    Sorted (score desc, first-seen order) list of user IDs.
+
+    Ties keep the order users first appeared in, which matches sort_leaderboard
+    over scores.json (a stable sort of a dict keeps insertion order).
+    """
+
+    def __init__(self):
+        self._keys = []      # sorted (-score, seq, user_id)
+        self._entries = {}   # user_id -> its key in _keys
+        self._next_seq = 0
+
+    @classmethod
+    def from_scores(cls, all_scores):
+        """Build the index from a {user_id: score_data} collection in one sort"""
+        index = cls()
+        for user_id, score_data in all_scores.items():
+            key = (-(score_data.get('score', 0) or 0), index._next_seq, str(user_id))
+            index._entries[str(user_id)] = key
+            index._next_seq += 1
+        index._keys = sorted(index._entries.values())
+        return index
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, user_id):
+        return str(user_id) in self._entries
+
+    def update(self, user_id, score):
+        """Insert a user or move them to their new score"""
+        user_id = str(user_id)
+        old_key = self._entries.get(user_id)
+        if old_key is None:
+            seq = self._next_seq
+            self._next_seq += 1
+        else:
+            if old_key[0] == -(score or 0):
+                return
+            seq = old_key[1]
+            del self._keys[bisect_left(self._keys, old_key)]
+
+        key = (-(score or 0), seq, user_id)
+        self._entries[user_id] = key
+        insort(self._keys, key)
+
+    def remove(self, user_id):
+        key = self._entries.pop(str(user_id), None)
+        if key is not None:
+            del self._keys[bisect_left(self._keys, key)]
+
+    def top(self, limit=None):
+        """User IDs in leaderboard order, highest score first"""
+        keys = self._keys if limit is None else self._keys[:limit]
+        return [key[2] for key in keys]
+
+    def rank(self, user_id):
+        """1-based leaderboard position of a user, or None if they have no score"""
+        key = self._entries.get(str(user_id))
+        if key is None:
+            return None
+        return bisect_left(self._keys, key) + 1
@@ -0,0 +1,435 @@
+"""
+SQLite Storage Module - drop-in DataStorage backend on the stdlib sqlite3 module
+Users, activities, and scores live in real tables (WAL mode) with indexes on
+user_id, score, and activity date, so leaderboard sorting happens in SQL.
+
+Migrate the existing JSON files with:
+    python sqlite_storage.py [data_dir]
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from data_storage import activity_sort_key, build_user_summaries, load_json_data, merge_activity_list
+from day_index import annotate_activity
+
+# Stay well under SQLite's bound-parameter limit for IN (...) lists
+MAX_IN_PARAMS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id    TEXT PRIMARY KEY,
+    username   TEXT,
+    data       TEXT NOT NULL,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS scores (
+    user_id    TEXT PRIMARY KEY,
+    score      REAL NOT NULL DEFAULT 0,
+    data       TEXT NOT NULL,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_scores_score ON scores (score DESC);
+
+CREATE TABLE IF NOT EXISTS activities (
+    user_id     TEXT NOT NULL,
+    position    INTEGER NOT NULL,
+    activity_id TEXT,
+    start_date  TEXT,
+    data        TEXT NOT NULL,
+    PRIMARY KEY (user_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_activities_user_date ON activities (user_id, start_date);
+CREATE INDEX IF NOT EXISTS idx_activities_date ON activities (start_date);
+DROP INDEX IF EXISTS idx_activities_user_activity;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_activities_user_activity_id ON activities (user_id, activity_id);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    user_id    TEXT PRIMARY KEY,
+    watermark  INTEGER NOT NULL,
+    updated_at TEXT
+);
+"""
+
+
+class SQLiteStorage:
+    """Manages users, activities, and scores in a SQLite database (same API as DataStorage)"""
+
+    def __init__(self, data_dir="data", db_name="dataduel.db"):
+        self.data_dir = data_dir
+        self.db_file = os.path.join(data_dir, db_name)
+        self._local = threading.local()
+
+        # Create data directory if it doesn't exist
+        os.makedirs(data_dir, exist_ok=True)
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+        print(f"[SQLITE STORAGE] Initialized with database: {self.db_file}")
+
+    def _conn(self):
+        """Return this thread's connection (sqlite3 connections are not shared across threads)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _writing(self):
+        """Yield the connection, committing on exit unless a transaction() is open"""
+        conn = self._conn()
+        if getattr(self._local, "in_transaction", False):
+            yield conn
+        else:
+            with conn:
+                yield conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work: every write in the block commits together, or rolls back if it raises.
+        Nested transactions join the outer one.
+        """
+        if getattr(self._local, "in_transaction", False):
+            yield self
+            return
+
+        conn = self._conn()
+        self._local.in_transaction = True
+        try:
+            with conn:
+                yield self
+        finally:
+            self._local.in_transaction = False
+
+    # User operations
+    def get_user(self, user_id):
+        """Get user data by ID"""
+        row = self._conn().execute(
+            "SELECT data FROM users WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_user(self, user_id, user_data):
+        """Save or update user data"""
+        user_data['updated_at'] = datetime.now().isoformat()
+        with self._writing() as conn:
+            self._upsert_user(conn, str(user_id), user_data)
+
+    def _upsert_user(self, conn, user_id, user_data):
+        conn.execute(
+            "INSERT INTO users (user_id, username, data, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, "
+            "data = excluded.data, updated_at = excluded.updated_at",
+            (user_id, user_data.get('username'), json.dumps(user_data), user_data.get('updated_at'))
+        )
+
+    def save_users(self, users):
+        """Save or update many users in one commit"""
+        now = datetime.now().isoformat()
+        with self._writing() as conn:
+            for user_id, user_data in users.items():
+                user_data['updated_at'] = now
+                self._upsert_user(conn, str(user_id), user_data)
+    
+    def get_all_users(self):
+        """Get all users"""
+        rows = self._conn().execute("SELECT user_id, data FROM users ORDER BY rowid").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def get_users(self, user_ids):
+        """Get {user_id: user_data} for many users with primary-key lookups (missing users are skipped)"""
+        return self._select_many("users", user_ids)
+
+    def get_user_summaries(self, user_ids):
+        """Get user data merged with score/improvement for many users (see build_user_summaries)"""
+        return build_user_summaries(user_ids, self.get_users(user_ids), self.get_scores(user_ids))
+
+    def _select_many(self, table, user_ids):
+        """Fetch {user_id: data} rows of a table for the given IDs, in chunks"""
+        ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+        found = {}
+        for start in range(0, len(ids), MAX_IN_PARAMS):
+            chunk = ids[start:start + MAX_IN_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self._conn().execute(
+                f"SELECT user_id, data FROM {table} WHERE user_id IN ({placeholders})", chunk
+            ).fetchall()
+            found.update((user_id, json.loads(data)) for user_id, data in rows)
+        return found
+
+    # Activity operations
+    def get_activities(self, user_id):
+        """Get activities for a specific user"""
+        rows = self._conn().execute(
+            "SELECT data FROM activities WHERE user_id = ? ORDER BY position", (str(user_id),)
+        ).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def save_activities(self, user_id, activities_data):
+        """Save activities for a user"""
+        with self._writing() as conn:
+            self._replace_activities(conn, str(user_id), activities_data)
+
+    def _replace_activities(self, conn, user_id, activities_data):
+        conn.execute("DELETE FROM activities WHERE user_id = ?", (user_id,))
+        conn.executemany(
+            "INSERT INTO activities (user_id, position, activity_id, start_date, data) VALUES (?, ?, ?, ?, ?)",
+            [self._activity_row(user_id, position, activity) for position, activity in enumerate(activities_data)]
+        )
+
+    @staticmethod
+    def _activity_row(user_id, position, activity):
+        activity_id = activity.get('id')
+        return (
+            user_id,
+            position,
+            str(activity_id) if activity_id is not None else None,
+            activity.get('start_date_local') or activity.get('start_date'),
+            json.dumps(activity)
+        )
+
+    def add_activity(self, user_id, activity_data):
+        """Add a single activity to user's activities (replaces one with the same id)"""
+        self.merge_activities(user_id, [activity_data])
+    
+    def get_activities_by_id(self, user_id, activity_ids):
+        """Get {activity_id: activity} for the given ids of one user (unknown ids are skipped)"""
+        ids = list(dict.fromkeys(str(activity_id) for activity_id in activity_ids))
+        found = {}
+        for start in range(0, len(ids), MAX_IN_PARAMS):
+            chunk = ids[start:start + MAX_IN_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self._conn().execute(
+                f"SELECT activity_id, data FROM activities WHERE user_id = ? AND activity_id IN ({placeholders})",
+                [str(user_id)] + chunk
+            ).fetchall()
+            found.update((activity_id, json.loads(data)) for activity_id, data in rows)
+        return found
+    
+    def merge_activities(self, user_id, batch):
+        """
+        Upsert activities by Strava id (same result and counts as merge_activity_list).
+        Only the batch's new and changed rows are written, with ON CONFLICT on the
+        (user_id, activity_id) index: new activities newer than the stored ones get
+        positions after the last, older ones (backfill pages) positions before the
+        first. So a sync page, webhook or backfill page costs O(batch), not O(history);
+        only an activity landing mid-history or an edited start date rewrites the list.
+        """
+        user_id = str(user_id)
+        batch = [annotate_activity(activity) for activity in batch]
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        with self._writing() as conn:
+            # Take the write lock before reading, so concurrent merges cannot pick the same positions
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            current = self.get_activities_by_id(
+                user_id, [activity['id'] for activity in batch if activity.get('id') is not None]
+            )
+            stored = dict(current)
+            inserts = {}
+            without_id = []
+            updates = {}
+            for activity in batch:
+                activity_id = activity.get('id')
+                if activity_id is None:
+                    without_id.append(activity)
+                    counts["inserted"] += 1
+                    continue
+                key = str(activity_id)
+                if key not in current:
+                    if key not in inserts:
+                        counts["inserted"] += 1
+                    inserts[key] = activity
+                elif current[key] == activity:
+                    counts["unchanged"] += 1
+                else:
+                    current[key] = updates[key] = activity
+                    counts["updated"] += 1
+            
+            additions = sorted(list(inserts.values()) + without_id, key=activity_sort_key)
+            positions = self._edge_positions(conn, user_id, additions)
+            moved = any(activity_sort_key(activity) != activity_sort_key(stored[key]) for key, activity in updates.items())
+            if positions is None or moved:
+                self._replace_activities(conn, user_id, merge_activity_list(self.get_activities(user_id), batch)[0])
+                return counts
+            
+            # ON CONFLICT also covers a concurrent writer inserting the same id first
+            conn.executemany(
+                "INSERT INTO activities (user_id, position, activity_id, start_date, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id, activity_id) DO UPDATE SET data = excluded.data",
+                [self._activity_row(user_id, position, activity) for position, activity in zip(positions, additions)]
+            )
+            conn.executemany(
+                "UPDATE activities SET data = ? WHERE user_id = ? AND activity_id = ?",
+                [(json.dumps(activity), user_id, key) for key, activity in updates.items()]
+            )
+        return counts
+
+    def _edge_positions(self, conn, user_id, additions):
+        """Positions that keep start-date order for new activities, or None if they belong mid-history"""
+        if not additions:
+            return []
+        first, last = conn.execute(
+            "SELECT MIN(position), MAX(position) FROM activities WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if first is None:
+            return list(range(len(additions)))
+        keys = dict(conn.execute(
+            "SELECT position, start_date FROM activities WHERE user_id = ? AND position IN (?, ?)",
+            (user_id, first, last)
+        ).fetchall())
+        # Ties go after the stored activities, as merge_activity_list's stable sort puts them
+        if activity_sort_key(additions[0]) >= (keys[last] or ''):
+            return list(range(last + 1, last + 1 + len(additions)))
+        if activity_sort_key(additions[-1]) < (keys[first] or ''):
+            return list(range(first - len(additions), first))
+        return None
+
+    # Score operations
+    def get_score(self, user_id):
+        """Get score data for a specific user"""
+        row = self._conn().execute(
+            "SELECT data FROM scores WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_score(self, user_id, score_data):
+        """Save score data for a user"""
+        score_data['updated_at'] = datetime.now().isoformat()
+        with self._writing() as conn:
+            self._upsert_score(conn, str(user_id), score_data)
+
+    def _upsert_score(self, conn, user_id, score_data):
+        conn.execute(
+            "INSERT INTO scores (user_id, score, data, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET score = excluded.score, "
+            "data = excluded.data, updated_at = excluded.updated_at",
+            (user_id, score_data.get('score', 0) or 0, json.dumps(score_data), score_data.get('updated_at'))
+        )
+
+    def get_all_scores(self):
+        """Get all scores for leaderboard"""
+        rows = self._conn().execute("SELECT user_id, data FROM scores ORDER BY rowid").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def get_scores(self, user_ids):
+        """Get {user_id: score_data} for many users with primary-key lookups (missing scores are skipped)"""
+        return self._select_many("scores", user_ids)
+
+    def get_leaderboard(self, limit=None):
+        """
+        Get (user_id, score_data, user_data) rows sorted by score, highest first.
+        Sorting and the users join run in SQL using the score index.
+        """
+        rows = self._conn().execute(
+            "SELECT s.user_id, s.data, u.data FROM scores s "
+            "LEFT JOIN users u ON u.user_id = s.user_id "
+            "ORDER BY s.score DESC, s.rowid LIMIT ?",
+            (-1 if limit is None else limit,)
+        ).fetchall()
+        return [
+            (user_id, json.loads(score_json), json.loads(user_json) if user_json else {})
+            for user_id, score_json, user_json in rows
+        ]
+
+    def get_rank(self, user_id):
+        """Get a user's 1-based leaderboard rank (counted on the score index), or None if they have no score"""
+        conn = self._conn()
+        row = conn.execute("SELECT score, rowid FROM scores WHERE user_id = ?", (str(user_id),)).fetchone()
+        if row is None:
+            return None
+        score, rowid = row
+        (ahead,) = conn.execute(
+            "SELECT COUNT(*) FROM scores WHERE score > ? OR (score = ? AND rowid < ?)", (score, score, rowid)
+        ).fetchone()
+        return ahead + 1
+
+    # Sync state operations
+    def get_sync_watermark(self, user_id):
+        """Start time (epoch seconds) of the newest activity synced for a user, or None"""
+        row = self._conn().execute(
+            "SELECT watermark FROM sync_state WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_sync_watermark(self, user_id, watermark):
+        """Record the newest synced start time; the next sync asks Strava for activities after it"""
+        with self._writing() as conn:
+            conn.execute(
+                "INSERT INTO sync_state (user_id, watermark, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET watermark = excluded.watermark, "
+                "updated_at = excluded.updated_at",
+                (str(user_id), watermark, datetime.now().isoformat())
+            )
+    
+    def clear_all_data(self):
+        """Clear all data (for testing/reset)"""
+        with self._writing() as conn:
+            conn.execute("DELETE FROM users")
+            conn.execute("DELETE FROM activities")
+            conn.execute("DELETE FROM scores")
+            conn.execute("DELETE FROM sync_state")
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # Migration
+    def migrate_from_json(self, json_dir=None):
+        """
+        Import everything DataStorage saved in json_dir (users.json, scores.json,
+        sync_state.json, and the activity shards or activities.json). Existing rows with the same user_id are overwritten, so re-running is safe.
+
+        Returns:
+            Dictionary with the number of users, athletes with activities, scores and
+            sync watermarks imported
+        """
+        json_dir = json_dir or self.data_dir
+        existing = load_json_data(json_dir)
+        users = existing["users"]
+        activities = existing["activities"]
+        scores = existing["scores"]
+        # Imported watermarks keep the first sync after the switch incremental
+        watermarks = {
+            str(user_id): state for user_id, state in existing["sync_state"].items()
+            if state.get('watermark') is not None
+        }
+
+        # Keep the original updated_at stamps instead of going through save_*
+        with self._writing() as conn:
+            for user_id, user_data in users.items():
+                self._upsert_user(conn, str(user_id), user_data)
+            for user_id, activities_data in activities.items():
+                self._replace_activities(conn, str(user_id), activities_data)
+            for user_id, score_data in scores.items():
+                self._upsert_score(conn, str(user_id), score_data)
+            conn.executemany(
+                "INSERT INTO sync_state (user_id, watermark, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET watermark = excluded.watermark, "
+                "updated_at = excluded.updated_at",
+                [(user_id, state['watermark'], state.get('updated_at')) for user_id, state in watermarks.items()]
+            )
+
+        counts = {"users": len(users), "activities": len(activities), "scores": len(scores),
+                  "sync_state": len(watermarks)}
+        print(f"[SQLITE STORAGE] Imported from {json_dir}: {counts}")
+        return counts
+
+
+if __name__ == "__main__":
+    # Usage: python sqlite_storage.py [data_dir]
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else "data"
+    SQLiteStorage(data_dir).migrate_from_json(data_dir)
@@ -0,0 +1,250 @@
+"""
+Strava Client Module - one pooled, rate-limit-aware HTTP client for Strava
+Every Strava call goes through a StravaClient: a shared requests.Session keeps
+connections (and TLS sessions) alive between calls, every request has a
+timeout, 429/5xx responses and connection errors are retried with exponential
+backoff, and the X-RateLimit-* headers of each response feed a process-wide
+RateLimitBudget.
+
+Usage:
+    from strava_client import strava_client
+    response = strava_client.get_activities(access_token, per_page=30)
+"""
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = "https://www.strava.com/api/v3"
+OAUTH_TOKEN_URL = "https://www.strava.com/oauth/token"
+
+SHORT_WINDOW = 15 * 60  # Strava's short limit resets every quarter hour
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class StravaRateLimitError(requests.exceptions.RequestException):
+    """The rate limit budget is used up; retry_after is seconds until it resets"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Strava rate limit reached, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def _parse_pair(value):
+    """'100,1000' -> (100, 1000); None if the header is missing or malformed"""
+    try:
+        short, daily = (int(part) for part in value.split(","))
+        return short, daily
+    except (AttributeError, ValueError):
+        return None
+
+
+class RateLimitBudget:
+    """
+    Strava's 15-minute and daily request limits as last reported by the API.
+
+    Usage is only known from response headers, so it is updated after every
+    response and treated as reset once the window it was reported in has passed
+    (quarter hours for the short limit, UTC midnight for the daily one).
+    """
+
+    def __init__(self, clock=time.time):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self.limit = None  # (short, daily)
+        self.usage = None
+        self.updated_at = None
+
+    def update(self, headers):
+        """Record X-RateLimit-Limit / X-RateLimit-Usage from a response"""
+        limit = _parse_pair(headers.get("X-RateLimit-Limit"))
+        usage = _parse_pair(headers.get("X-RateLimit-Usage"))
+        if limit is None or usage is None:
+            return
+        with self._lock:
+            self.limit = limit
+            self.usage = usage
+            self.updated_at = self._clock()
+
+    @staticmethod
+    def _short_reset(timestamp):
+        return (timestamp // SHORT_WINDOW + 1) * SHORT_WINDOW
+
+    @staticmethod
+    def _daily_reset(timestamp):
+        day = datetime.fromtimestamp(timestamp, timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        return day.timestamp() + 24 * 60 * 60
+
+    def remaining(self):
+        """(short, daily) requests left, or None before any response was seen"""
+        with self._lock:
+            if self.limit is None:
+                return None
+            now = self._clock()
+            short_used, daily_used = self.usage
+            if now >= self._short_reset(self.updated_at):
+                short_used = 0
+            if now >= self._daily_reset(self.updated_at):
+                daily_used = 0
+            return max(self.limit[0] - short_used, 0), max(self.limit[1] - daily_used, 0)
+
+    def wait_time(self):
+        """Seconds until a request may be sent (0 if there is budget left)"""
+        remaining = self.remaining()
+        if remaining is None:
+            return 0
+        now = self._clock()
+        if remaining[1] == 0:
+            return self._daily_reset(self.updated_at) - now
+        if remaining[0] == 0:
+            return self._short_reset(self.updated_at) - now
+        return 0
+
+    def snapshot(self):
+        """Limits, usage and what is left, for /api/status"""
+        remaining = self.remaining()
+        return {
+            "limit": list(self.limit) if self.limit else None,
+            "usage": list(self.usage) if self.usage else None,
+            "remaining": list(remaining) if remaining else None,
+        }
+
+
+# Shared by every client in the process: the limits are per Strava application
+rate_limit_budget = RateLimitBudget()
+
+
+class StravaClient:
+    """Strava API calls over a pooled session with timeouts, retries and a rate limit budget"""
+
+    def __init__(self, session=None, budget=None, timeout=(5, 30), max_retries=3,
+                 backoff=0.5, max_backoff=30.0, pool_size=None, sleep=time.sleep):
+        """
+        Args:
+            session: requests.Session to use (default: a new pooled session)
+            budget: RateLimitBudget to update (default: the process-wide one)
+            timeout: (connect, read) seconds for every request
+            max_retries: Retries after a 429/5xx response or a connection error
+            backoff: First retry delay in seconds, doubled on every retry
+            max_backoff: Longest delay to wait before a retry; a 429 that asks
+                for longer is returned to the caller instead
+            pool_size: Connections kept alive (default: STRAVA_POOL_SIZE or 10)
+        """
+        if session is None:
+            pool_size = pool_size or int(os.getenv("STRAVA_POOL_SIZE", "10"))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self.budget = budget or rate_limit_budget
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+
+    def _retry_delay(self, attempt, response=None):
+        """Retry-After if the response has one, else exponential backoff with jitter"""
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return float(retry_after)
+            wait = self.budget.wait_time()
+            if wait:
+                return wait
+        return self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+
+    def request(self, method, url, retry=None, **kwargs):
+        """
+        Send a request, retrying 429/5xx responses and connection errors.
+
+        Only idempotent methods are retried unless retry says otherwise: a POST
+        such as the OAuth code exchange may have been applied even though its
+        response was lost, and the same code cannot be traded twice.
+
+        Returns:
+            The final requests.Response (callers check status_code as before)
+
+        Raises:
+            StravaRateLimitError: The budget is used up for longer than max_backoff
+            requests.RequestException: Connection errors after the last retry
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if retry is None:
+            retry = method.upper() in IDEMPOTENT_METHODS
+        max_retries = self.max_retries if retry else 0
+        attempt = 0
+        while True:
+            wait = self.budget.wait_time()
+            if wait > self.max_backoff:
+                raise StravaRateLimitError(wait)
+            if wait:
+                self.sleep(wait)
+
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                print(f"[STRAVA] {method} {url} failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                self.sleep(delay)
+                attempt += 1
+                continue
+
+            self.budget.update(response.headers)
+            if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+                return response
+
+            delay = self._retry_delay(attempt, response)
+            if delay > self.max_backoff:
+                return response
+            print(f"[STRAVA] {method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            response.close()
+            self.sleep(delay)
+            attempt += 1
+
+    def get(self, path, access_token, params=None, stream=False):
+        """GET an API path such as '/athlete/activities'"""
+        headers = {"Authorization": f"Bearer {access_token}"}
+        return self.request("GET", API_URL + path, headers=headers, params=params, stream=stream)
+
+    def get_activities(self, access_token, stream=False, **params):
+        """GET /athlete/activities (params: per_page, page, before, after)"""
+        return self.get("/athlete/activities", access_token, params=params, stream=stream)
+
+    def exchange_code(self, client_id, client_secret, code):
+        """Trade an OAuth authorization code for tokens"""
+        return self.request("POST", OAUTH_TOKEN_URL, retry=False, data={
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "code": code,
+            "grant_type": "authorization_code",
+        })
+
+    def refresh_token(self, client_id, client_secret, refresh_token):
+        """Trade a refresh token for a new access token"""
+        return self.request("POST", OAUTH_TOKEN_URL, retry=False, data={
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+        })
+
+    def close(self):
+        self.session.close()
+
+
+# Process-wide client; import this rather than creating a client per request
+strava_client = StravaClient()
+
+if os.getenv("STRAVA_SIMULATOR", "false").lower() == "true":
+    # Offline runs: answer every Strava call from the local simulator
+    from strava_simulator import install
+    install(strava_client)
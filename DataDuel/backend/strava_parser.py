@@ -4,12 +4,13 @@ Handles parsing Strava API data and updating Person objects with real activity d
 """
 import sys
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 # Add parent directory to path to import Person, Score, etc.
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from Person import Person
+from day_index import EPOCH_ORDINAL, DayIndex, activity_epoch_day, annotate_activity, epoch_day
 
 
 class StravaParser:
@@ -141,6 +142,51 @@ class StravaParser:
             'max_speed': person.max_speed
         }
     
+    @staticmethod
+    def apply_activity_changes(person, previous_by_id, activities):
+        """
+        Update a Person's running-sum baselines with a batch of activities
+        
+        Only the difference to what was stored before is applied, so the cost
+        depends on the batch, not on the athlete's history. Non-runs are ignored;
+        an activity that stopped (or started) being a run is removed (or added).
+        
+        Args:
+            person: Person whose activity_stats cover the stored activities
+            previous_by_id: {activity_id: stored activity} for the batch's ids
+            activities: Activities being merged into storage
+            
+        Returns:
+            Number of activities that changed the baselines
+        """
+        run_types = ActivityAggregator.RUN_TYPES
+        previous_by_id = dict(previous_by_id)
+        changed = 0
+        
+        for activity in activities:
+            # Stored activities carry their epoch day, so compare like with like
+            activity = annotate_activity(activity)
+            activity_id = activity.get('id')
+            old = previous_by_id.get(str(activity_id)) if activity_id is not None else None
+            if old == activity:
+                continue
+            
+            old_is_run = old is not None and old.get('type') in run_types
+            new_is_run = activity.get('type') in run_types
+            if old_is_run and new_is_run:
+                person.replace_activity(old, activity)
+            elif old_is_run:
+                person.remove_activity(old)
+            elif new_is_run:
+                person.add_activity(activity)
+            changed += old_is_run or new_is_run
+            
+            # A repeated id later in the batch replaces this one, as in merge_activities
+            if activity_id is not None:
+                previous_by_id[str(activity_id)] = activity
+        
+        return changed
+    
     @staticmethod
     def parse_activities_new(activities_dict, person):
         """
@@ -238,42 +284,10 @@ class StravaParser:
         if not activities_data:
             return 0
         
-        # Extract unique activity dates
-        activity_dates = set()
-        for activity in activities_data:
-            start_date_str = activity.get('start_date_local') or activity.get('start_date')
-            if start_date_str:
-                # Parse ISO format date
-                date_obj = datetime.fromisoformat(start_date_str.replace('Z', '+00:00'))
-                activity_dates.add(date_obj.date())
-        
-        if not activity_dates:
-            return 0
-        
-        # Sort dates in descending order (most recent first)
-        sorted_dates = sorted(activity_dates, reverse=True)
-        
-        # Check if there's an activity today or yesterday
-        today = datetime.now().date()
-        yesterday = today - timedelta(days=1)
-        
-        if sorted_dates[0] not in [today, yesterday]:
-            # Streak is broken if most recent activity is more than 1 day ago
-            return 0
-        
-        # Count consecutive days
-        streak = 1
-        expected_date = sorted_dates[0] - timedelta(days=1)
-        
-        for i in range(1, len(sorted_dates)):
-            if sorted_dates[i] == expected_date:
-                streak += 1
-                expected_date -= timedelta(days=1)
-            elif sorted_dates[i] < expected_date:
-                # Gap found, streak ends
-                break
-        
-        return streak
+        # Local epoch days (pre-computed on stored activities, see day_index.py);
+        # the streak is broken if the most recent activity is more than 1 day ago
+        day_index = DayIndex.from_activities(activities_data)
+        return day_index.current_streak(epoch_day(datetime.now().date()))
     
     @staticmethod
     def check_badges(person):
@@ -324,24 +338,20 @@ class StravaParser:
         person.weekly_challenges.second_challenge = False
         person.weekly_challenges.third_challenge = False
         
-        # Calculate week start (Monday)
-        today = datetime.now()
-        week_start = today - timedelta(days=today.weekday())
-        week_start = week_start.replace(hour=0, minute=0, second=0, microsecond=0)
+        # Calculate week start (Monday) as a local epoch day
+        today = datetime.now().date()
+        week_start = epoch_day(today - timedelta(days=today.weekday()))
         
         # Filter activities from this week
         this_week_activities = []
         this_week_distance = 0
         
         for activity in activities_data:
-            start_date_str = activity.get('start_date_local') or activity.get('start_date')
-            if start_date_str:
-                date_obj = datetime.fromisoformat(start_date_str.replace('Z', '+00:00'))
-                
-                if date_obj >= week_start:
-                    if activity.get('type') in ['Run', 'VirtualRun', 'TrailRun']:
-                        this_week_activities.append(activity)
-                        this_week_distance += activity.get('distance', 0)
+            day_number = activity_epoch_day(activity)
+            if day_number is not None and day_number >= week_start:
+                if activity.get('type') in ['Run', 'VirtualRun', 'TrailRun']:
+                    this_week_activities.append(activity)
+                    this_week_distance += activity.get('distance', 0)
         
         # Challenge 1: 3+ runs this week
         if len(this_week_activities) >= 3:
@@ -355,3 +365,189 @@ class StravaParser:
         if person.streak >= 5:
             person.weekly_challenges.third_challenge = True
 
+
+class ActivityAggregator:
+    """
+    Single pass over a list of activities that collects everything one sync needs:
+    run totals and baselines, the set of activity days for the streak, and this
+    week's run count/distance for the challenges.
+    
+    Replaces calling parse_activities, calculate_streak and check_challenges one
+    after another (three scans, two of them parsing every date). Each start date
+    is parsed once, as a local calendar date.
+    
+    Usage:
+        aggregator = ActivityAggregator(activities)
+        metrics = aggregator.apply(person)  # None if there are no runs
+    """
+    
+    RUN_TYPES = ('Run', 'VirtualRun', 'TrailRun')
+    
+    def __init__(self, activities=None, assume_runs=False, today=None):
+        """
+        Args:
+            activities: Optional list of activities to add right away
+            assume_runs: Treat activities without a type as runs and fall back to
+                elapsed_time for a missing moving_time (frontend payloads, like
+                parse_activities_new)
+            today: Date the streak and week are computed for (default: today)
+        """
+        self.assume_runs = assume_runs
+        self.today = today or datetime.now().date()
+        self.week_start = self.today - timedelta(days=self.today.weekday())
+        
+        self.total_activities = 0
+        self.total_workouts = 0
+        self.total_distance = 0
+        self.total_moving_time = 0
+        self.total_average_speed = 0
+        self.total_max_speed = 0
+        self.total_elevation = 0
+        self.total_cadence = 0
+        self.total_heartrate = 0
+        self.total_elapsed_time = 0
+        
+        self.activity_days = set()  # local epoch days; every activity type counts toward the streak
+        self.week_runs = 0
+        self.week_distance = 0
+        
+        if activities:
+            self.add_all(activities)
+    
+    def add(self, activity):
+        """Fold one activity into every aggregate"""
+        self.add_all((activity,))
+    
+    def add_all(self, activities):
+        """Fold activities into every aggregate (the hot loop works on locals)"""
+        run_types = self.RUN_TYPES
+        assume_runs = self.assume_runs
+        week_start = epoch_day(self.week_start)
+        activity_days = self.activity_days
+        parsed_days = {}  # many activities share a date prefix
+        
+        workouts = distance_sum = moving_sum = average_speed_sum = max_speed_sum = 0
+        elevation_sum = cadence_sum = heartrate_sum = elapsed_sum = 0
+        week_runs = week_distance = 0
+        count = 0
+        
+        for activity in activities:
+            count += 1
+            get = activity.get
+            
+            # Stored activities carry their epoch day; others parse the ISO date prefix once
+            day = get('local_epoch_day')
+            if day is None:
+                start_date_str = get('start_date_local') or get('start_date')
+                if start_date_str:
+                    prefix = start_date_str[:10]
+                    day = parsed_days.get(prefix)
+                    if day is None:
+                        day = parsed_days[prefix] = date.fromisoformat(prefix).toordinal() - EPOCH_ORDINAL
+            if day is not None:
+                activity_days.add(day)
+            
+            if (get('type', 'Run') if assume_runs else get('type')) not in run_types:
+                continue
+            
+            distance = get('distance', 0)
+            if assume_runs:
+                moving_time = get('moving_time', get('elapsed_time', 0))
+            else:
+                moving_time = get('moving_time', 0)
+            
+            workouts += 1
+            distance_sum += distance
+            moving_sum += moving_time
+            average_speed_sum += get('average_speed', 0)
+            max_speed_sum += get('max_speed', 0)
+            elevation_sum += get('total_elevation_gain', 0)
+            cadence_sum += get('average_cadence', 0) or 0
+            heartrate_sum += get('average_heartrate', 0) or 0
+            elapsed_sum += get('elapsed_time', 0) or moving_time
+            
+            if day is not None and day >= week_start:
+                week_runs += 1
+                week_distance += distance
+        
+        self.total_activities += count
+        self.total_workouts += workouts
+        self.total_distance += distance_sum
+        self.total_moving_time += moving_sum
+        self.total_average_speed += average_speed_sum
+        self.total_max_speed += max_speed_sum
+        self.total_elevation += elevation_sum
+        self.total_cadence += cadence_sum
+        self.total_heartrate += heartrate_sum
+        self.total_elapsed_time += elapsed_sum
+        self.week_runs += week_runs
+        self.week_distance += week_distance
+    
+    def streak(self):
+        """Consecutive activity days ending today or yesterday (same rule as calculate_streak)"""
+        return self.day_index().current_streak(epoch_day(self.today))
+    
+    def day_index(self):
+        """DayIndex over every activity day seen (longest streak, streak as of a date)"""
+        return DayIndex(self.activity_days)
+    
+    def apply_metrics(self, person):
+        """
+        Set the person's totals, baselines and current metrics (as parse_activities does)
+        
+        Returns:
+            Dictionary of aggregated metrics, or None if no running activities
+        """
+        workouts = self.total_workouts
+        if not workouts:
+            return None
+        
+        person.total_workouts = workouts
+        person.total_distance = self.total_distance
+        person.total_moving_time = self.total_moving_time
+        person.total_average_speed = self.total_average_speed
+        person.total_max_speed = self.total_max_speed
+        
+        person.baseline_average_speed = self.total_average_speed / workouts
+        person.baseline_max_speed = self.total_max_speed / workouts
+        person.baseline_distance = self.total_distance / workouts
+        person.baseline_moving_time = self.total_moving_time / workouts
+        person.average_cadence = self.total_cadence / workouts
+        person.average_heartrate = self.total_heartrate / workouts
+        person.elapsed_time = self.total_elapsed_time / workouts
+        person.total_elevation = self.total_elevation / workouts
+        
+        person.average_speed = person.baseline_average_speed
+        person.max_speed = person.baseline_max_speed
+        person.distance = person.baseline_distance
+        person.moving_time = person.baseline_moving_time
+        
+        return {
+            'total_workouts': person.total_workouts,
+            'total_distance': person.total_distance,
+            'total_moving_time': person.total_moving_time,
+            'average_speed': person.average_speed,
+            'max_speed': person.max_speed
+        }
+    
+    def apply_challenges(self, person):
+        """Set weekly challenges (as check_challenges does); uses person.streak"""
+        person.weekly_challenges.first_challenge = self.week_runs >= 3
+        person.weekly_challenges.second_challenge = self.week_distance >= 15000  # 15 km in meters
+        person.weekly_challenges.third_challenge = person.streak >= 5
+    
+    def apply(self, person):
+        """
+        Metrics, streak, badges and challenges in one go
+        
+        Returns:
+            Dictionary of aggregated metrics, or None if no running activities
+            (the person is left untouched in that case, like parse_activities)
+        """
+        metrics = self.apply_metrics(person)
+        if metrics is None:
+            return None
+        person.streak = self.streak()
+        StravaParser.check_badges(person)
+        self.apply_challenges(person)
+        return metrics
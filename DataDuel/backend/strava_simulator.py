@@ -0,0 +1,341 @@
+"""
+Strava Simulator Module - an offline stand-in for the Strava API
+StravaSimulator holds synthetic athletes, their activity histories and OAuth
+tokens, and answers the endpoints DataDuel uses:
+
+    POST /oauth/token                 authorization_code and refresh_token grants
+    GET  /api/v3/athlete              the token's athlete
+    GET  /api/v3/athlete/activities   page, per_page (max 200), after, before
+    GET  /api/v3/activities/<id>
+    GET  /api/v3/activities/<id>/streams   keys, key_by_type
+
+with X-RateLimit-* headers, 429s once the limits are used up, and optional
+injected latency, random 429s and 5xx errors. SimulatorAdapter plugs it into
+a requests.Session as a transport, so StravaClient - and everything built on
+it (/api/sync, get_valid_token, backfill, bulk sync) - runs against it
+unchanged. Set STRAVA_SIMULATOR=true to install it on the shared client at
+startup, or call install(client, simulator).
+"""
+import http.client
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlsplit
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+STRAVA_ORIGIN = "https://www.strava.com/"
+SHORT_WINDOW = 15 * 60
+ACTIVITY_TYPES = ("Run", "Run", "Run", "TrailRun", "Ride", "Walk")
+
+
+def _timestamp(activity):
+    return int(datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ")
+               .replace(tzinfo=timezone.utc).timestamp())
+
+
+class StravaSimulator:
+    """Synthetic Strava backend: athletes, activity histories, tokens and rate limits"""
+
+    def __init__(self, athletes=10, activities_per_athlete=100, days=365, seed=0,
+                 latency=0.0, latency_jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 limit=(100, 1000), token_ttl=6 * 60 * 60, clock=time.time, sleep=time.sleep):
+        """
+        Args:
+            athletes: Number of athletes (ids 1..athletes)
+            activities_per_athlete: History length, spread over the last `days` days
+            latency: Base seconds added to every API call
+            latency_jitter: Mean of an exponential extra delay (gives a long tail)
+            error_rate: Share of API calls answered with a random 5xx
+            throttle_rate: Share of API calls answered with 429 regardless of usage
+            limit: (15-minute, daily) request limits reported and enforced
+            token_ttl: Lifetime of issued access tokens in seconds
+        """
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.limit = limit
+        self.token_ttl = token_ttl
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+
+        self.athletes = {}  # athlete_id -> activities sorted by start date
+        self.access_tokens = {}  # token -> (athlete_id, expires_at)
+        self.refresh_tokens = {}  # token -> athlete_id
+        self._next_activity_id = 1_000_000
+        self._window = self._day = None
+        self.usage = [0, 0]
+        self.calls = {}  # "GET /api/v3/athlete/activities" -> count
+        self.statuses = {}  # HTTP status -> count
+
+        now = datetime.fromtimestamp(self.clock(), timezone.utc).replace(microsecond=0)
+        for athlete_id in range(1, athletes + 1):
+            self.athletes[athlete_id] = []
+            starts = sorted(now - timedelta(seconds=self.rng.randint(3600, days * 86400))
+                            for _ in range(activities_per_athlete))
+            for start in starts:
+                self._create_activity(athlete_id, start)
+
+    # Data
+    def _create_activity(self, athlete_id, start):
+        rng = self.rng
+        activity_type = rng.choice(ACTIVITY_TYPES)
+        distance = round(rng.uniform(2000, 25000), 1)
+        average_speed = round(rng.uniform(2.2, 4.5) * (2.5 if activity_type == "Ride" else 1), 3)
+        moving_time = int(distance / average_speed)
+        activity = {
+            "resource_state": 2,
+            "athlete": {"id": athlete_id, "resource_state": 1},
+            "id": self._next_activity_id,
+            "name": f"{activity_type} {self._next_activity_id}",
+            "type": activity_type,
+            "sport_type": activity_type,
+            "distance": distance,
+            "moving_time": moving_time,
+            "elapsed_time": moving_time + rng.randint(0, 900),
+            "total_elevation_gain": round(rng.uniform(0, 400), 1),
+            "start_date": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "start_date_local": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "timezone": "(GMT+00:00) UTC",
+            "average_speed": average_speed,
+            "max_speed": round(average_speed * rng.uniform(1.2, 1.9), 3),
+            "average_cadence": round(rng.uniform(150, 185), 1),
+            "average_heartrate": round(rng.uniform(120, 175), 1),
+            "max_heartrate": round(rng.uniform(170, 200), 1),
+            "kudos_count": rng.randint(0, 30),
+            "map": {"id": f"a{self._next_activity_id}", "summary_polyline": "", "resource_state": 2},
+        }
+        self._next_activity_id += 1
+        self.athletes[athlete_id].append(activity)
+        return activity
+
+    def add_activities(self, athlete_id, count=1):
+        """New activities for an athlete, starting in the last hour (what the next sync picks up)"""
+        with self._lock:
+            now = datetime.fromtimestamp(self.clock(), timezone.utc).replace(microsecond=0)
+            latest = _timestamp(self.athletes[athlete_id][-1]) if self.athletes[athlete_id] else 0
+            added = []
+            for _ in range(count):
+                start = max(now - timedelta(seconds=self.rng.randint(0, 3600)),
+                            datetime.fromtimestamp(latest + 1, timezone.utc))
+                added.append(self._create_activity(athlete_id, start))
+                latest = _timestamp(added[-1])
+            return added
+
+    def issue_tokens(self, athlete_id, expires_at=None):
+        """A token response as /oauth/token returns it (also usable to seed tokens.json)"""
+        with self._lock:
+            return self._issue_tokens(athlete_id, expires_at)
+
+    def _issue_tokens(self, athlete_id, expires_at=None):
+        access_token, refresh_token = uuid.uuid4().hex, uuid.uuid4().hex
+        expires_at = int(self.clock()) + self.token_ttl if expires_at is None else expires_at
+        self.access_tokens[access_token] = (athlete_id, expires_at)
+        self.refresh_tokens[refresh_token] = athlete_id
+        return {
+            "token_type": "Bearer",
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "expires_at": expires_at,
+            "expires_in": max(expires_at - int(self.clock()), 0),
+            "athlete": self._athlete(athlete_id),
+        }
+
+    @staticmethod
+    def _athlete(athlete_id):
+        return {"id": athlete_id, "username": f"athlete{athlete_id}", "firstname": "Sim",
+                "lastname": f"Athlete {athlete_id}", "resource_state": 2}
+
+    # Request handling
+    def _rate_headers(self):
+        return {
+            "X-RateLimit-Limit": f"{self.limit[0]},{self.limit[1]}",
+            "X-RateLimit-Usage": f"{self.usage[0]},{self.usage[1]}",
+        }
+
+    def _count_request(self, now):
+        """Count an API call; False if it is over the limits"""
+        window = int(now // SHORT_WINDOW)
+        day = datetime.fromtimestamp(now, timezone.utc).date()
+        if window != self._window:
+            self._window, self.usage[0] = window, 0
+        if day != self._day:
+            self._day, self.usage[1] = day, 0
+        if self.usage[0] >= self.limit[0] or self.usage[1] >= self.limit[1]:
+            return False
+        self.usage[0] += 1
+        self.usage[1] += 1
+        return True
+
+    def handle(self, method, url, headers=None, body=None):
+        """
+        Answer one request.
+
+        Returns:
+            (status code, response headers, JSON payload)
+        """
+        parts = urlsplit(url)
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        route = f"{method} {parts.path}"
+
+        with self._lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+            delay = self.latency + (self.rng.expovariate(1 / self.latency_jitter) if self.latency_jitter else 0)
+
+        if delay:
+            self.sleep(delay)
+
+        with self._lock:
+            status, response_headers, payload = self._respond(method, parts.path, query, headers, body)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        return status, response_headers, payload
+
+    def _respond(self, method, path, query, headers, body):
+        """Route one request (call with the lock held)"""
+        if path == "/oauth/token" and method == "POST":
+            if isinstance(body, bytes):
+                body = body.decode("utf-8")
+            form = {key: values[-1] for key, values in parse_qs(body or "").items()}
+            return self._token_grant(form)
+
+        if not path.startswith("/api/v3/"):
+            return 404, {}, {"message": "Record Not Found"}
+
+        now = self.clock()
+        if not self._count_request(now) or self.rng.random() < self.throttle_rate:
+            return 429, self._rate_headers(), {"message": "Rate Limit Exceeded"}
+        rate_headers = self._rate_headers()
+        if self.rng.random() < self.error_rate:
+            return self.rng.choice((500, 502, 503)), rate_headers, {"message": "Simulated server error"}
+
+        authorization = (headers or {}).get("Authorization", "")
+        token = self.access_tokens.get(authorization[len("Bearer "):]) if authorization.startswith("Bearer ") else None
+        if token is None or token[1] < now:
+            return 401, rate_headers, {"message": "Authorization Error",
+                                       "errors": [{"resource": "AccessToken", "code": "invalid"}]}
+        athlete_id = token[0]
+
+        path = path[len("/api/v3"):]
+        if path == "/athlete" and method == "GET":
+            return 200, rate_headers, self._athlete(athlete_id)
+        if path == "/athlete/activities" and method == "GET":
+            return self._list_activities(athlete_id, query, rate_headers)
+        if path.startswith("/activities/") and method == "GET":
+            activity_id, _, resource = path[len("/activities/"):].partition("/")
+            for activity in self.athletes.get(athlete_id, []):
+                if str(activity["id"]) != activity_id:
+                    continue
+                if resource == "streams":
+                    return 200, rate_headers, self._streams(activity, query)
+                if not resource:
+                    return 200, rate_headers, activity
+        return 404, rate_headers, {"message": "Record Not Found"}
+
+    def _token_grant(self, form):
+        grant_type = form.get("grant_type")
+        if grant_type == "refresh_token":
+            athlete_id = self.refresh_tokens.pop(form.get("refresh_token"), None)
+            if athlete_id is None:
+                return 400, {}, {"message": "Bad Request", "errors": [{"field": "refresh_token", "code": "invalid"}]}
+            return 200, {}, self._issue_tokens(athlete_id)
+        if grant_type == "authorization_code":
+            # Codes look like "sim-<athlete_id>"; anything else logs in the first athlete
+            code = form.get("code", "")
+            athlete_id = int(code[4:]) if code.startswith("sim-") and code[4:].isdigit() else min(self.athletes)
+            if athlete_id not in self.athletes:
+                return 400, {}, {"message": "Bad Request", "errors": [{"field": "code", "code": "invalid"}]}
+            return 200, {}, self._issue_tokens(athlete_id)
+        return 400, {}, {"message": "Bad Request", "errors": [{"field": "grant_type", "code": "invalid"}]}
+
+    def _list_activities(self, athlete_id, query, rate_headers):
+        try:
+            page = max(int(query.get("page", 1)), 1)
+            per_page = min(max(int(query.get("per_page", 30)), 1), 200)
+            after = int(float(query["after"])) if "after" in query else None
+            before = int(float(query["before"])) if "before" in query else None
+        except ValueError:
+            return 400, rate_headers, {"message": "Bad Request"}
+
+        activities = self.athletes.get(athlete_id, [])
+        matching = [
+            activity for activity in activities
+            if (after is None or _timestamp(activity) > after) and (before is None or _timestamp(activity) < before)
+        ]
+        # Like Strava: oldest first when only `after` is given, newest first otherwise
+        if after is None or before is not None:
+            matching.reverse()
+        start = (page - 1) * per_page
+        return 200, rate_headers, matching[start:start + per_page]
+
+    @staticmethod
+    def _streams(activity, query):
+        """1 Hz streams consistent with the activity's distance and moving time"""
+        rng = random.Random(activity["id"])
+        samples = max(activity["moving_time"], 2)
+        speed = activity["distance"] / samples
+        lat, lng, altitude, distance = rng.uniform(-60, 60), rng.uniform(-180, 180), rng.uniform(0, 500), 0.0
+        channels = {key: [] for key in ("time", "distance", "latlng", "altitude", "heartrate", "cadence", "velocity_smooth")}
+        for second in range(samples):
+            velocity = max(speed * rng.uniform(0.8, 1.2), 0.1)
+            distance += velocity
+            lat += velocity / 111_000 * rng.uniform(-1, 1)
+            lng += velocity / 111_000 * rng.uniform(-1, 1)
+            altitude += rng.uniform(-0.5, 0.5)
+            channels["time"].append(second)
+            channels["distance"].append(round(distance, 1))
+            channels["latlng"].append([round(lat, 6), round(lng, 6)])
+            channels["altitude"].append(round(altitude, 1))
+            channels["heartrate"].append(int(activity["average_heartrate"] + rng.randint(-8, 8)))
+            channels["cadence"].append(int(activity["average_cadence"] / 2 + rng.randint(-3, 3)))
+            channels["velocity_smooth"].append(round(velocity, 3))
+
+        keys = set(query.get("keys", "time").split(",")) | {"distance"}  # Strava always adds distance
+        streams = {
+            key: {"type": key, "data": data, "series_type": "distance", "original_size": samples,
+                  "resolution": "high"}
+            for key, data in channels.items() if key in keys
+        }
+        return streams if query.get("key_by_type") == "true" else list(streams.values())
+
+
+class SimulatorAdapter(BaseAdapter):
+    """requests transport that answers from a StravaSimulator instead of the network"""
+
+    def __init__(self, simulator):
+        super().__init__()
+        self.simulator = simulator
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        status, headers, payload = self.simulator.handle(request.method, request.url, request.headers, request.body)
+
+        response = Response()
+        response.status_code = status
+        response.reason = http.client.responses.get(status, "")
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers["Content-Type"] = "application/json; charset=utf-8"
+        response.encoding = "utf-8"
+        response.raw = io.BytesIO(json.dumps(payload).encode("utf-8"))
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+def install(client, simulator=None):
+    """Route a StravaClient's Strava traffic to a simulator (a default one if none is given)"""
+    simulator = simulator or StravaSimulator()
+    client.session.mount(STRAVA_ORIGIN, SimulatorAdapter(simulator))
+    print(f"[STRAVA] Using the local Strava simulator ({len(simulator.athletes)} athletes)")
+    return simulator
@@ -289,7 +289,7 @@ def refresh_strava_token(athlete_id: str, client_id: str, client_secret: str):
     Returns:
         (updated_tokens_dict, error_message)
     """
-    import requests
+    from strava_client import strava_client
     
     try:
         print(f"[TOKEN STORAGE] Refreshing token for athlete_id: {athlete_id}")
@@ -304,14 +304,7 @@ def refresh_strava_token(athlete_id: str, client_id: str, client_secret: str):
             return None, "No refresh token available"
         
         # Request new token from Strava
-        refresh_payload = {
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token,
-        }
-        
-        response = requests.post("https://www.strava.com/oauth/token", data=refresh_payload)
+        response = strava_client.refresh_token(client_id, client_secret, refresh_token)
         new_data = response.json()
         
         if "access_token" not in new_data:
@@ -0,0 +1,259 @@
+"""
+Sync Jobs Module - run /api/sync pipelines on a bounded worker pool
+POST /api/sync only queues a job and returns its id; the Strava fetch,
+scoring and storage writes run on one of SYNC_WORKERS threads, and
+GET /api/sync/<job_id> reports the job's state, timings and result. A second
+sync request for an athlete whose job is still queued or running joins that
+job instead of starting another.
+
+Job state lives in a SQLite table (data/sync_jobs.db), so with several worker
+processes a status poll can land on any of them, and a request in one process
+joins a job running in another. Finished jobs are dropped oldest first beyond
+max_finished. A job left in flight by a process that died counts as
+abandoned job_timeout after it was queued (if it never started) or started,
+and the athlete can be synced again. A queued job found abandoned by the time
+a worker picks it up is not run.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_jobs (
+    id          TEXT PRIMARY KEY,
+    athlete_id  TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    requests    INTEGER NOT NULL DEFAULT 1,
+    created_at  REAL NOT NULL,
+    started_at  REAL,
+    finished_at REAL,
+    status_code INTEGER,
+    result      TEXT,
+    error       TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_jobs_in_flight ON sync_jobs (athlete_id)
+    WHERE state IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS idx_sync_jobs_finished ON sync_jobs (finished_at);
+"""
+
+
+class SyncJob:
+    """One queued sync; task() returns (result dict, HTTP status code)"""
+
+    def __init__(self, athlete_id):
+        self.id = uuid.uuid4().hex
+        self.athlete_id = athlete_id
+        self.state = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.status_code = None
+        self.error = None
+        self.requests = 1  # sync requests this job answers (1 + coalesced ones)
+        self.finished = threading.Event()
+
+    @classmethod
+    def from_row(cls, row):
+        """A job as stored, e.g. one another worker process runs"""
+        job = cls(row["athlete_id"])
+        job.id = row["id"]
+        for field in ("state", "requests", "created_at", "started_at", "finished_at", "status_code", "error"):
+            setattr(job, field, row[field])
+        job.result = json.loads(row["result"]) if row["result"] is not None else None
+        if job.finished_at is not None:
+            job.finished.set()
+        return job
+
+    def to_dict(self):
+        """State, timings (seconds) and, once finished, the pipeline's result"""
+        now = time.time()
+        started = self.started_at or now
+        return {
+            "job_id": self.id,
+            "athlete_id": self.athlete_id,
+            "state": self.state,
+            "requests": self.requests,
+            "created_at": self.created_at,
+            "queued_seconds": round(started - self.created_at, 3),
+            "run_seconds": round((self.finished_at or now) - self.started_at, 3) if self.started_at else None,
+            "status_code": self.status_code,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class SyncJobQueue:
+    """Bounded pool of sync workers with at most one in-flight job per athlete across processes"""
+
+    def __init__(self, db_file, workers=None, max_finished=1000, job_timeout=900.0):
+        """
+        Args:
+            db_file: SQLite database file shared by the worker processes (created if missing)
+            workers: Pipelines run at the same time (default: SYNC_WORKERS or 4)
+            max_finished: Finished jobs kept for status lookups
+            job_timeout: Seconds after being queued (or started, once running) at
+                which a job counts as abandoned (its process died) and no longer
+                blocks new syncs
+        """
+        workers = workers or int(os.getenv("SYNC_WORKERS", "4"))
+        self.db_file = db_file
+        self.max_finished = max_finished
+        self.job_timeout = job_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sync-job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # job_id -> SyncJob run by this process, oldest first
+        self._local = threading.local()
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _conn(self):
+        """This thread's connection, in autocommit mode (transactions are explicit)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def submit(self, athlete_id, task):
+        """
+        Queue task for athlete_id unless a job for them is already queued or running
+        (in any process).
+
+        Returns:
+            (job, created) - created is False when an in-flight job was reused
+        """
+        now = time.time()
+        conn = self._conn()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "UPDATE sync_jobs SET state = ?, status_code = 500, error = 'Abandoned', finished_at = ? "
+                    "WHERE athlete_id = ? AND ((state = ? AND created_at < ?) OR (state = ? AND started_at < ?))",
+                    (FAILED, now, athlete_id, QUEUED, now - self.job_timeout, RUNNING, now - self.job_timeout)
+                )
+                row = conn.execute(
+                    "SELECT * FROM sync_jobs WHERE athlete_id = ? AND state IN (?, ?)",
+                    (athlete_id, QUEUED, RUNNING)
+                ).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE sync_jobs SET requests = requests + 1 WHERE id = ?", (row["id"],))
+                else:
+                    job = SyncJob(athlete_id)
+                    conn.execute(
+                        "INSERT INTO sync_jobs (id, athlete_id, state, requests, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (job.id, athlete_id, job.state, job.requests, job.created_at)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            if row is not None:
+                job = self._jobs.get(row["id"]) or SyncJob.from_row(row)
+                job.requests = row["requests"] + 1
+                return job, False
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, task)
+        return job, True
+
+    def get(self, job_id):
+        """A job by id, whichever process runs it; None if unknown or pruned"""
+        row = self._conn().execute("SELECT * FROM sync_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return SyncJob.from_row(row)
+        job.requests = row["requests"]
+        return job
+
+    def _save(self, job):
+        self._conn().execute(
+            "UPDATE sync_jobs SET state = ?, started_at = ?, finished_at = ?, status_code = ?, result = ?, "
+            "error = ? WHERE id = ?",
+            (job.state, job.started_at, job.finished_at, job.status_code,
+             json.dumps(job.result) if job.result is not None else None, job.error, job.id)
+        )
+
+    def _start(self, job):
+        """Mark a queued job running; False if it was marked abandoned meanwhile"""
+        job.started_at = time.time()
+        cursor = self._conn().execute(
+            "UPDATE sync_jobs SET state = ?, started_at = ? WHERE id = ? AND state = ?",
+            (RUNNING, job.started_at, job.id, QUEUED)
+        )
+        if cursor.rowcount:
+            job.state = RUNNING
+            return True
+        row = self._conn().execute("SELECT * FROM sync_jobs WHERE id = ?", (job.id,)).fetchone()
+        stored = SyncJob.from_row(row)
+        for field in ("state", "started_at", "finished_at", "status_code", "error"):
+            setattr(job, field, getattr(stored, field))
+        return False
+
+    def _run(self, job, task):
+        try:
+            if not self._start(job):
+                # Already stored as failed; another job may be running for the athlete
+                print(f"[SYNC] Job {job.id} was abandoned before it started, not running it")
+                job.finished.set()
+                return
+            job.result, job.status_code = task()
+            job.state = DONE if job.status_code < 400 else FAILED
+        except Exception as e:
+            print(f"[ERROR] Sync job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.status_code = 500
+            job.state = FAILED
+        finally:
+            if not job.finished.is_set():
+                job.finished_at = time.time()
+                try:
+                    self._save(job)
+                    self._prune()
+                except Exception as e:
+                    print(f"[ERROR] Saving sync job {job.id} failed: {str(e)}")
+                job.finished.set()
+
+    def _prune(self):
+        """Drop the oldest finished jobs beyond max_finished, in the table and in memory"""
+        conn = self._conn()
+        stale = [row["id"] for row in conn.execute(
+            "SELECT id FROM sync_jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT -1 OFFSET ?",
+            (self.max_finished,)
+        )]
+        conn.executemany("DELETE FROM sync_jobs WHERE id = ?", [(job_id,) for job_id in stale])
+        with self._lock:
+            for job_id in stale:
+                self._jobs.pop(job_id, None)
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+            for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+                del self._jobs[job_id]
+
+    def counts(self):
+        """{state: number of jobs kept}"""
+        rows = self._conn().execute("SELECT state, COUNT(*) FROM sync_jobs GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
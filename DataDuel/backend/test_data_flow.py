@@ -19,8 +19,45 @@ from Person import Person
 from Score import Score
 from badges import badges
 from challenges import challenges
-from data_storage import DataStorage
-from strava_parser import StravaParser
+import batch_baselines
+from activity_streams import ActivityStreams, StreamStore, encode_streams, fetch_streams, ingest_streams
+from athlete_locks import _thread_locks, athlete_lock
+from backfill import backfill_activities
+from bulk_sync import RequestPacer, bulk_sync, stalest_first
+from day_index import DayIndex, activity_timestamp, annotate_activity, epoch_day
+from json_stream import iter_json_array, iter_response_json
+from data_storage import DataStorage, activity_sort_key, index_activities, sort_leaderboard
+from log_storage import LogStorage
+from sqlite_storage import SQLiteStorage
+from strava_client import RateLimitBudget, StravaClient, StravaRateLimitError
+from strava_parser import ActivityAggregator, StravaParser
+from strava_simulator import StravaSimulator, install
+from sync_jobs import SyncJobQueue
+from token_cache import TokenCache
+from webhook_queue import WebhookQueue, apply_activity, drain
+from webhook_simulator import storage_mismatches, synthetic_events
+from window_metrics import WindowMetrics, recent_activities
+
+
+def _concurrent_writer(data_dir, worker_id, count):
+    """Worker process for test 17: save `count` users, scores and shared-shard activities for one worker"""
+    import contextlib
+    import io
+    storage = DataStorage(data_dir=data_dir, multiprocess=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(count):
+            user_id = f"{worker_id}_{i}"
+            with storage.transaction():
+                storage.save_user(user_id, {"id": user_id})
+                storage.save_score(user_id, {"user_id": user_id, "score": i})
+            # Readers must never see a truncated file mid-write
+            storage.get_all_scores()
+        # Every worker merges into the same athlete's shard
+        for i in range(count):
+            storage.merge_activities("shared", [{
+                "id": f"{worker_id}{i:03d}", "type": "Run", "distance": 1000.0,
+                "start_date_local": f"2024-01-{i % 28 + 1:02d}T0{worker_id}:00:00Z"
+            }])
 
 
 class TestDataFlow:
@@ -649,6 +686,1867 @@ class TestDataFlow:
             traceback.print_exc()
             return False
     
+    def test_12_log_storage(self):
+        """Test 12: Log-structured storage appends, compacts, and reloads"""
+        print("="*70)
+        print("TEST 12: Log-Structured Storage")
+        print("="*70)
+        
+        try:
+            log_storage = LogStorage(data_dir="test_data/log")
+            
+            # Overwrite the same keys many times so most records go stale
+            for i in range(50):
+                for athlete_id in ["1", "2", "3"]:
+                    log_storage.save_score(athlete_id, {"score": i, "user_id": athlete_id})
+            log_storage.save_user("1", {"name": "Test Runner"})
+            log_storage.add_activity("1", {"id": 1001, "distance": 5000.0})
+            log_storage.add_activity("1", {"id": 1002, "distance": 8000.0})
+            
+            assert log_storage.get_score("2")["score"] == 49, "Latest score not returned"
+            assert len(log_storage.get_all_scores()) == 3, "Expected 3 scores"
+            assert len(log_storage.get_activities("1")) == 2, "Expected 2 activities"
+            
+            size_before = os.path.getsize("test_data/log/scores.log")
+            log_storage.compact()
+            size_after = os.path.getsize("test_data/log/scores.log")
+            assert size_after < size_before, "Compaction did not shrink the log"
+            assert log_storage.get_score("3")["score"] == 49, "Score lost during compaction"
+            log_storage.close()
+            
+            # Reopen and rebuild the index from disk
+            reopened = LogStorage(data_dir="test_data/log")
+            assert reopened.get_user("1")["name"] == "Test Runner", "User lost after reopen"
+            assert reopened.get_score("1")["score"] == 49, "Score lost after reopen"
+            assert len(reopened.get_activities("1")) == 2, "Activities lost after reopen"
+            reopened.close()
+            
+            # New logs are seeded from the JSON files, sync watermarks included
+            json_storage = DataStorage(data_dir="test_data/log_seed")
+            json_storage.save_user("1", {"name": "Test Runner"})
+            json_storage.save_sync_watermark("1", 1700000000)
+            seeded = LogStorage(data_dir="test_data/log_seed")
+            assert seeded.get_sync_watermark("1") == 1700000000, "Watermark not seeded"
+            seeded.close()
+            
+            self.log_test(
+                "Log-Structured Storage",
+                True,
+                f"scores.log compacted from {size_before} to {size_after} bytes"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Log-Structured Storage", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_13_sqlite_storage(self):
+        """Test 13: SQLite storage matches JSON storage and imports JSON data"""
+        print("="*70)
+        print("TEST 13: SQLite Storage and JSON Migration")
+        print("="*70)
+        
+        try:
+            # Build a small JSON data set the way the app would
+            json_storage = DataStorage(data_dir="test_data/sqlite_src")
+            for athlete_id, score in [("1", 40), ("2", 95), ("3", 70), ("4", 70)]:
+                json_storage.save_user(athlete_id, {"id": athlete_id, "username": f"runner{athlete_id}"})
+                json_storage.save_score(athlete_id, {"user_id": athlete_id, "score": score})
+            json_storage.save_activities("2", self.get_mock_activities_diverse())
+            json_storage.save_sync_watermark("2", 1700000000)
+            
+            sqlite_storage = SQLiteStorage(data_dir="test_data/sqlite")
+            counts = sqlite_storage.migrate_from_json("test_data/sqlite_src")
+            assert counts == {"users": 4, "activities": 1, "scores": 4, "sync_state": 1}, f"Unexpected counts: {counts}"
+            assert sqlite_storage.get_sync_watermark("2") == 1700000000, "Watermark not migrated"
+            
+            # Leaderboard order must match the JSON backend, ties included
+            expected = [row[0] for row in json_storage.get_leaderboard()]
+            actual = [row[0] for row in sqlite_storage.get_leaderboard()]
+            assert actual == expected, f"Leaderboard mismatch: {actual} != {expected}"
+            assert sqlite_storage.get_leaderboard(limit=1)[0][2]["username"] == "runner2", "Users join failed"
+            
+            # Round-trip through the regular API
+            assert sqlite_storage.get_activities("2") == json_storage.get_activities("2"), "Activities mismatch"
+            rowids = sqlite_storage._conn().execute("SELECT rowid FROM activities ORDER BY rowid").fetchall()
+            sqlite_storage.add_activity("2", {"id": 9001, "type": "Run", "distance": 1000.0})
+            assert len(sqlite_storage.get_activities("2")) == 7, "add_activity did not append"
+            after = sqlite_storage._conn().execute("SELECT rowid FROM activities ORDER BY rowid").fetchall()
+            assert after[:len(rowids)] == rowids, "Upsert rewrote the athlete's other activities"
+            sqlite_storage.save_score("1", {"user_id": "1", "score": 120})
+            assert sqlite_storage.get_leaderboard()[0][0] == "1", "Updated score not ranked first"
+            assert sqlite_storage.get_all_users() == json_storage.get_all_users(), "Users mismatch"
+            sqlite_storage.close()
+            
+            self.log_test(
+                "SQLite Storage and JSON Migration",
+                True,
+                f"Imported {counts}, leaderboard order {actual}"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("SQLite Storage and JSON Migration", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_14_read_cache(self):
+        """Test 14: DataStorage caches parsed files and invalidates on change"""
+        print("="*70)
+        print("TEST 14: DataStorage Read Cache")
+        print("="*70)
+        
+        try:
+            cache_storage = DataStorage(data_dir="test_data/cache")
+            cache_storage.save_score("1", {"user_id": "1", "score": 10})
+            
+            # Repeated reads after our own write are served from the cache
+            hits_before = cache_storage.cache_hits
+            for _ in range(5):
+                assert cache_storage.get_score("1")["score"] == 10, "Wrong cached score"
+            assert cache_storage.cache_hits - hits_before == 5, "Reads were not cache hits"
+            
+            # A write from outside this instance changes mtime/size and invalidates
+            with open(cache_storage.scores_file, 'w') as f:
+                json.dump({"1": {"user_id": "1", "score": 250}}, f)
+            misses_before = cache_storage.cache_misses
+            assert cache_storage.get_score("1")["score"] == 250, "Stale cache after external write"
+            assert cache_storage.cache_misses == misses_before + 1, "External write not detected"
+            
+            # Our own writes are visible immediately
+            cache_storage.save_score("1", {"user_id": "1", "score": 300})
+            assert cache_storage.get_score("1")["score"] == 300, "Own write not visible"
+            
+            stats = cache_storage.cache_stats()
+            self.log_test(
+                "DataStorage Read Cache",
+                True,
+                f"Cache stats: {stats}"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("DataStorage Read Cache", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_15_sharded_activities(self):
+        """Test 15: Per-athlete activity shards and migration from activities.json"""
+        print("="*70)
+        print("TEST 15: Sharded Activity Files")
+        print("="*70)
+        
+        try:
+            # Start from a monolithic activities.json like older installs have
+            os.makedirs("test_data/shards", exist_ok=True)
+            monolithic = {
+                "101": self.get_mock_activities_diverse(),
+                "102": self.get_mock_activities_streak(),
+                "103": []
+            }
+            with open("test_data/shards/activities.json", 'w') as f:
+                json.dump(monolithic, f)
+            
+            shard_storage = DataStorage(data_dir="test_data/shards", shard_activities=True)
+            assert sorted(shard_storage.get_activity_user_ids()) == ["101", "102", "103"], "Index incomplete"
+            for athlete_id, activities in monolithic.items():
+                assert shard_storage.get_activities(athlete_id) == activities, f"Shard mismatch for {athlete_id}"
+            
+            # Writing one athlete only touches that athlete's shard
+            other_shard = shard_storage._shard_file("102")
+            other_mtime = os.stat(other_shard).st_mtime_ns
+            shard_storage.save_activities("101", self.get_mock_activities_minimal())
+            shard_storage.add_activity("104", {"id": 5001, "type": "Run", "distance": 3000.0})
+            assert os.stat(other_shard).st_mtime_ns == other_mtime, "Unrelated shard was rewritten"
+            assert len(shard_storage.get_activities("101")) == 1, "save_activities did not replace"
+            assert "104" in shard_storage.get_activity_user_ids(), "New athlete missing from index"
+            assert shard_storage.get_activities("999") == [], "Unknown athlete should have no activities"
+            
+            self.log_test(
+                "Sharded Activity Files",
+                True,
+                f"{len(shard_storage.get_activity_user_ids())} athletes indexed"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Sharded Activity Files", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_16_transaction(self):
+        """Test 16: Storage transactions batch writes and roll back on error"""
+        print("="*70)
+        print("TEST 16: Storage Transactions")
+        print("="*70)
+        
+        try:
+            for backend in [
+                DataStorage(data_dir="test_data/txn_json"),
+                LogStorage(data_dir="test_data/txn_log"),
+                SQLiteStorage(data_dir="test_data/txn_sqlite")
+            ]:
+                name = type(backend).__name__
+                backend.save_score("1", {"user_id": "1", "score": 10})
+                
+                # A failing sync leaves nothing behind
+                try:
+                    with backend.transaction():
+                        backend.save_activities("1", self.get_mock_activities_minimal())
+                        backend.save_user("1", {"name": "Half Written"})
+                        backend.save_score("1", {"user_id": "1", "score": 99})
+                        raise RuntimeError("simulated Strava failure")
+                except RuntimeError:
+                    pass
+                assert backend.get_user("1") is None, f"{name}: user written despite rollback"
+                assert backend.get_activities("1") == [], f"{name}: activities written despite rollback"
+                assert backend.get_score("1")["score"] == 10, f"{name}: score changed despite rollback"
+                
+                # A successful sync lands all three writes, visible inside the block too
+                with backend.transaction():
+                    backend.save_activities("1", self.get_mock_activities_minimal())
+                    backend.save_user("1", {"name": "Test Runner"})
+                    backend.save_score("1", {"user_id": "1", "score": 20})
+                    backend.save_score("1", {"user_id": "1", "score": 30})
+                    assert backend.get_score("1")["score"] == 30, f"{name}: read-your-writes failed"
+                assert backend.get_user("1")["name"] == "Test Runner", f"{name}: user not committed"
+                assert len(backend.get_activities("1")) == 1, f"{name}: activities not committed"
+                assert backend.get_score("1")["score"] == 30, f"{name}: score not committed"
+                
+                if hasattr(backend, "close"):
+                    backend.close()
+            
+            # JSON backend: the scores file is untouched until commit
+            json_storage = DataStorage(data_dir="test_data/txn_json")
+            mtime_before = os.stat(json_storage.scores_file).st_mtime_ns
+            with json_storage.transaction():
+                json_storage.save_score("2", {"user_id": "2", "score": 5})
+                assert os.stat(json_storage.scores_file).st_mtime_ns == mtime_before, "Write was not buffered"
+            assert json_storage.get_score("2")["score"] == 5, "Buffered write not flushed"
+            
+            self.log_test(
+                "Storage Transactions",
+                True,
+                "Commit and rollback verified for json, log and sqlite backends"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Storage Transactions", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_17_multiprocess_storage(self):
+        """Test 17: Concurrent worker processes do not lose or corrupt updates"""
+        print("="*70)
+        print("TEST 17: Multi-Process Storage")
+        print("="*70)
+        
+        try:
+            import multiprocessing
+            from data_storage import fcntl
+            if fcntl is None:
+                self.log_test("Multi-Process Storage", True, "Skipped: fcntl not available on this platform")
+                return True
+            
+            data_dir = "test_data/multiprocess"
+            DataStorage(data_dir=data_dir, multiprocess=True)
+            workers, per_worker = 4, 25
+            context = multiprocessing.get_context("fork")
+            processes = [
+                context.Process(target=_concurrent_writer, args=(data_dir, worker_id, per_worker))
+                for worker_id in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            
+            assert all(process.exitcode == 0 for process in processes), "A worker process failed"
+            
+            check_storage = DataStorage(data_dir=data_dir, multiprocess=True)
+            users = check_storage.get_all_users()
+            scores = check_storage.get_all_scores()
+            expected = workers * per_worker
+            assert len(users) == expected, f"Lost user updates: {len(users)} of {expected}"
+            assert len(scores) == expected, f"Lost score updates: {len(scores)} of {expected}"
+            shared = check_storage.get_activities("shared")
+            assert len(shared) == expected, f"Lost shard merges: {len(shared)} of {expected}"
+            
+            self.log_test(
+                "Multi-Process Storage",
+                True,
+                f"{workers} processes wrote {expected} users and shard merges with no lost updates"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Multi-Process Storage", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_18_bulk_get(self):
+        """Test 18: Bulk user/score lookups match single-key lookups"""
+        print("="*70)
+        print("TEST 18: Bulk Multi-Get")
+        print("="*70)
+        
+        try:
+            for backend in [
+                DataStorage(data_dir="test_data/bulk_json"),
+                LogStorage(data_dir="test_data/bulk_log"),
+                SQLiteStorage(data_dir="test_data/bulk_sqlite")
+            ]:
+                name = type(backend).__name__
+                with backend.transaction():
+                    for i in range(20):
+                        backend.save_user(str(i), {"id": str(i), "username": f"runner{i}", "streak": i})
+                        if i % 2 == 0:
+                            backend.save_score(str(i), {"user_id": str(i), "score": i * 10, "improvement": 1.5})
+                
+                ids = [str(i) for i in range(0, 25, 3)]  # includes unknown IDs 21 and 24
+                users = backend.get_users(ids)
+                scores = backend.get_scores(ids)
+                summaries = backend.get_user_summaries(ids)
+                
+                assert set(users) == {i for i in ids if int(i) < 20}, f"{name}: wrong users {sorted(users)}"
+                assert set(scores) == {i for i in ids if int(i) < 20 and int(i) % 2 == 0}, f"{name}: wrong scores"
+                assert list(summaries) == ids, f"{name}: summaries should cover every requested ID"
+                for user_id in ids:
+                    assert users.get(user_id) == backend.get_user(user_id), f"{name}: user {user_id} mismatch"
+                    assert scores.get(user_id) == backend.get_score(user_id), f"{name}: score {user_id} mismatch"
+                    expected_score = (backend.get_score(user_id) or {}).get('score', 0)
+                    assert summaries[user_id]['score'] == expected_score, f"{name}: summary {user_id} mismatch"
+                assert summaries["21"] == {"score": 0, "improvement": 0}, f"{name}: unknown user summary"
+                
+                if hasattr(backend, "close"):
+                    backend.close()
+            
+            # JSON backend resolves a whole batch with at most one parse per file
+            json_storage = DataStorage(data_dir="test_data/bulk_json")
+            json_storage.get_user_summaries([str(i) for i in range(20)])
+            assert json_storage.cache_misses <= 2, f"Expected <= 2 file parses, got {json_storage.cache_misses}"
+            
+            self.log_test(
+                "Bulk Multi-Get",
+                True,
+                "get_users, get_scores and get_user_summaries verified for all backends"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Bulk Multi-Get", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_20_merge_activities(self):
+        """Test 20: Activities are upserted by id and kept in start-date order"""
+        print("="*70)
+        print("TEST 20: Idempotent Activity Merge")
+        print("="*70)
+        
+        try:
+            for backend in [
+                DataStorage(data_dir="test_data/merge_json"),
+                LogStorage(data_dir="test_data/merge_log"),
+                SQLiteStorage(data_dir="test_data/merge_sqlite")
+            ]:
+                name = type(backend).__name__
+                page = self.get_mock_activities_diverse()  # newest first, like Strava
+                
+                counts = backend.merge_activities("1", page)
+                assert counts == {"inserted": 6, "updated": 0, "unchanged": 0}, f"{name}: first merge {counts}"
+                
+                if isinstance(backend, DataStorage):
+                    shard_mtime = os.stat(backend._shard_file("1")).st_mtime_ns
+                counts = backend.merge_activities("1", page)
+                assert counts == {"inserted": 0, "updated": 0, "unchanged": 6}, f"{name}: re-sync {counts}"
+                if isinstance(backend, DataStorage):
+                    assert os.stat(backend._shard_file("1")).st_mtime_ns == shard_mtime, "Unchanged re-sync rewrote shard"
+                
+                edited = dict(page[2], distance=5100.0)
+                newest = {"id": 1006, "type": "Run", "distance": 4000.0, "moving_time": 1500,
+                          "start_date": (datetime.now() + timedelta(hours=1)).isoformat()}
+                counts = backend.merge_activities("1", [edited, newest, newest, page[0]])
+                assert counts == {"inserted": 1, "updated": 1, "unchanged": 1}, f"{name}: mixed batch {counts}"
+                
+                stored = backend.get_activities("1")
+                ids = [activity['id'] for activity in stored]
+                assert len(ids) == len(set(ids)) == 7, f"{name}: duplicates or lost history {ids}"
+                assert [activity_sort_key(a) for a in stored] == sorted(activity_sort_key(a) for a in stored), \
+                    f"{name}: activities not in start-date order"
+                assert stored[-1]['id'] == 1006, f"{name}: newest activity should be last"
+                assert next(a for a in stored if a['id'] == 1003)['distance'] == 5100.0, f"{name}: update lost"
+                
+                backend.add_activity("1", dict(newest, name="Renamed"))
+                assert len(backend.get_activities("1")) == 7, f"{name}: add_activity duplicated an id"
+                
+                if isinstance(backend, DataStorage):
+                    _, positions = backend._activity_positions["1"]
+                    assert positions == index_activities(backend.get_activities("1")), "Stale id -> position index"
+                
+                # Merges in concurrent transactions each build on the other's committed result
+                import contextlib
+                import io
+                import threading
+                import time
+                
+                def merge_in_transaction(activity_id):
+                    with backend.transaction():
+                        backend.merge_activities("2", [{"id": activity_id, "type": "Run", "distance": 1000.0,
+                                                        "start_date": f"2024-01-{activity_id:02d}T07:00:00Z"}])
+                        time.sleep(0.01)
+                
+                with contextlib.redirect_stdout(io.StringIO()):
+                    threads = [threading.Thread(target=merge_in_transaction, args=(i,)) for i in range(1, 9)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                merged = backend.get_activities("2")
+                assert len(merged) == 8, f"{name}: concurrent merges lost activities ({len(merged)} of 8)"
+                if hasattr(backend, "close"):
+                    backend.close()
+            
+            self.log_test(
+                "Idempotent Activity Merge",
+                True,
+                "Insert/update/unchanged counts, ordering and no-op re-sync verified for all backends"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Idempotent Activity Merge", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_21_score_index(self):
+        """Test 21: Maintained score index matches a full sort of every score"""
+        print("="*70)
+        print("TEST 21: Sorted Score Index")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            import random
+            
+            rng = random.Random(7)
+            for backend in [
+                DataStorage(data_dir="test_data/rank_json"),
+                LogStorage(data_dir="test_data/rank_log"),
+                SQLiteStorage(data_dir="test_data/rank_sqlite")
+            ]:
+                name = type(backend).__name__
+                with contextlib.redirect_stdout(io.StringIO()):
+                    with backend.transaction():
+                        for i in range(150):
+                            # Few distinct scores so ties are common
+                            backend.save_score(str(i), {"user_id": str(i), "score": rng.randrange(20)})
+                    for _ in range(100):
+                        user_id = str(rng.randrange(200))  # some updates, some new users
+                        backend.save_score(user_id, {"user_id": user_id, "score": rng.randrange(20)})
+                
+                expected = [row[0] for row in sort_leaderboard(backend.get_all_scores(), {})]
+                got = [row[0] for row in backend.get_leaderboard()]
+                assert got == expected, f"{name}: leaderboard order differs from a full sort"
+                assert [row[0] for row in backend.get_leaderboard(10)] == expected[:10], f"{name}: top-10 differs"
+                for rank, user_id in enumerate(expected, start=1):
+                    assert backend.get_rank(user_id) == rank, f"{name}: rank of {user_id} wrong"
+                assert backend.get_rank("no_such_user") is None, f"{name}: unknown user should have no rank"
+                
+                if hasattr(backend, "close"):
+                    backend.close()
+            
+            # Rebuilt at startup, and after another writer changes scores.json
+            storage = DataStorage(data_dir="test_data/rank_json")
+            other_writer = DataStorage(data_dir="test_data/rank_json")
+            with contextlib.redirect_stdout(io.StringIO()):
+                other_writer.save_score("newcomer", {"user_id": "newcomer", "score": 1000})
+            assert storage.get_rank("newcomer") == 1, "Index missed another writer's score"
+            expected = [row[0] for row in sort_leaderboard(storage.get_all_scores(), {})]
+            assert [row[0] for row in storage.get_leaderboard()] == expected, "Rebuilt index order wrong"
+            
+            self.log_test(
+                "Sorted Score Index",
+                True,
+                f"Top-k and ranks match a full sort of {len(expected)} scores on all backends"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Sorted Score Index", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_22_activity_aggregator(self):
+        """Test 22: One ActivityAggregator pass matches the separate StravaParser scans"""
+        print("="*70)
+        print("TEST 22: Single-Pass Activity Aggregator")
+        print("="*70)
+        
+        try:
+            fields = ['total_workouts', 'total_distance', 'total_moving_time', 'baseline_average_speed',
+                      'baseline_max_speed', 'baseline_distance', 'baseline_moving_time', 'average_cadence',
+                      'average_heartrate', 'elapsed_time', 'total_elevation', 'streak']
+            
+            for activities in [self.get_mock_activities_diverse(), self.get_mock_activities_streak(),
+                               self.get_mock_activities_minimal()]:
+                expected = Person()
+                StravaParser.parse_activities(activities, expected)
+                expected.streak = StravaParser.calculate_streak(activities)
+                StravaParser.check_badges(expected)
+                StravaParser.check_challenges(expected, activities)
+                
+                person = Person()
+                assert ActivityAggregator(activities).apply(person) is not None, "Expected run metrics"
+                for field in fields:
+                    assert getattr(person, field) == getattr(expected, field), \
+                        f"{field}: {getattr(person, field)} != {getattr(expected, field)}"
+                assert person.badges.get_points() == expected.badges.get_points(), "Badges differ"
+                assert person.weekly_challenges.get_points() == expected.weekly_challenges.get_points(), \
+                    "Challenges differ"
+            
+            # assume_runs mirrors parse_activities_new (untyped frontend activities)
+            untyped = [{"distance": 5000.0, "elapsed_time": 1500}, {"type": "Run", "distance": 3000.0, "moving_time": 900}]
+            expected = Person()
+            StravaParser.parse_activities_new(untyped, expected)
+            person = Person()
+            ActivityAggregator(untyped, assume_runs=True).apply_metrics(person)
+            assert (person.total_workouts, person.total_moving_time) == (expected.total_workouts, expected.total_moving_time), \
+                "assume_runs does not match parse_activities_new"
+            
+            # Strava's 'Z'-suffixed local dates; adding one at a time matches the batch
+            now = datetime.now()
+            strava_style = [
+                {"id": i, "type": "Run", "distance": 6000.0, "moving_time": 1800,
+                 "start_date_local": (now - timedelta(days=i)).strftime("%Y-%m-%dT%H:%M:%SZ")}
+                for i in range(6)
+            ]
+            incremental = ActivityAggregator()
+            for activity in strava_style:
+                incremental.add(activity)
+            batch = ActivityAggregator(strava_style)
+            assert incremental.streak() == batch.streak() == 6, f"Streak {batch.streak()} != 6"
+            assert (incremental.week_runs, incremental.week_distance) == (batch.week_runs, batch.week_distance), \
+                "Incremental week totals differ"
+            assert ActivityAggregator([]).apply(Person()) is None, "No runs should give no metrics"
+            
+            self.log_test(
+                "Single-Pass Activity Aggregator",
+                True,
+                "Metrics, streak, badges and challenges match the separate scans"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Single-Pass Activity Aggregator", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_23_batch_baselines(self):
+        """Test 23: Batch baseline recompute seeds the running_stats sync continues from"""
+        print("="*70)
+        print("TEST 23: Batch Baseline Recompute")
+        print("="*70)
+        
+        try:
+            histories = {
+                "1": self.get_mock_activities_diverse(),
+                "2": self.get_mock_activities_streak(),
+                "3": self.get_mock_activities_minimal(),
+                "4": [{"id": 1, "type": "Ride", "distance": 20000.0, "moving_time": 3600}]  # no runs
+            }
+            
+            engines = [False] + ([True] if batch_baselines.np is not None else [])
+            for use_numpy in engines:
+                for backend in [
+                    DataStorage(data_dir=f"test_data/baselines_json_{use_numpy}"),
+                    LogStorage(data_dir=f"test_data/baselines_log_{use_numpy}"),
+                    SQLiteStorage(data_dir=f"test_data/baselines_sqlite_{use_numpy}")
+                ]:
+                    name = f"{type(backend).__name__} (numpy={use_numpy})"
+                    with backend.transaction():
+                        for user_id, activities in histories.items():
+                            # Stale running sums and this week's speed from an earlier sync
+                            backend.save_user(user_id, {"id": user_id, "username": f"runner{user_id}",
+                                                        "average_speed": 9.5, "running_stats": {"distance": {}},
+                                                        "baseline_distance": 1.0})
+                            backend.save_activities(user_id, activities)
+                    
+                    updated = batch_baselines.recompute_all_baselines(backend, use_numpy=use_numpy)
+                    assert updated == 3, f"{name}: expected 3 users updated, got {updated}"
+                    
+                    for user_id, activities in histories.items():
+                        user_data = backend.get_user(user_id)
+                        assert user_data['username'] == f"runner{user_id}", f"{name}: user fields lost"
+                        assert user_data['average_speed'] == 9.5, f"{name}: this week's speed overwritten"
+                        runs = [a for a in activities if a.get('type') in ActivityAggregator.RUN_TYPES]
+                        if not runs:
+                            assert user_data['running_stats'] == {"distance": {}}, f"{name}: runless user changed"
+                            continue
+                        assert 'baseline_distance' not in user_data, f"{name}: unused baseline field kept"
+                        assert user_data.get('rescore_pending'), f"{name}: user not flagged for rescoring"
+                        
+                        # What the sync's cold seed would have built from the same runs
+                        person = Person()
+                        for run in runs:
+                            person.add_activity(run)
+                        for metric, expected in person.running_stats_to_dict().items():
+                            for key, value in expected.items():
+                                actual = user_data['running_stats'][metric][key]
+                                assert abs(actual - value) <= 1e-9 * max(1.0, abs(value)), \
+                                    f"{name}: user {user_id} {metric}.{key} {actual} != {value}"
+                        
+                        # A sync continues from the saved stats
+                        restored = Person()
+                        restored.load_running_stats(user_data['running_stats'])
+                        for field, expected in [('total_workouts', person.total_workouts),
+                                                ('total_distance', person.total_distance),
+                                                ('total_moving_time', person.total_moving_time),
+                                                ('baseline_distance', person.baseline_distance),
+                                                ('baseline_average_speed', person.baseline_average_speed)]:
+                            actual = user_data[field] if field.startswith('total_') else getattr(restored, field)
+                            assert abs(actual - expected) < 1e-9, \
+                                f"{name}: user {user_id} {field} {actual} != {expected}"
+                    
+                    if hasattr(backend, "close"):
+                        backend.close()
+            
+            # A webhook holding athlete 1's lock saves a new run and its own field;
+            # the recompute waits for it and keeps both
+            import contextlib
+            import io
+            import threading
+            import time
+            backend = DataStorage(data_dir="test_data/baselines_locked")
+            for user_id, activities in histories.items():
+                backend.save_user(user_id, {"id": user_id})
+                backend.save_activities(user_id, activities)
+            new_run = {"id": 999, "type": "Run", "distance": 5000.0, "moving_time": 1500,
+                       "start_date_local": "2099-01-01T07:00:00Z"}
+            with contextlib.redirect_stdout(io.StringIO()):
+                with athlete_lock(backend, "1"):
+                    worker = threading.Thread(target=batch_baselines.recompute_all_baselines, args=(backend,))
+                    worker.start()
+                    time.sleep(0.2)
+                    assert worker.is_alive(), "Recompute did not wait for the athlete's lock"
+                    backend.merge_activities("1", [new_run])
+                    backend.save_user("1", {"id": "1", "scored_day": 123})
+                worker.join(10)
+            user_data = backend.get_user("1")
+            assert user_data.get('scored_day') == 123, "Recompute saved over a newer user record"
+            runs = [a for a in backend.get_activities("1") if a.get('type') in ActivityAggregator.RUN_TYPES]
+            assert user_data['running_stats']['distance']['count'] == len(runs), \
+                "Running stats miss the run saved during the recompute"
+            
+            self.log_test(
+                "Batch Baseline Recompute",
+                True,
+                f"Engines checked: {['numpy' if e else 'python' for e in engines]}"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Batch Baseline Recompute", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_24_running_baselines(self):
+        """Test 24: Running-sum baselines match a full re-aggregation after add/remove/edit"""
+        print("="*70)
+        print("TEST 24: Incremental Running-Sum Baselines")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            import statistics
+            
+            fields = ['total_workouts', 'total_distance', 'total_moving_time', 'baseline_average_speed',
+                      'baseline_max_speed', 'baseline_distance', 'baseline_moving_time', 'average_cadence',
+                      'average_heartrate', 'elapsed_time', 'total_elevation']
+            
+            def assert_matches(person, activities, label):
+                expected = Person()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    StravaParser.parse_activities(activities, expected)
+                for field in fields:
+                    got, want = getattr(person, field), getattr(expected, field)
+                    assert abs(got - want) < 1e-6, f"{label}: {field} {got} != {want}"
+            
+            runs = [a for a in self.get_mock_activities_diverse() if a['type'] != 'Ride']
+            person = Person()
+            for activity in runs:
+                person.add_activity(activity)
+            assert_matches(person, runs, "after adds")
+            distances = [a['distance'] for a in runs]
+            assert abs(person.activity_stats['distance'].get_variance() - statistics.pvariance(distances)) < 1e-6, \
+                "Welford variance differs from pvariance"
+            
+            person.remove_activity(runs[1])
+            assert_matches(person, runs[:1] + runs[2:], "after remove")
+            edited = dict(runs[0], distance=21097.0, moving_time=6000)
+            person.replace_activity(runs[0], edited)
+            assert_matches(person, [edited] + runs[2:], "after edit")
+            assert abs(person.activity_stats['distance'].get_variance()
+                       - statistics.pvariance([edited['distance']] + distances[2:])) < 1e-6, "Variance after edit"
+            
+            # Persisted sums continue where they left off
+            restored = Person()
+            restored.load_running_stats(json.loads(json.dumps(person.running_stats_to_dict())))
+            assert_matches(restored, [edited] + runs[2:], "after reload")
+            
+            # Sync flow: apply only the page's changes, then compare with the merged history
+            storage = DataStorage(data_dir="test_data/running_baselines")
+            history = self.get_mock_activities_diverse()
+            with contextlib.redirect_stdout(io.StringIO()):
+                storage.merge_activities("1", history)
+            person = Person()
+            for activity in history:
+                if activity['type'] in ActivityAggregator.RUN_TYPES:
+                    person.add_activity(activity)
+            
+            page = [
+                dict(history[0], distance=16000.0),              # edited run
+                dict(history[3], type="Hike"),                   # run that became a hike
+                dict(history[5], type="Run", average_speed=3.0), # ride that became a run
+                {"id": 1007, "type": "Run", "distance": 7000.0, "moving_time": 2100,
+                 "average_speed": 3.3, "max_speed": 4.4, "start_date": datetime.now().isoformat()},
+                history[1]                                       # unchanged
+            ]
+            previous = storage.get_activities_by_id("1", [a['id'] for a in page])
+            assert len(previous) == 4, f"Expected 4 stored activities, got {len(previous)}"
+            changed = StravaParser.apply_activity_changes(person, previous, page)
+            assert changed == 4, f"Expected 4 changes, got {changed}"
+            
+            with contextlib.redirect_stdout(io.StringIO()):
+                storage.merge_activities("1", page)
+            assert_matches(person, storage.get_activities("1"), "after sync page")
+            
+            self.log_test(
+                "Incremental Running-Sum Baselines",
+                True,
+                "Add/remove/edit, persistence and page deltas match full re-aggregation"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Incremental Running-Sum Baselines", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_25_day_index(self):
+        """Test 25: Epoch-day index answers streak queries like a day-by-day scan"""
+        print("="*70)
+        print("TEST 25: Epoch-Day Streak Index")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            import random
+            from datetime import date
+            
+            # Annotation: local calendar date, ISO week across a year boundary
+            annotated = annotate_activity({"id": 1, "start_date_local": "2024-12-30T23:30:00Z"})
+            assert annotated['local_epoch_day'] == epoch_day(date(2024, 12, 30)), "Wrong epoch day"
+            assert annotated['local_iso_week'] == 202501, f"Wrong ISO week {annotated['local_iso_week']}"
+            assert annotate_activity(annotated) is annotated, "Re-annotating should be a no-op"
+            
+            def scan_streak(days, as_of):
+                # Reference: walk back day by day from as_of (or the day before)
+                day = as_of if as_of in days else as_of - 1
+                streak = 0
+                while day in days:
+                    streak += 1
+                    day -= 1
+                return streak
+            
+            rng = random.Random(3)
+            days = {day for day in range(20000, 20400) if rng.random() < 0.7}
+            index = DayIndex(days)
+            longest = max(scan_streak(days, day) for day in days)
+            assert index.longest_streak == longest, f"Longest streak {index.longest_streak} != {longest}"
+            for as_of in range(19990, 20410):
+                assert index.streak_as_of(as_of) == scan_streak(days, as_of), f"Streak as of {as_of} wrong"
+            assert index.current_streak(max(days) + 2) == 0, "Old activity should not give a current streak"
+            
+            # Stored activities carry the index fields, and calculate_streak agrees with them
+            now = datetime.now()
+            activities = [
+                {"id": i, "type": "Run", "distance": 5000.0,
+                 "start_date_local": (now - timedelta(days=i)).strftime("%Y-%m-%dT%H:%M:%SZ")}
+                for i in list(range(4)) + [6, 7]
+            ]
+            storage = DataStorage(data_dir="test_data/day_index")
+            with contextlib.redirect_stdout(io.StringIO()):
+                storage.merge_activities("1", activities)
+            stored = storage.get_activities("1")
+            assert all('local_epoch_day' in a and 'local_iso_week' in a for a in stored), "Index fields not stored"
+            assert StravaParser.calculate_streak(stored) == StravaParser.calculate_streak(activities) == 4, \
+                "calculate_streak differs between stored and raw activities"
+            assert DayIndex.from_activities(stored).longest_streak == 4, "Longest streak of stored activities"
+            
+            self.log_test(
+                "Epoch-Day Streak Index",
+                True,
+                f"Longest streak {index.longest_streak}, streak-as-of checked on {len(days)} days"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Epoch-Day Streak Index", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_26_window_metrics(self):
+        """Test 26: Prefix-sum window metrics match a scan over the activities"""
+        print("="*70)
+        print("TEST 26: Rolling Window Metrics")
+        print("="*70)
+        
+        try:
+            import random
+            
+            rng = random.Random(5)
+            first_day, last_day = 20000, 20120
+            activities = [
+                {"id": i, "type": rng.choice(["Run", "Run", "TrailRun", "Ride"]),
+                 "local_epoch_day": rng.randint(first_day - 10, last_day + 10),
+                 "distance": rng.uniform(1000, 20000), "moving_time": rng.randint(300, 7200),
+                 "average_speed": rng.uniform(2, 5), "max_speed": rng.uniform(4, 8)}
+                for i in range(400)
+            ]
+            windows = WindowMetrics(activities, first_day, last_day)
+            
+            def scan(start_day, end_day):
+                # Reference: filter and sum every activity in the window
+                runs = [a for a in activities
+                        if a['type'] in ("Run", "TrailRun")
+                        and max(start_day, first_day) <= a['local_epoch_day'] <= min(end_day, last_day)]
+                return len(runs), sum(a['distance'] for a in runs), sum(a['max_speed'] for a in runs)
+            
+            for _ in range(300):
+                start_day = rng.randint(first_day - 20, last_day + 5)
+                end_day = start_day + rng.randint(-3, 100)
+                count, distance, max_speed = scan(start_day, end_day)
+                totals = windows.totals(start_day, end_day)
+                assert totals['count'] == count, f"Count {totals['count']} != {count} for {start_day}..{end_day}"
+                assert abs(totals['distance'] - distance) < 1e-6, f"Distance wrong for {start_day}..{end_day}"
+                averages = windows.averages(start_day, end_day)
+                expected = max_speed / count if count else 0
+                assert abs(averages['max_speed'] - expected) < 1e-9, f"Average max speed wrong for {start_day}..{end_day}"
+            
+            # Week vs trailing baseline: empty 28-day window falls back to 90 days
+            week_start = last_day - 3
+            sparse = [a for a in activities if not week_start - 28 <= a['local_epoch_day'] < week_start]
+            current, baseline, baseline_days = WindowMetrics(sparse, first_day, last_day).week_vs_baseline(
+                week_start, last_day)
+            assert baseline_days == 90, f"Expected the 90-day fallback, got {baseline_days}"
+            assert current['count'] == scan(week_start, last_day)[0], "Current week count wrong"
+            _, baseline, baseline_days = WindowMetrics([], first_day, last_day).week_vs_baseline(week_start, last_day)
+            assert baseline is None and baseline_days is None, "No runs should give no baseline"
+            
+            # recent_activities: page copies replace stored ones, the walk stops at older days
+            stored = [{"id": i, "local_epoch_day": 100 + i, "distance": 1.0} for i in range(10)]
+            page = [{"id": 8, "local_epoch_day": 108, "distance": 2.0}, {"id": 20, "local_epoch_day": 50}]
+            recent = recent_activities(stored, page, 105)
+            assert sorted(a['id'] for a in recent) == [5, 6, 7, 8, 9], f"Wrong recent ids {[a['id'] for a in recent]}"
+            assert [a['distance'] for a in recent if a['id'] == 8] == [2.0], "Page copy should win"
+            
+            self.log_test(
+                "Rolling Window Metrics",
+                True,
+                f"300 random windows over {last_day - first_day + 1} days match a full scan"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Rolling Window Metrics", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_27_json_stream(self):
+        """Test 27: Streaming JSON parser yields the same activities as json.loads"""
+        print("="*70)
+        print("TEST 27: Streaming Activity JSON Parser")
+        print("="*70)
+        
+        try:
+            import random
+            
+            activities = [
+                {"id": 10**12 + i, "name": f"Run {i} \u00e9\u00e8 \u2192 ]}},\"", "type": "Run",
+                 "distance": 5000.5 + i, "moving_time": 1500, "max_speed": -1.5e-3,
+                 "map": {"summary_polyline": "a[b]c"}, "private": False, "gear_id": None, "laps": [1, [2, 3]]}
+                for i in range(50)
+            ]
+            body = json.dumps(activities, ensure_ascii=False, indent=1).encode("utf-8")
+            
+            class StreamedResponse:
+                # Minimal stand-in for a requests.Response opened with stream=True
+                encoding = "utf-8"
+                
+                def __init__(self, body, sizes):
+                    self.body = body
+                    self.sizes = sizes
+                    self.chunks_read = 0
+                    self.closed = False
+                
+                def iter_content(self, chunk_size=1):
+                    position = 0
+                    while position < len(self.body):
+                        size = self.sizes()
+                        self.chunks_read += 1
+                        yield self.body[position:position + size]
+                        position += size
+                
+                def close(self):
+                    self.closed = True
+            
+            rng = random.Random(7)
+            # Chunk boundaries fall inside numbers, strings and multi-byte characters
+            for sizes in (lambda: 1, lambda: 3, lambda: rng.randint(1, 200), lambda: len(body)):
+                response = StreamedResponse(body, sizes)
+                parsed = list(iter_response_json(response))
+                assert parsed == activities, "Streamed activities differ from json.loads"
+                assert response.closed, "Response not closed"
+            
+            # Elements come out while the body is still arriving
+            response = StreamedResponse(body, lambda: 256)
+            stream = iter_response_json(response)
+            first = next(stream)
+            assert first == activities[0], "Wrong first activity"
+            assert response.chunks_read < len(body) // 256 // 10, f"Read {response.chunks_read} chunks for one activity"
+            stream.close()
+            assert response.closed, "Response not closed when the stream is abandoned"
+            
+            assert list(iter_json_array(["[", " ]"])) == [], "Empty array"
+            assert list(iter_json_array(["[1", "2.", "5e1, 3]"])) == [12.5e1, 3], "Number split across chunks"
+            for bad in ("[1, 2", "[1 2]", '{"id": 1}', "[1]]", "[1,]"):
+                try:
+                    list(iter_json_array([bad]))
+                    raise AssertionError(f"No error for {bad!r}")
+                except ValueError:
+                    pass
+            
+            self.log_test(
+                "Streaming Activity JSON Parser",
+                True,
+                f"{len(activities)} activities, {len(body)} bytes, first yielded after {response.chunks_read} chunks"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Streaming Activity JSON Parser", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_28_strava_client(self):
+        """Test 28: StravaClient retries, backs off and tracks the rate limit budget"""
+        print("="*70)
+        print("TEST 28: Rate-Limit-Aware Strava Client")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            import requests
+            
+            class FakeResponse:
+                def __init__(self, status_code, headers=None):
+                    self.status_code = status_code
+                    self.headers = headers or {}
+                    self.closed = False
+                
+                def close(self):
+                    self.closed = True
+            
+            class FakeSession:
+                # Hands out queued responses (or raises queued exceptions) in order
+                def __init__(self, responses):
+                    self.responses = list(responses)
+                    self.calls = []
+                
+                def request(self, method, url, **kwargs):
+                    self.calls.append((method, url, kwargs))
+                    response = self.responses.pop(0)
+                    if isinstance(response, Exception):
+                        raise response
+                    return response
+            
+            now = [1_700_000_000.0]  # 22:13:20 UTC, 1h40m before the daily reset
+            budget = RateLimitBudget(clock=lambda: now[0])
+            sleeps = []
+            
+            def make_client(responses, **kwargs):
+                return StravaClient(session=FakeSession(responses), budget=budget, sleep=sleeps.append, **kwargs)
+            
+            # 503 and a dropped connection are retried with growing delays
+            limits = {"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "10,500"}
+            client = make_client([FakeResponse(503), requests.exceptions.ConnectionError("reset"),
+                                  FakeResponse(200, limits)])
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = client.get_activities("token", per_page=30)
+            assert response.status_code == 200, f"Expected 200 after retries, got {response.status_code}"
+            assert len(client.session.calls) == 3 and len(sleeps) == 2, "Expected two retries"
+            assert sleeps[1] > sleeps[0], f"Backoff should grow: {sleeps}"
+            method, url, kwargs = client.session.calls[-1]
+            assert url.endswith("/athlete/activities") and kwargs["params"] == {"per_page": 30}, "Wrong request"
+            assert kwargs["timeout"] == client.timeout, "Requests must carry a timeout"
+            assert kwargs["headers"]["Authorization"] == "Bearer token", "Missing bearer token"
+            assert budget.remaining() == (90, 500), f"Budget not parsed: {budget.remaining()}"
+            
+            # 429 honours Retry-After; retries stop after max_retries
+            sleeps.clear()
+            client = make_client([FakeResponse(429, {"Retry-After": "7"})] + [FakeResponse(500)] * 3, max_retries=2)
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = client.get("/athlete", "token")
+            assert sleeps[0] == 7, f"Retry-After ignored: {sleeps}"
+            assert response.status_code == 500 and len(client.session.calls) == 3, "max_retries not respected"
+            
+            # The OAuth code exchange is not idempotent: a 503 or a dropped connection is not retried
+            client = make_client([FakeResponse(503)])
+            response = client.exchange_code("id", "secret", "code")
+            assert response.status_code == 503 and len(client.session.calls) == 1, "Code exchange was retried"
+            client = make_client([requests.exceptions.ConnectionError("reset"), FakeResponse(200)])
+            try:
+                client.exchange_code("id", "secret", "code")
+                raise AssertionError("Dropped code exchange was retried")
+            except requests.exceptions.ConnectionError:
+                pass
+            assert len(client.session.calls) == 1, "Code exchange was sent twice"
+            
+            # A used-up short window blocks requests until the next quarter hour
+            budget.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,600"})
+            assert budget.remaining() == (0, 400), f"Wrong remaining {budget.remaining()}"
+            wait = budget.wait_time()
+            assert 0 < wait <= 15 * 60, f"Wrong wait {wait}"
+            client = make_client([FakeResponse(200)])
+            try:
+                client.get("/athlete", "token")
+                raise AssertionError("Request sent with no budget left")
+            except StravaRateLimitError as e:
+                assert e.retry_after == wait, "Wrong retry_after"
+            assert not client.session.calls, "Nothing should have been sent"
+            now[0] += wait
+            assert budget.remaining() == (100, 400), "Short window should have reset"
+            now[0] += 2 * 60 * 60
+            assert budget.remaining() == (100, 1000), "Daily window should have reset"
+            
+            self.log_test(
+                "Rate-Limit-Aware Strava Client",
+                True,
+                f"Retries, Retry-After and budget windows behave (snapshot {budget.snapshot()['remaining']})"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Rate-Limit-Aware Strava Client", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_29_backfill(self):
+        """Test 29: Concurrent backfill stores the whole history and resumes from its cursor"""
+        print("="*70)
+        print("TEST 29: Full-History Backfill")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            import threading
+            import time
+            
+            history = [
+                {"id": 5000 - i, "type": "Run", "distance": 5000.0, "moving_time": 1500,
+                 "start_date_local": (datetime(2025, 6, 1) - timedelta(days=i)).strftime("%Y-%m-%dT%H:%M:%SZ")}
+                for i in range(23)
+            ]
+            
+            class PageResponse:
+                status_code = 200
+                encoding = "utf-8"
+                
+                def __init__(self, activities):
+                    self.body = json.dumps(activities).encode("utf-8")
+                
+                def iter_content(self, chunk_size=1):
+                    yield self.body
+                
+                def close(self):
+                    pass
+            
+            class FakeStrava:
+                # Serves `history` newest first; optionally rate limits one page once
+                def __init__(self, rate_limit_page=None):
+                    self.budget = RateLimitBudget()
+                    self.rate_limit_page = rate_limit_page
+                    self.pages = []
+                    self.active = 0
+                    self.max_active = 0
+                    self.lock = threading.Lock()
+                
+                def get_activities(self, access_token, stream=False, before=None, page=1, per_page=30):
+                    with self.lock:
+                        self.pages.append(page)
+                        self.active += 1
+                        self.max_active = max(self.max_active, self.active)
+                    try:
+                        time.sleep(0.01)
+                        if page == self.rate_limit_page:
+                            self.rate_limit_page = None
+                            raise StravaRateLimitError(60)
+                        return PageResponse(history[(page - 1) * per_page:page * per_page])
+                    finally:
+                        with self.lock:
+                            self.active -= 1
+            
+            storage = DataStorage(data_dir="test_data/backfill")
+            storage.save_user("7", {"id": "7", "username": "runner", "running_stats": {"distance": {}}})
+            
+            with contextlib.redirect_stdout(io.StringIO()):
+                # Interrupted twice: after two pages, then by the rate limit on page 4
+                client = FakeStrava(rate_limit_page=4)
+                first = backfill_activities(storage, "7", "token", client=client, per_page=3, workers=3, max_pages=2)
+                interrupted = storage.get_user("7")
+                second = backfill_activities(storage, "7", "token", client=client, per_page=3, workers=3)
+                third = backfill_activities(storage, "7", "token", client=client, per_page=3, workers=3)
+                again = backfill_activities(storage, "7", "token", client=client, per_page=3, workers=3)
+            
+            assert first['stopped'] == 'max_pages' and first['cursor']['next_page'] == 3, f"First run: {first}"
+            assert 'running_stats' not in interrupted, "Running stats kept after pages were stored"
+            assert second['stopped'] == 'rate_limited' and second['cursor']['next_page'] == 4, f"Second run: {second}"
+            assert third['stopped'] is None and third['cursor']['complete'], f"Third run: {third}"
+            assert again['pages'] == 0, "A finished backfill should not fetch again"
+            assert client.max_active > 1, "Pages were not fetched concurrently"
+            
+            stored = storage.get_activities("7")
+            assert sorted(a['id'] for a in stored) == sorted(a['id'] for a in history), "History not fully stored"
+            assert all('local_epoch_day' in a for a in stored), "Backfilled activities not annotated"
+            user_data = storage.get_user("7")
+            assert user_data['backfill']['activities'] == len(history), f"Cursor count {user_data['backfill']}"
+            assert 'running_stats' not in user_data, "Running stats should be re-seeded after a backfill"
+            
+            self.log_test(
+                "Full-History Backfill",
+                True,
+                f"{len(stored)} activities over {third['cursor']['next_page'] - 1} pages, "
+                f"up to {client.max_active} pages in flight, resumed twice"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Full-History Backfill", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_30_sync_watermark(self):
+        """Test 30: Every storage backend persists the incremental sync watermark"""
+        print("="*70)
+        print("TEST 30: Incremental Sync Watermark")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            
+            newest = activity_timestamp({"start_date": "2025-03-01T07:30:00Z"})
+            assert newest == 1740814200, f"Wrong timestamp {newest}"
+            assert activity_timestamp({"start_date_local": "2025-03-01T07:30:00Z"}) is None, \
+                "Only the UTC start_date is comparable with after="
+            
+            backends = {
+                "json": lambda: DataStorage(data_dir="test_data/watermark_json"),
+                "log": lambda: LogStorage(data_dir="test_data/watermark_log"),
+                "sqlite": lambda: SQLiteStorage(data_dir="test_data/watermark_sqlite"),
+            }
+            for name, open_storage in backends.items():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    storage = open_storage()
+                    assert storage.get_sync_watermark("1") is None, f"{name}: unexpected watermark"
+                    storage.save_sync_watermark("1", newest)
+                    
+                    # A failed sync leaves the watermark where it was
+                    try:
+                        with storage.transaction():
+                            storage.save_sync_watermark("1", newest + 60)
+                            raise RuntimeError("sync failed")
+                    except RuntimeError:
+                        pass
+                    assert storage.get_sync_watermark("1") == newest, f"{name}: rollback moved the watermark"
+                    
+                    if hasattr(storage, "close"):
+                        storage.close()
+                    reopened = open_storage()
+                    assert reopened.get_sync_watermark("1") == newest, f"{name}: watermark not persisted"
+                    assert reopened.get_sync_watermark("2") is None, f"{name}: watermark leaked to another user"
+                    if hasattr(reopened, "close"):
+                        reopened.close()
+            
+            self.log_test(
+                "Incremental Sync Watermark",
+                True,
+                f"Watermark persisted and rolled back on {', '.join(backends)}"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Incremental Sync Watermark", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_31_webhook_queue(self):
+        """Test 31: Simulated webhook events drain into storage and running baselines"""
+        print("="*70)
+        print("TEST 31: Webhook Event Queue")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            
+            athlete_ids = ["201", "202"]
+            events, strava = synthetic_events(athlete_ids, 120, seed=4)
+            
+            storage = DataStorage(data_dir="test_data/webhooks")
+            for athlete_id in athlete_ids:
+                storage.save_user(athlete_id, {"id": athlete_id, "running_stats": Person().running_stats_to_dict()})
+            queue = WebhookQueue("test_data/webhooks/webhook_events.db", retry_delay=0)
+            
+            queued = [queue.enqueue(event) for event in events]
+            assert sum(queued) == len({(e["object_id"], e["aspect_type"], e["event_time"]) for e in events}), \
+                "Duplicate deliveries should be ignored"
+            try:
+                queue.enqueue({"object_type": "activity"})
+                raise AssertionError("Incomplete event accepted")
+            except ValueError:
+                pass
+            
+            # The first token lookup fails: those events are retried, not lost
+            failures = []
+            
+            def token_provider(athlete_id):
+                if not failures:
+                    failures.append(athlete_id)
+                    raise RuntimeError("token refresh failed")
+                return "token"
+            
+            with contextlib.redirect_stdout(io.StringIO()):
+                first = drain(queue, storage, token_provider, client=strava)
+                second = drain(queue, storage, token_provider, client=strava)
+            assert first["failed"] > 0 and second["failed"] == 0, f"Retry not exercised: {first}, {second}"
+            assert queue.counts() == {"done": sum(queued)}, f"Events left over: {queue.counts()}"
+            
+            mismatches = storage_mismatches(storage, strava, athlete_ids)
+            assert not mismatches, f"Storage differs from Strava: {mismatches[:3]}"
+            
+            # A delete of an activity Strava still has is not applied
+            kept_id, kept = next(iter(strava.activities.items()))
+            queue.enqueue({"object_type": "activity", "object_id": kept_id, "aspect_type": "delete",
+                           "owner_id": kept["athlete"]["id"], "event_time": 1, "updates": {}})
+            with contextlib.redirect_stdout(io.StringIO()):
+                forged = drain(queue, storage, token_provider, client=strava)
+            assert forged["applied"] == 1, f"Forged delete not processed: {forged}"
+            assert not storage_mismatches(storage, strava, athlete_ids), "Forged delete removed an activity"
+            
+            # A webhook update waits for a sync holding the athlete's lock, then builds on its save
+            import threading
+            athlete_id = str(kept["athlete"]["id"])
+            with athlete_lock(storage, athlete_id):
+                synced = storage.get_user(athlete_id)
+                synced.pop("rescore_pending", None)
+                applier = threading.Thread(target=apply_activity, args=(storage, athlete_id, kept_id, dict(kept)))
+                applier.start()
+                applier.join(0.2)
+                assert applier.is_alive(), "Webhook update did not wait for the athlete's lock"
+                storage.save_user(athlete_id, dict(synced, scored_day=1))
+            applier.join()
+            user_data = storage.get_user(athlete_id)
+            assert user_data.get("scored_day") == 1 and user_data.get("rescore_pending"), \
+                f"An update was lost: {user_data}"
+            assert not _thread_locks, "Athlete locks were not released"
+            
+            # Saved running baselines equal a fresh pass over the stored runs
+            for athlete_id in athlete_ids:
+                user_data = storage.get_user(athlete_id)
+                assert user_data.get("rescore_pending"), "Next sync should re-score"
+                person = Person()
+                person.load_running_stats(user_data["running_stats"])
+                runs = [a for a in storage.get_activities(athlete_id) if a["type"] in ActivityAggregator.RUN_TYPES]
+                assert person.total_workouts == len(runs), f"Workouts {person.total_workouts} != {len(runs)}"
+                expected = sum(a["distance"] for a in runs)
+                assert abs(person.total_distance - expected) < 1e-6, "Running distance drifted"
+            queue.close()
+            
+            self.log_test(
+                "Webhook Event Queue",
+                True,
+                f"{sum(queued)} events ({len(events) - sum(queued)} duplicates), "
+                f"{len(strava.activities)} activities in sync after one retry"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Webhook Event Queue", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_32_sync_jobs(self):
+        """Test 32: Sync jobs run on a bounded pool and coalesce per athlete"""
+        print("="*70)
+        print("TEST 32: Background Sync Jobs")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            import threading
+            
+            queue = SyncJobQueue("test_data/sync_jobs.db", workers=2, max_finished=3)
+            other = SyncJobQueue("test_data/sync_jobs.db", workers=1)  # another worker process
+            release = threading.Event()
+            lock = threading.Lock()
+            running = [0, 0]  # current, most at once
+            started = threading.Semaphore(0)
+            
+            def pipeline(result):
+                def task():
+                    with lock:
+                        running[0] += 1
+                        running[1] = max(running[1], running[0])
+                    started.release()
+                    release.wait(5)
+                    with lock:
+                        running[0] -= 1
+                    return result, 200
+                return task
+            
+            first, created = queue.submit("1", pipeline({"athlete": "1"}))
+            again, created_again = queue.submit("1", pipeline({"athlete": "1", "duplicate": True}))
+            assert created and not created_again and again is first, "In-flight job should be reused"
+            assert first.requests == 2, f"Coalesced request not counted: {first.requests}"
+            
+            # Other processes see the job and join it rather than running their own
+            remote, created_remote = other.submit("1", lambda: ({"ran": "other process"}, 200))
+            assert not created_remote and remote.id == first.id, "Other process should join the job"
+            assert other.get(first.id).to_dict()["state"] in ("queued", "running"), "Job not visible"
+            assert queue.get(first.id).requests == 3, "Request joined from another process not counted"
+            
+            jobs = [first] + [queue.submit(str(athlete), pipeline({"athlete": str(athlete)}))[0] for athlete in (2, 3, 4)]
+            assert started.acquire(timeout=5) and started.acquire(timeout=5), "Workers did not start"
+            assert jobs[-1].to_dict()["state"] == "queued", "Fourth job should wait for a worker"
+            release.set()
+            for job in jobs:
+                assert job.finished.wait(5), f"Job {job.id} did not finish"
+            assert running[1] == 2, f"Expected 2 concurrent pipelines, saw {running[1]}"
+            assert first.result == {"athlete": "1"}, "Duplicate request must not run its own pipeline"
+            status = first.to_dict()
+            assert status["state"] == "done" and status["status_code"] == 200, f"Wrong status {status}"
+            assert status["queued_seconds"] >= 0 and status["run_seconds"] >= 0, "Missing timings"
+            
+            # Finished jobs free the athlete; 4xx results and exceptions mark jobs failed
+            followup, created = queue.submit("1", lambda: ({"error": "User not found"}, 404))
+            assert created and followup is not first, "A finished job must not be reused"
+            
+            def crash():
+                raise RuntimeError("boom")
+            
+            with contextlib.redirect_stdout(io.StringIO()):
+                crashed, _ = queue.submit("5", crash)
+                assert followup.finished.wait(5) and crashed.finished.wait(5), "Jobs did not finish"
+            assert followup.state == "failed" and followup.status_code == 404, "4xx should fail the job"
+            assert crashed.state == "failed" and crashed.error == "boom", "Exception should fail the job"
+            
+            # Only the newest max_finished jobs are kept for lookups
+            assert queue.get(first.id) is None and queue.get(crashed.id) is crashed, "Old jobs not pruned"
+            assert sum(queue.counts().values()) == 3, f"Kept jobs: {queue.counts()}"
+            assert other.get(crashed.id).to_dict()["error"] == "boom", "Finished job not visible elsewhere"
+            other.shutdown()
+            queue.shutdown()
+            
+            # A job stuck in flight past job_timeout (its process died) does not block the athlete
+            stuck = threading.Event()
+            began = threading.Event()
+            dead = SyncJobQueue("test_data/sync_jobs_abandoned.db", workers=1)
+            abandoned, _ = dead.submit("6", lambda: (began.set(), stuck.wait(5), ({}, 200))[2])
+            assert began.wait(5), "Job did not start"
+            
+            # The timeout runs from the start, not from when the job was queued
+            dead._conn().execute("UPDATE sync_jobs SET created_at = created_at - 3600 WHERE id = ?", (abandoned.id,))
+            patient = SyncJobQueue("test_data/sync_jobs_abandoned.db", workers=1, job_timeout=60)
+            joined, created = patient.submit("6", lambda: ({}, 200))
+            assert not created and joined.id == abandoned.id, "A job queued long ago but just started was abandoned"
+            patient.shutdown()
+            
+            # A queued job abandoned before a worker frees up is not run
+            queued_ran = threading.Event()
+            backlog, _ = dead.submit("7", lambda: (queued_ran.set(), ({}, 200))[1])
+            impatient = SyncJobQueue("test_data/sync_jobs_abandoned.db", workers=1, job_timeout=0)
+            replacement, _ = impatient.submit("7", lambda: ({"retried": True}, 200))
+            assert replacement.finished.wait(5), "Replacement of a queued job did not run"
+            
+            retried, created = impatient.submit("6", lambda: ({"retried": True}, 200))
+            assert created and retried.finished.wait(5) and retried.result == {"retried": True}, \
+                "Abandoned job blocked a new sync"
+            assert impatient.get(abandoned.id).to_dict()["error"] == "Abandoned", "Stuck job not marked"
+            with contextlib.redirect_stdout(io.StringIO()):
+                stuck.set()
+                assert backlog.finished.wait(5), "Abandoned queued job was not dropped"
+            assert not queued_ran.is_set() and backlog.error == "Abandoned", "Abandoned queued job ran"
+            dead.shutdown()
+            impatient.shutdown()
+            
+            self.log_test(
+                "Background Sync Jobs",
+                True,
+                f"2 workers, duplicate request coalesced, failures reported, {len(jobs) + 2} jobs run"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Background Sync Jobs", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_33_bulk_sync(self):
+        """Test 33: Bulk sync paces requests to the rate limits and syncs stalest first"""
+        print("="*70)
+        print("TEST 33: Bulk Sync Scheduler")
+        print("="*70)
+        
+        try:
+            import asyncio
+            import contextlib
+            import io
+            import threading
+            import time
+            
+            # Simulated clock: sleeping just moves time forward
+            now = [1_700_000_100.0]  # 100s into a quarter hour
+            
+            async def fake_sleep(seconds):
+                now[0] += seconds
+            
+            budget = RateLimitBudget(clock=lambda: now[0])
+            pacer = RequestPacer(budget, default_limit=(10, 25), reserve=(0, 0),
+                                 clock=lambda: now[0], sleep=fake_sleep)
+            
+            async def take_slots(count):
+                slots = []
+                for _ in range(count):
+                    slots.append(now[0] if await pacer.acquire() else None)
+                return slots
+            
+            slots = asyncio.run(take_slots(26))
+            granted = [slot for slot in slots if slot is not None]
+            assert len(granted) == 25 and slots[-1] is None, "Daily limit should stop the 26th request"
+            windows = {}
+            for slot in granted:
+                windows[int(slot // 900)] = windows.get(int(slot // 900), 0) + 1
+            assert max(windows.values()) <= 10, f"Short limit exceeded: {windows}"
+            first_window = [slot for slot in granted if int(slot // 900) == int(granted[0] // 900)]
+            gaps = [b - a for a, b in zip(first_window, first_window[1:])]
+            assert max(gaps) - min(gaps) < 1e-6 and gaps[0] > 0, f"Requests not evenly spaced: {gaps}"
+            
+            # Usage reported by Strava counts even if this pacer sent nothing
+            budget.update({"X-RateLimit-Limit": "10,1000", "X-RateLimit-Usage": "10,30"})
+            before = now[0]
+            assert asyncio.run(pacer.acquire()), "Slot expected after the window resets"
+            assert int(now[0] // 900) > int(before // 900), "Should have waited for the next window"
+            
+            # Stalest first: never synced, then longest since the last sync (not the
+            # newest activity); athletes without last_synced_at fall back to the watermark
+            storage = DataStorage(data_dir="test_data/bulk_sync")
+            with contextlib.redirect_stdout(io.StringIO()):
+                storage.save_user("a", {"id": "a", "last_synced_at": 300})
+                storage.save_user("b", {"id": "b", "last_synced_at": 100})
+                storage.save_sync_watermark("a", 50)
+                storage.save_sync_watermark("b", 250)
+                storage.save_sync_watermark("d", 200)
+                order = stalest_first(storage, ["a", "b", "c", "d"])
+            assert order == ["c", "b", "d", "a"], f"Wrong priority order: {order}"
+            
+            # The scheduler runs syncs concurrently and classifies their results
+            lock = threading.Lock()
+            active = [0, 0]
+            
+            def sync_one(athlete_id):
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active[1], active[0])
+                time.sleep(0.01)
+                with lock:
+                    active[0] -= 1
+                if athlete_id == "bad":
+                    raise RuntimeError("no token")
+                if athlete_id.startswith("idle"):
+                    return {"message": "Already up to date"}, 200
+                return {"message": "Sync successful!"}, 200
+            
+            athletes = ["bad"] + [f"idle{i}" for i in range(5)] + [f"new{i}" for i in range(14)]
+            roomy = RequestPacer(RateLimitBudget(), default_limit=(10**6, 10**6), reserve=(0, 0))
+            with contextlib.redirect_stdout(io.StringIO()):
+                metrics = asyncio.run(bulk_sync(athletes, sync_one, pacer=roomy, concurrency=4))
+            assert (metrics["synced"], metrics["up_to_date"], metrics["failed"]) == (14, 5, 1), f"Wrong outcomes {metrics}"
+            assert 1 < active[1] <= 4, f"Concurrency {active[1]} outside 2..4"
+            assert metrics["athletes_per_minute"] and metrics["latency_p95"] >= metrics["latency_p50"], "Missing metrics"
+            
+            # Out of daily budget: the rest is deferred, not attempted
+            tight = RequestPacer(RateLimitBudget(), default_limit=(10**6, 3), reserve=(0, 0))
+            with contextlib.redirect_stdout(io.StringIO()):
+                metrics = asyncio.run(bulk_sync(athletes[1:], sync_one, pacer=tight, concurrency=2))
+            assert metrics["deferred"] == len(athletes) - 4, f"Wrong deferred count {metrics}"
+            
+            self.log_test(
+                "Bulk Sync Scheduler",
+                True,
+                f"25/26 slots within 10/15min and 25/day, {active[1]} concurrent syncs, deferral on daily limit"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Bulk Sync Scheduler", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_34_strava_simulator(self):
+        """Test 34: The local Strava simulator answers StravaClient like the real API"""
+        print("="*70)
+        print("TEST 34: Strava Simulator")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            import requests
+            
+            now = [1_700_000_100.0]
+            simulator = StravaSimulator(athletes=2, activities_per_athlete=45, seed=3, limit=(12, 1000),
+                                        clock=lambda: now[0], sleep=lambda seconds: None)
+            budget = RateLimitBudget(clock=lambda: now[0])
+            client = StravaClient(session=requests.Session(), budget=budget, max_retries=2,
+                                  sleep=lambda seconds: None)
+            with contextlib.redirect_stdout(io.StringIO()):
+                install(client, simulator)
+            token = simulator.issue_tokens(1)["access_token"]
+            history = simulator.athletes[1]
+            
+            # Paging walks the history newest first, 20 at a time
+            pages = []
+            for page in (1, 2, 3):
+                response = client.get_activities(token, per_page=20, page=page)
+                assert response.status_code == 200, f"Page {page} returned {response.status_code}"
+                pages.append(response.json())
+            assert [len(page) for page in pages] == [20, 20, 5], f"Wrong page sizes {[len(p) for p in pages]}"
+            ids = [activity["id"] for page in pages for activity in page]
+            assert ids == [activity["id"] for activity in reversed(history)], "Pages not newest first"
+            
+            # after alone lists oldest first; after+before is a window, newest first
+            after = activity_timestamp(history[29])
+            newer = client.get_activities(token, stream=True, after=after, per_page=200)
+            newer_ids = [activity["id"] for activity in iter_response_json(newer)]
+            assert newer_ids == [activity["id"] for activity in history[30:]], "after filter wrong"
+            before = activity_timestamp(history[35])
+            window = client.get_activities(token, after=after, before=before).json()
+            assert [a["id"] for a in window] == [a["id"] for a in reversed(history[30:35])], "before filter wrong"
+            
+            # New activities show up after the previous newest one
+            added = simulator.add_activities(1, 2)
+            newer = client.get_activities(token, after=activity_timestamp(history[-3])).json()
+            assert [a["id"] for a in newer] == [a["id"] for a in added], "Added activities not listed"
+            
+            # Rate-limit headers feed the budget; past the limit the client backs off
+            assert budget.limit == (12, 1000) and budget.remaining() == (6, 994), f"Budget {budget.snapshot()}"
+            assert client.get("/athlete", "bad-token").status_code == 401, "Bad token accepted"
+            for _ in range(5):
+                client.get("/athlete", token)
+            try:
+                client.get("/athlete", token)
+                assert False, "Expected StravaRateLimitError once the 15-minute limit is used"
+            except StravaRateLimitError as e:
+                assert 0 < e.retry_after <= 900, f"Wrong retry_after {e.retry_after}"
+            now[0] += 900
+            assert client.get("/athlete", token).status_code == 200, "Limit did not reset with the window"
+            
+            # Refresh rotates tokens; expired access tokens are rejected
+            expired = simulator.issue_tokens(2, expires_at=int(now[0]) - 1)
+            assert client.get("/athlete", expired["access_token"]).status_code == 401, "Expired token accepted"
+            refreshed = client.refresh_token("id", "secret", expired["refresh_token"]).json()
+            assert client.get("/athlete", refreshed["access_token"]).json()["id"] == 2, "Refreshed token unusable"
+            reused = client.refresh_token("id", "secret", expired["refresh_token"])
+            assert reused.status_code == 400, "Used refresh token accepted again"
+            
+            # Injected 5xx errors are retried by the client
+            flaky = StravaSimulator(athletes=1, activities_per_athlete=5, seed=0, error_rate=0.5)
+            flaky_client = StravaClient(session=requests.Session(), budget=RateLimitBudget(), max_retries=10,
+                                        sleep=lambda seconds: None)
+            with contextlib.redirect_stdout(io.StringIO()):
+                install(flaky_client, flaky)
+                flaky_token = flaky.issue_tokens(1)["access_token"]
+                for _ in range(10):
+                    assert flaky_client.get_activities(flaky_token).status_code == 200, "Retry did not recover"
+            assert any(status >= 500 for status in flaky.statuses), f"No errors injected: {flaky.statuses}"
+            
+            # Simulated activities go through the parser like real ones
+            person = Person()
+            with contextlib.redirect_stdout(io.StringIO()):
+                StravaParser.parse_activities(history, person)
+            assert person.total_distance > 0, "Parser found no distance"
+            
+            self.log_test(
+                "Strava Simulator",
+                True,
+                f"Paging/after/before, 401s, 429 at 12/15min, token rotation, retried {flaky.statuses} responses"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Strava Simulator", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_35_activity_streams(self):
+        """Test 35: Activity streams are stored as typed arrays and loaded as views"""
+        print("="*70)
+        print("TEST 35: Activity Streams")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            import shutil
+            import requests
+            
+            # Round trip, with a pause longer than uint16 seconds and missing samples
+            streams = {
+                "time": [0, 1, 2, 70000, 70001],
+                "distance": [0.0, 3.1, 6.2, 6.2, 9.5],
+                "latlng": [[51.507351, -0.127758], [51.50736, -0.12776], None, [51.5074, -0.1278], [51.50741, -0.12781]],
+                "heartrate": [120, 121, None, 95, 130],
+                "watts": [200, 210, 220, 0, 250],  # not a stored channel
+            }
+            loaded = ActivityStreams(encode_streams(streams))
+            assert loaded.samples == 5 and loaded.keys() == ["time", "distance", "latlng", "heartrate"], \
+                f"Wrong channels {loaded.keys()}"
+            assert list(loaded["time"]) == streams["time"], f"Time not decoded: {list(loaded['time'])}"
+            
+            # Time that runs backwards or has a gap is kept raw instead of failing the activity
+            for time_values, expected in [([0, 5, 3, 4], [0, 5, 3, 4]), ([0, 1, None, 3], [0, 1, 0, 3])]:
+                irregular = ActivityStreams(encode_streams({"time": time_values}))
+                assert irregular.to_dict() == {"time": expected}, f"Irregular time {irregular.to_dict()}"
+            assert loaded["heartrate"].format == "H" and loaded["latlng"].format == "f", "Channels not typed views"
+            assert len(loaded["latlng"]) == 10, "latlng should be interleaved pairs"
+            as_dict = loaded.to_dict()
+            assert as_dict["latlng"][0] == [51.50735, -0.127758] and as_dict["latlng"][2] == [None, None], \
+                f"latlng not restored: {as_dict['latlng'][:3]}"
+            assert as_dict["heartrate"] == [120, 121, 0, 95, 130], "heartrate not restored"
+            assert as_dict["distance"] == streams["distance"], "distance not restored"
+            assert loaded.to_dict(["heartrate", "cadence"]) == {"heartrate": as_dict["heartrate"]}, "keys filter wrong"
+            
+            # An hour at 1 Hz: compact on disk compared with Strava's JSON
+            hour = {
+                "time": list(range(3600)),
+                "distance": [round(i * 3.1, 1) for i in range(3600)],
+                "latlng": [[round(51.5 + i * 1e-5, 6), round(-0.12 - i * 1e-5, 6)] for i in range(3600)],
+                "altitude": [round(10 + (i % 50) * 0.2, 1) for i in range(3600)],
+                "heartrate": [140 + i % 20 for i in range(3600)],
+                "cadence": [85 + i % 5 for i in range(3600)],
+                "velocity_smooth": [3.1] * 3600,
+            }
+            encoded = encode_streams(hour)
+            assert len(encoded) < len(json.dumps(hour)) / 2, f"{len(encoded)} bytes is not compact"
+            assert ActivityStreams(encoded).to_dict() == hour, "Hour of streams changed in the round trip"
+            
+            # Store: one file per activity, empty record for activities without streams
+            root = "test_data/streams"
+            shutil.rmtree(root, ignore_errors=True)
+            store = StreamStore(root)
+            store.save("7", 1001, hour)
+            store.save("7", 1002, {})
+            assert store.stored_ids("7") == {"1001", "1002"} and store.has("7", 1001), "Files not stored"
+            assert store.load("7", 1001)["heartrate"][:3].tolist() == [140, 141, 142], "Stored streams differ"
+            assert len(store.load("7", 1002)) == 0 and store.load("7", 1003) is None, "Empty/missing wrong"
+            
+            # Ingestion through StravaClient against the simulator
+            simulator = StravaSimulator(athletes=1, activities_per_athlete=8, seed=5, limit=(6, 1000))
+            client = StravaClient(session=requests.Session(), budget=RateLimitBudget(), sleep=lambda seconds: None)
+            with contextlib.redirect_stdout(io.StringIO()):
+                install(client, simulator)
+            token = simulator.issue_tokens(1)["access_token"]
+            activities = simulator.athletes[1]
+            activity_ids = [a["id"] for a in activities]
+            
+            as_list = fetch_streams(client, token, activity_ids[0], keys=("time", "heartrate"))
+            assert set(as_list) == {"time", "distance", "heartrate"}, f"Wrong channels {set(as_list)}"
+            
+            with contextlib.redirect_stdout(io.StringIO()):
+                first = ingest_streams(store, "1", activity_ids, token, client=client, limit=3)
+                second = ingest_streams(store, "1", activity_ids, token, client=client)
+            assert first["stored"] == 3 and first["samples"] > 0, f"First ingest {first}"
+            # 1 + 3 requests used of 6 per 15 minutes: two more fit, the rest are rate limited
+            assert (second["skipped"], second["stored"], second["rate_limited"]) == (3, 2, 3), f"Second ingest {second}"
+            stored = store.load("1", activity_ids[0])
+            assert stored.samples == activities[0]["moving_time"], "One sample per second expected"
+            assert abs(stored["distance"][-1] - activities[0]["distance"]) < activities[0]["distance"] * 0.05, \
+                "Stream distance does not match the activity"
+            
+            self.log_test(
+                "Activity Streams",
+                True,
+                f"Lossless round trip, hour of streams {len(encoded)} vs {len(json.dumps(hour))} JSON bytes, "
+                f"rate-limited ingestion resumes"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Activity Streams", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def test_36_token_cache(self):
+        """Test 36: Token cache serves valid tokens from memory and refreshes them early"""
+        print("="*70)
+        print("TEST 36: Token Cache")
+        print("="*70)
+        
+        try:
+            import contextlib
+            import io
+            
+            now = [1_000_000.0]
+            store = {"1": {"access_token": "a1", "refresh_token": "r1", "expires_at": now[0] + 3600, "athlete_id": 1}}
+            calls = {"load": 0, "refresh": 0}
+            failing = []
+            
+            def load(athlete_id):
+                calls["load"] += 1
+                key = "1" if athlete_id is None else str(athlete_id)
+                if key not in store:
+                    raise RuntimeError(f"No Strava token for athlete {athlete_id}")
+                return dict(store[key])
+            
+            def refresh(athlete_id, tokens):
+                calls["refresh"] += 1
+                if failing:
+                    raise RuntimeError("Strava unavailable")
+                count = calls["refresh"]
+                store[athlete_id] = dict(tokens, access_token=f"a{count + 1}", refresh_token=f"r{count + 1}",
+                                         expires_at=now[0] + 21600)
+                return dict(store[athlete_id])
+            
+            cache = TokenCache(load, refresh, refresh_margin=600, min_validity=60, idle_timeout=7200,
+                               retry_delay=30, clock=lambda: now[0], background=False)
+            
+            def keep_using(seconds):
+                # Time passes while athlete 1's token is used every hour
+                for _ in range(int(seconds // 3600)):
+                    now[0] += 3600
+                    cache.get()
+                now[0] += seconds % 3600
+            
+            # One load, then memory only (with or without the athlete ID)
+            for _ in range(50):
+                assert cache.get()["access_token"] == "a1", "Wrong default token"
+            assert cache.get(1)["access_token"] == "a1" and cache.get("1")["access_token"] == "a1", "ID lookup"
+            assert calls["load"] == 1 and cache.hits == 51, f"Expected 1 load, got {calls} / {cache.hits} hits"
+            
+            # Nothing due yet; 10 minutes before expiry the token is refreshed in the background
+            assert cache.refresh_due() == 3000, "Refresh should be due 600s before expiry"
+            now[0] += 3000
+            with contextlib.redirect_stdout(io.StringIO()):
+                cache.refresh_due()
+            assert calls["refresh"] == 1 and cache.get()["access_token"] == "a2", "Token not refreshed early"
+            assert calls["load"] == 1, "Refreshed token should not need a reload"
+            
+            # A failed refresh is retried while the old token is still valid
+            keep_using(21000)
+            failing.append(True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                cache.refresh_due()
+            assert cache.refresh_failures == 1 and cache.get()["access_token"] == "a2", "Valid token dropped"
+            failing.clear()
+            now[0] += 30
+            with contextlib.redirect_stdout(io.StringIO()):
+                cache.refresh_due()
+            assert cache.get()["access_token"] == "a4" and cache.refreshes == 2, "Retry did not refresh"
+            
+            # Failing until the token is nearly expired: dropped, the next get() reloads
+            failing.append(True)
+            keep_using(21000)
+            with contextlib.redirect_stdout(io.StringIO()):
+                while cache.refresh_due() is not None and now[0] < store["1"]["expires_at"]:
+                    now[0] += 30
+            failing.clear()
+            assert cache.expired_drops == 1, f"Expected the expiring token to be dropped: {cache.metrics()}"
+            store["1"]["expires_at"] = now[0] + 21600
+            loads = calls["load"]
+            cache.get()
+            assert calls["load"] == loads + 1, "Dropped token should be reloaded"
+            
+            # Tokens nobody asks for are dropped instead of refreshed
+            store["2"] = {"access_token": "b1", "refresh_token": "s1", "expires_at": now[0] + 21600, "athlete_id": 2}
+            assert cache.get(2)["access_token"] == "b1", "Second athlete"
+            refreshes = calls["refresh"]
+            keep_using(21000)
+            with contextlib.redirect_stdout(io.StringIO()):
+                cache.refresh_due()
+            assert cache.idle_drops == 1 and calls["refresh"] == refreshes + 1, "Idle token should not be refreshed"
+            
+            # put() (OAuth callback) switches the default athlete; expired tokens are not cached
+            cache.put({"access_token": "c1", "refresh_token": "t1", "expires_at": now[0] + 21600, "athlete_id": 3},
+                      default=True)
+            assert cache.get()["access_token"] == "c1", "put() did not switch the default athlete"
+            cache.put({"access_token": "x", "refresh_token": "x", "expires_at": now[0] - 1, "athlete_id": 4})
+            assert "4" not in cache._entries, "Expired token cached"
+            try:
+                cache.get(5)
+                assert False, "Unknown athlete should raise"
+            except RuntimeError:
+                pass
+            
+            metrics = cache.metrics()
+            assert metrics["entries"] == 2 and metrics["hit_rate"] > 0.8, f"Metrics {metrics}"
+            assert metrics["refreshes"] == cache.refreshes and metrics["next_refresh_in_seconds"] > 0, "Metrics"
+            
+            self.log_test(
+                "Token Cache",
+                True,
+                f"{metrics['hits']} hits / {metrics['misses']} misses, early refresh, retry, idle and expiry drops"
+            )
+            return True
+            
+        except Exception as e:
+            self.log_test("Token Cache", False, str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+    
     # ==================== RUN TESTS ====================
     
     def run_all_tests(self):
@@ -671,6 +2569,30 @@ class TestDataFlow:
         self.test_9_empty_activities()
         self.test_10_minimal_activity()
         self.test_11_complete_pipeline()
+        self.test_12_log_storage()
+        self.test_13_sqlite_storage()
+        self.test_14_read_cache()
+        self.test_15_sharded_activities()
+        self.test_16_transaction()
+        self.test_17_multiprocess_storage()
+        self.test_18_bulk_get()
+        self.test_20_merge_activities()
+        self.test_21_score_index()
+        self.test_22_activity_aggregator()
+        self.test_23_batch_baselines()
+        self.test_24_running_baselines()
+        self.test_25_day_index()
+        self.test_26_window_metrics()
+        self.test_27_json_stream()
+        self.test_28_strava_client()
+        self.test_29_backfill()
+        self.test_30_sync_watermark()
+        self.test_31_webhook_queue()
+        self.test_32_sync_jobs()
+        self.test_33_bulk_sync()
+        self.test_34_strava_simulator()
+        self.test_35_activity_streams()
+        self.test_36_token_cache()
         
         # Print summary
         print("\n")
@@ -0,0 +1,199 @@
+"""
+Token Cache Module - Strava access tokens kept in memory between requests
+get_valid_token() runs on nearly every endpoint; without a cache each call
+reads tokens.json and queries Supabase. TokenCache serves a token from memory
+while it is valid, so the hot path touches neither disk nor network, and a
+background thread refreshes tokens shortly before they expire.
+
+Tokens only reach the cache through its loader (the tokens.json / Supabase
+lookup) or put() (the OAuth callback), so a token changed behind the cache's
+back (tokens.json edited by hand, another process refreshing) is noticed at
+the latest when the cached one stops being valid.
+"""
+import heapq
+import threading
+import time
+
+REFRESH_MARGIN = 10 * 60  # Strava only issues a new token within an hour of expiry
+MIN_VALIDITY = 60
+IDLE_TIMEOUT = 60 * 60
+RETRY_DELAY = 30
+
+
+class TokenCache:
+    """Tokens by athlete ID, refreshed ahead of expiry while they are in use"""
+
+    def __init__(self, load, refresh, refresh_margin=REFRESH_MARGIN, min_validity=MIN_VALIDITY,
+                 idle_timeout=IDLE_TIMEOUT, retry_delay=RETRY_DELAY, clock=time.time, background=True):
+        """
+        Args:
+            load: athlete_id (None for the tokens.json athlete) -> tokens dict with
+                access_token, refresh_token, expires_at and athlete_id; the slow
+                path, refreshing expired tokens itself. Raises if there are none
+            refresh: (athlete_id, tokens) -> new tokens dict, already saved
+            refresh_margin: Seconds before expiry a token is refreshed
+            min_validity: A cached token with less life left is reloaded instead
+            idle_timeout: Tokens unused for this long are dropped, not refreshed
+            retry_delay: Seconds before a failed refresh is tried again
+            background: Run refreshes on a daemon thread (else call refresh_due())
+        """
+        self.load = load
+        self.refresh = refresh
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self.idle_timeout = idle_timeout
+        self.retry_delay = retry_delay
+        self.clock = clock
+        self.background = background
+
+        self._entries = {}  # athlete_id -> {"tokens", "cached_at", "last_used"}
+        self._schedule = []  # heap of (refresh at, athlete_id)
+        self._default = None  # athlete of tokens.json, what get() without an ID returns
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.expired_drops = 0
+        self.idle_drops = 0
+        self.last_refresh_error = None
+
+    def get(self, athlete_id=None):
+        """
+        Tokens for an athlete (default: the tokens.json athlete).
+        Served from memory while valid for min_validity more seconds.
+        """
+        key = str(athlete_id) if athlete_id is not None else self._default
+        entry = self._entries.get(key) if key is not None else None
+        now = self.clock()
+        if entry is not None and now < entry["tokens"]["expires_at"] - self.min_validity:
+            entry["last_used"] = now
+            self.hits += 1
+            return entry["tokens"]
+
+        self.misses += 1
+        tokens = self.load(athlete_id)
+        self.put(tokens, default=athlete_id is None)
+        return tokens
+
+    def put(self, tokens, default=False):
+        """
+        Cache freshly issued or loaded tokens; default=True makes them get()'s default.
+        Tokens without min_validity seconds of life left are not cached.
+        """
+        key = str(tokens["athlete_id"])
+        now = self.clock()
+        if now >= (tokens.get("expires_at") or 0) - self.min_validity:
+            return
+        with self._lock:
+            self._entries[key] = {"tokens": tokens, "cached_at": now, "last_used": now}
+            if default:
+                self._default = key
+            self._schedule_refresh(key, tokens["expires_at"] - self.refresh_margin)
+
+    def invalidate(self, athlete_id=None):
+        """Forget an athlete's tokens (all of them without an ID)"""
+        with self._lock:
+            if athlete_id is None:
+                self._entries.clear()
+                self._default = None
+            else:
+                self._entries.pop(str(athlete_id), None)
+
+    def _schedule_refresh(self, key, at):
+        """Queue a refresh (call with the lock held); never sooner than retry_delay from now"""
+        heapq.heappush(self._schedule, (max(at, self.clock() + self.retry_delay), key))
+        if self.background:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="token-refresh", daemon=True)
+                self._thread.start()
+            self._wake.notify()
+
+    def refresh_due(self):
+        """
+        Refresh every token whose refresh time has come.
+
+        Returns:
+            Seconds until the next scheduled refresh, or None if none is scheduled
+        """
+        while True:
+            with self._lock:
+                if not self._schedule:
+                    return None
+                at, key = self._schedule[0]
+                now = self.clock()
+                if at > now:
+                    return at - now
+                heapq.heappop(self._schedule)
+                entry = self._entries.get(key)
+                # Stale schedule entries (token replaced or dropped since) are skipped
+                if entry is None or entry["tokens"]["expires_at"] - self.refresh_margin > at:
+                    continue
+                if now - entry["last_used"] > self.idle_timeout:
+                    del self._entries[key]
+                    self.idle_drops += 1
+                    continue
+                tokens = entry["tokens"]
+
+            try:
+                refreshed = self.refresh(key, tokens)
+            except Exception as e:
+                self.refresh_failures += 1
+                self.last_refresh_error = str(e)
+                print(f"[TOKEN] Early refresh for athlete {key} failed: {str(e)}")
+                with self._lock:
+                    if self._entries.get(key, {}).get("tokens") is tokens:
+                        if self.clock() < tokens["expires_at"] - self.min_validity:
+                            self._schedule_refresh(key, self.clock() + self.retry_delay)
+                        else:
+                            del self._entries[key]
+                            self.expired_drops += 1
+                continue
+
+            self.refreshes += 1
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry["tokens"] is tokens:
+                    entry["tokens"], entry["cached_at"] = refreshed, self.clock()
+                    self._schedule_refresh(key, refreshed["expires_at"] - self.refresh_margin)
+            print(f"[TOKEN] Refreshed token for athlete {key} ahead of expiry")
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh_due()
+            except Exception as e:
+                print(f"[ERROR] Token refresh thread: {str(e)}")
+                time.sleep(self.retry_delay)
+            with self._lock:
+                # Checked under the lock, so a put() since refresh_due() is not missed
+                wait = self._schedule[0][0] - self.clock() if self._schedule else None
+                if wait is None or wait > 0:
+                    self._wake.wait(wait)
+
+    def metrics(self):
+        """Hit/miss and refresh counters plus the age and remaining life of cached tokens"""
+        now = self.clock()
+        with self._lock:
+            entries = list(self._entries.values())
+            next_refresh = self._schedule[0][0] - now if self._schedule else None
+        ages = [now - entry["cached_at"] for entry in entries]
+        lives = [entry["tokens"]["expires_at"] - now for entry in entries]
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "last_refresh_error": self.last_refresh_error,
+            "expired_drops": self.expired_drops,
+            "idle_drops": self.idle_drops,
+            "max_age_seconds": round(max(ages), 1) if ages else None,
+            "min_expires_in_seconds": round(min(lives), 1) if lives else None,
+            "next_refresh_in_seconds": round(next_refresh, 1) if next_refresh is not None else None,
+        }
@@ -0,0 +1,322 @@
+"""
+Webhook Queue Module - durable queue of Strava push-subscription events
+/api/webhook only records each event (Strava expects an answer within two
+seconds); a worker drains the queue later, fetching just the changed activity
+and applying it to storage and the athlete's running baselines.
+
+Events live in a SQLite table (data/webhook_events.db), so nothing is lost if
+the process stops between receiving and applying an event. Strava retries
+deliveries, so duplicates are ignored on insert.
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Add parent directory to path to import Person
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Person import Person
+from athlete_locks import athlete_lock
+from day_index import annotate_activity
+from strava_client import strava_client
+from strava_parser import ActivityAggregator, StravaParser
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    object_type  TEXT NOT NULL,
+    object_id    TEXT NOT NULL,
+    aspect_type  TEXT NOT NULL,
+    owner_id     TEXT NOT NULL,
+    event_time   INTEGER NOT NULL,
+    updates      TEXT,
+    status       TEXT NOT NULL DEFAULT 'pending',
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    claimed_at   REAL,
+    last_error   TEXT,
+    UNIQUE (object_type, object_id, aspect_type, event_time)
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_events_status ON webhook_events (status, available_at);
+"""
+
+REQUIRED_FIELDS = ("object_type", "object_id", "aspect_type", "owner_id", "event_time")
+
+# DetailedActivity fields that the stored (summary) activities do not have
+DETAIL_ONLY_FIELDS = (
+    "segment_efforts", "splits_metric", "splits_standard", "laps", "best_efforts",
+    "photos", "similar_activities", "stats_visibility", "embed_token", "available_zones",
+)
+
+
+class WebhookError(Exception):
+    """An event could not be applied (it is retried later)"""
+
+
+class WebhookQueue:
+    """Pending/processing/done/failed webhook events in a SQLite table"""
+
+    def __init__(self, db_file, max_attempts=5, retry_delay=30.0, claim_timeout=300.0):
+        """
+        Args:
+            db_file: SQLite database file (created if missing)
+            max_attempts: Tries before an event is marked failed
+            retry_delay: Seconds before the first retry, doubled on every retry
+            claim_timeout: Seconds after which a claimed event counts as abandoned
+                (its worker died) and can be claimed again
+        """
+        self.db_file = db_file
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+        self._local = threading.local()
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _conn(self):
+        """This thread's connection, in autocommit mode (transactions are explicit)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def validate(event):
+        """Raise ValueError unless event looks like a Strava webhook event"""
+        if not isinstance(event, dict):
+            raise ValueError("Event must be a JSON object")
+        missing = [field for field in REQUIRED_FIELDS if event.get(field) in (None, "")]
+        if missing:
+            raise ValueError(f"Event is missing {', '.join(missing)}")
+
+    def enqueue(self, event):
+        """
+        Record an event.
+
+        Returns:
+            True if it was queued, False if the same event was already queued
+        """
+        self.validate(event)
+        cursor = self._conn().execute(
+            "INSERT OR IGNORE INTO webhook_events "
+            "(object_type, object_id, aspect_type, owner_id, event_time, updates) VALUES (?, ?, ?, ?, ?, ?)",
+            (event["object_type"], str(event["object_id"]), event["aspect_type"], str(event["owner_id"]),
+             int(event["event_time"]), json.dumps(event.get("updates") or {}))
+        )
+        return cursor.rowcount == 1
+
+    def claim(self, limit=100):
+        """Mark up to `limit` due events as processing and return them, oldest first"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT * FROM webhook_events "
+                "WHERE (status = 'pending' AND available_at <= ?) OR (status = 'processing' AND claimed_at < ?) "
+                "ORDER BY id LIMIT ?",
+                (now, now - self.claim_timeout, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE webhook_events SET status = 'processing', claimed_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                [(now, row["id"]) for row in rows]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        events = []
+        for row in rows:
+            event = dict(row)
+            event["updates"] = json.loads(event["updates"] or "{}")
+            event["attempts"] += 1
+            events.append(event)
+        return events
+
+    def complete(self, event_ids):
+        self._conn().executemany(
+            "UPDATE webhook_events SET status = 'done', last_error = NULL WHERE id = ?",
+            [(event_id,) for event_id in event_ids]
+        )
+
+    def fail(self, event, error):
+        """Schedule a retry with exponential backoff, or mark the event failed after max_attempts"""
+        if event["attempts"] >= self.max_attempts:
+            status, available_at = "failed", 0
+        else:
+            status, available_at = "pending", time.time() + self.retry_delay * 2 ** (event["attempts"] - 1)
+        self._conn().execute(
+            "UPDATE webhook_events SET status = ?, available_at = ?, last_error = ? WHERE id = ?",
+            (status, available_at, str(error), event["id"])
+        )
+
+    def counts(self):
+        """{status: number of events}"""
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM webhook_events GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def apply_activity(storage, athlete_id, activity_id, activity):
+    """
+    Store one created/updated activity (or delete it when activity is None) and
+    keep the athlete's saved running baselines in step with it.
+
+    The user is flagged rescore_pending so the next /api/sync recomputes the
+    score even if Strava has nothing newer than its watermark. The athlete's lock
+    keeps a sync running meanwhile from saving over the update.
+
+    Returns:
+        "applied", "missing" (delete of an unknown activity) or "unknown_athlete"
+    """
+    athlete_id = str(athlete_id)
+    run_types = ActivityAggregator.RUN_TYPES
+    with athlete_lock(storage, athlete_id), storage.transaction():
+        user_data = storage.get_user(athlete_id)
+        if not user_data:
+            return "unknown_athlete"
+        previous = storage.get_activities_by_id(athlete_id, [activity_id])
+        old = previous.get(str(activity_id))
+
+        person = None
+        if user_data.get('running_stats'):
+            person = Person()
+            person.load_running_stats(user_data['running_stats'])
+
+        if activity is None:
+            if old is None:
+                return "missing"
+            remaining = [a for a in storage.get_activities(athlete_id) if str(a.get('id')) != str(activity_id)]
+            storage.save_activities(athlete_id, remaining)
+            if person is not None and old.get('type') in run_types:
+                person.remove_activity(old)
+        else:
+            storage.merge_activities(athlete_id, [activity])
+            if person is not None:
+                StravaParser.apply_activity_changes(person, previous, [activity])
+
+        if person is not None:
+            user_data['running_stats'] = person.running_stats_to_dict()
+        user_data['rescore_pending'] = True
+        storage.save_user(athlete_id, user_data)
+    return "applied"
+
+
+def fetch_activity(client, access_token, activity_id):
+    """An activity as the activity list returns it, or None if Strava no longer has it"""
+    response = client.get(f"/activities/{activity_id}", access_token)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise WebhookError(f"Fetching activity {activity_id} returned HTTP {response.status_code}")
+    activity = response.json()
+    for field in DETAIL_ONLY_FIELDS:
+        activity.pop(field, None)
+    return annotate_activity(activity)
+
+
+def process_events(queue, events, storage, token_provider, client=None):
+    """
+    Apply claimed events. Several events for the same activity collapse into one
+    fetch. Deletes are fetched too: an activity is only removed once Strava
+    answers 404 for it, so a forged delete event cannot remove anything.
+
+    Args:
+        token_provider: athlete_id -> access token
+
+    Returns:
+        Dictionary with "applied", "skipped" and "failed" event counts
+    """
+    client = client or strava_client
+    counts = {"applied": 0, "skipped": 0, "failed": 0}
+
+    groups = OrderedDict()
+    for event in events:
+        groups.setdefault((event["object_type"], event["owner_id"], event["object_id"]), []).append(event)
+
+    for (object_type, owner_id, object_id), group in groups.items():
+        event_ids = [event["id"] for event in group]
+        try:
+            if object_type != "activity":
+                # Athlete events (profile changes, deauthorization) need no activity work
+                if any(event["updates"].get("authorized") == "false" for event in group):
+                    print(f"[WEBHOOK] Athlete {owner_id} revoked access")
+                result = "skipped"
+            elif not storage.get_user(owner_id):
+                result = "unknown_athlete"
+            else:
+                activity = fetch_activity(client, token_provider(owner_id), object_id)
+                if activity is not None and str(activity.get("athlete", {}).get("id", owner_id)) != str(owner_id):
+                    print(f"[WEBHOOK] Activity {object_id} does not belong to athlete {owner_id}")
+                    result = "skipped"
+                else:
+                    result = apply_activity(storage, owner_id, object_id, activity)
+        except Exception as e:
+            print(f"[ERROR] Webhook events {event_ids} for {object_type} {object_id} failed: {str(e)}")
+            for event in group:
+                queue.fail(event, e)
+            counts["failed"] += len(group)
+            continue
+
+        queue.complete(event_ids)
+        counts["applied" if result == "applied" else "skipped"] += len(group)
+    return counts
+
+
+def drain(queue, storage, token_provider, client=None, batch_size=100):
+    """Process due events until none are left; returns summed process_events counts"""
+    totals = {"applied": 0, "skipped": 0, "failed": 0}
+    while True:
+        events = queue.claim(batch_size)
+        if not events:
+            return totals
+        for key, value in process_events(queue, events, storage, token_provider, client).items():
+            totals[key] += value
+
+
+class WebhookWorker:
+    """Background thread that drains the queue when woken, and every `interval` seconds"""
+
+    def __init__(self, queue, storage, token_provider, client=None, interval=60.0):
+        self.queue = queue
+        self.storage = storage
+        self.token_provider = token_provider
+        self.client = client
+        self.interval = interval
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def wake(self):
+        """Start the thread if needed and have it drain now"""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="webhook-worker", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                counts = drain(self.queue, self.storage, self.token_provider, self.client)
+                if any(counts.values()):
+                    print(f"[WEBHOOK] Drained queue: {counts}")
+            except Exception as e:
+                print(f"[ERROR] Webhook worker: {str(e)}")
@@ -0,0 +1,200 @@
+"""
+Webhook Simulator - replay synthetic Strava webhook events offline
+Generates activity create/update/delete events for a few athletes together
+with SimulatedStrava, a stand-in for GET /activities/<id> that serves the
+activities those events describe. The events go through the real
+/api/webhook endpoint (Flask test client), the durable queue and the worker's
+drain, then storage is checked against the simulated Strava state. No network
+or Strava account is needed.
+
+Run with: python webhook_simulator.py [events] [seed]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+RUN_TYPES = ("Run", "Run", "Run", "TrailRun")
+
+
+class SimulatedResponse:
+    """The parts of requests.Response the webhook worker uses"""
+
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = {}
+
+    def json(self):
+        return json.loads(json.dumps(self.data))
+
+    def close(self):
+        pass
+
+
+class SimulatedStrava:
+    """Activities by id, served the way StravaClient.get would return them"""
+
+    def __init__(self):
+        self.activities = {}
+        self.requests = 0
+
+    def get(self, path, access_token, params=None, stream=False):
+        self.requests += 1
+        prefix = "/activities/"
+        if not path.startswith(prefix):
+            return SimulatedResponse(404, {"message": "Record Not Found"})
+        activity = self.activities.get(path[len(prefix):])
+        if activity is None:
+            return SimulatedResponse(404, {"message": "Record Not Found"})
+        return SimulatedResponse(200, activity)
+
+
+def make_activity(rng, activity_id, athlete_id, start):
+    distance = round(rng.uniform(3000, 21000), 1)
+    moving_time = int(distance / rng.uniform(2.5, 4.2))
+    return {
+        "id": activity_id,
+        "athlete": {"id": int(athlete_id)},
+        "name": f"Morning {rng.choice(['Run', 'Jog', 'Tempo'])}",
+        "type": rng.choice(RUN_TYPES),
+        "distance": distance,
+        "moving_time": moving_time,
+        "elapsed_time": moving_time + rng.randint(0, 600),
+        "average_speed": round(distance / moving_time, 3),
+        "max_speed": round(distance / moving_time * rng.uniform(1.2, 1.8), 3),
+        "total_elevation_gain": round(rng.uniform(0, 300), 1),
+        "start_date": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "start_date_local": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        # Detail-only field the worker drops before storing
+        "splits_metric": [{"split": 1, "distance": 1000.0}],
+    }
+
+
+def synthetic_events(athlete_ids, count, seed=0):
+    """
+    A plausible stream of webhook events and the Strava state they lead to.
+
+    Returns:
+        (events, strava) - events in delivery order (with some Strava-style
+        duplicate deliveries), and a SimulatedStrava holding the final activities
+    """
+    rng = random.Random(seed)
+    strava = SimulatedStrava()
+    owners = {}
+    events = []
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    next_id = 10_000_000
+
+    for step in range(count):
+        event_time = int(now.timestamp()) - (count - step) * 60
+        existing = list(strava.activities)
+        roll = rng.random()
+        if not existing or roll < 0.6:
+            athlete_id = str(rng.choice(athlete_ids))
+            activity_id = str(next_id)
+            next_id += 1
+            start = now - timedelta(days=rng.randint(0, 60), hours=rng.randint(0, 12))
+            strava.activities[activity_id] = make_activity(rng, int(activity_id), athlete_id, start)
+            owners[activity_id] = athlete_id
+            aspect_type, updates = "create", {}
+        elif roll < 0.85:
+            activity_id = rng.choice(existing)
+            activity = strava.activities[activity_id]
+            activity["name"] = f"Edited {activity['name']}"
+            activity["type"] = rng.choice(RUN_TYPES + ("Ride",))
+            activity["distance"] = round(activity["distance"] * rng.uniform(0.9, 1.1), 1)
+            aspect_type, updates = "update", {"title": activity["name"], "type": activity["type"]}
+        else:
+            activity_id = rng.choice(existing)
+            del strava.activities[activity_id]
+            aspect_type, updates = "delete", {}
+
+        event = {
+            "object_type": "activity",
+            "object_id": int(activity_id),
+            "aspect_type": aspect_type,
+            "owner_id": int(owners[activity_id]),
+            "subscription_id": 1,
+            "event_time": event_time,
+            "updates": updates,
+        }
+        events.append(event)
+        if rng.random() < 0.1:
+            events.append(dict(event))  # Strava retries deliveries it thinks failed
+
+    return events, strava
+
+
+def storage_mismatches(storage, strava, athlete_ids):
+    """Differences between stored activities and the simulated Strava state (empty when in sync)"""
+    from webhook_queue import DETAIL_ONLY_FIELDS
+
+    mismatches = []
+    for athlete_id in athlete_ids:
+        expected = {
+            activity_id: activity for activity_id, activity in strava.activities.items()
+            if str(activity["athlete"]["id"]) == str(athlete_id)
+        }
+        stored = {str(activity["id"]): activity for activity in storage.get_activities(athlete_id)}
+        for activity_id in expected.keys() | stored.keys():
+            if activity_id not in stored:
+                mismatches.append(f"athlete {athlete_id}: activity {activity_id} missing")
+            elif activity_id not in expected:
+                mismatches.append(f"athlete {athlete_id}: activity {activity_id} should be deleted")
+            else:
+                want = {k: v for k, v in expected[activity_id].items() if k not in DETAIL_ONLY_FIELDS}
+                have = {k: v for k, v in stored[activity_id].items() if k in want}
+                if have != want:
+                    mismatches.append(f"athlete {athlete_id}: activity {activity_id} differs")
+    return mismatches
+
+
+def main(count=200, seed=0):
+    athlete_ids = ["101", "102", "103"]
+    events, strava = synthetic_events(athlete_ids, count, seed)
+
+    # Work in a scratch directory so the real data/ is untouched
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, backend_dir)
+    os.chdir(tempfile.mkdtemp(prefix="dataduel-webhooks-"))
+    os.environ["WEBHOOK_WORKER"] = "false"  # drained below instead of on a thread
+    os.environ.setdefault("STRAVA_SUBSCRIPTION_ID", "1")  # what synthetic_events sends
+    import app
+    from webhook_queue import drain
+
+    for athlete_id in athlete_ids:
+        app.storage.save_user(athlete_id, {"id": athlete_id, "username": f"athlete{athlete_id}"})
+
+    client = app.app.test_client()
+    challenge = client.get("/api/webhook", query_string={
+        "hub.mode": "subscribe", "hub.verify_token": os.getenv("STRAVA_WEBHOOK_VERIFY_TOKEN", "dataduel"),
+        "hub.challenge": "simulated"
+    })
+    print(f"[SIMULATOR] Subscription check: {challenge.status_code} {challenge.get_json()}")
+
+    forged = client.post("/api/webhook", json=dict(events[0], subscription_id=999))
+    print(f"[SIMULATOR] Event of another subscription: {forged.status_code}")
+
+    queued = sum(client.post("/api/webhook", json=event).get_json()["queued"] for event in events)
+    print(f"[SIMULATOR] Posted {len(events)} events, {queued} queued ({len(events) - queued} duplicates)")
+
+    counts = drain(app.webhook_queue, app.storage, lambda athlete_id: "simulated-token", client=strava)
+    print(f"[SIMULATOR] Drained: {counts}, {strava.requests} activity fetches")
+    print(f"[SIMULATOR] Queue: {app.webhook_queue.counts()}")
+
+    mismatches = storage_mismatches(app.storage, strava, athlete_ids)
+    for mismatch in mismatches[:10]:
+        print(f"[ERROR] {mismatch}")
+    print(f"[SIMULATOR] Storage {'matches' if not mismatches else 'DOES NOT match'} "
+          f"the simulated Strava state ({len(strava.activities)} activities)")
+    return not mismatches
+
+
+if __name__ == "__main__":
+    # Usage: python webhook_simulator.py [events] [seed]
+    event_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    event_seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    sys.exit(0 if main(event_count, event_seed) else 1)
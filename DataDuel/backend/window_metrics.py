@@ -0,0 +1,96 @@
+"""
+Window Metrics Module - rolling 7/28/90-day run metrics from daily prefix sums
+Runs are bucketed by local epoch day (see day_index.py) and each metric gets a
+prefix-sum array, so the totals or per-run averages of any day window cost
+two lookups instead of a scan over the activities.
+"""
+from itertools import accumulate
+
+from day_index import activity_epoch_day
+from strava_parser import ActivityAggregator
+
+RUN_TYPES = ActivityAggregator.RUN_TYPES
+
+
+def recent_activities(stored_activities, new_activities, since_day):
+    """
+    Activities on or after since_day from a stored history plus a fresh page.
+
+    The stored list is in start-date order (merge_activities keeps it that way),
+    so it is walked backwards and the walk stops at the first older activity.
+    A stored activity that also appears in the page is replaced by the page's copy.
+    """
+    new_ids = {str(activity['id']) for activity in new_activities if activity.get('id') is not None}
+    recent = []
+    for activity in new_activities:
+        day_number = activity_epoch_day(activity)
+        if day_number is not None and day_number >= since_day:
+            recent.append(activity)
+    for activity in reversed(stored_activities):
+        day_number = activity_epoch_day(activity)
+        if day_number is not None and day_number < since_day:
+            break
+        if activity.get('id') is None or str(activity['id']) not in new_ids:
+            recent.append(activity)
+    return recent
+
+
+class WindowMetrics:
+    """Per-day run totals between first_day and last_day (inclusive) with prefix sums"""
+
+    FIELDS = ("distance", "moving_time", "average_speed", "max_speed")
+
+    def __init__(self, activities, first_day, last_day):
+        self.first_day = first_day
+        self.last_day = last_day
+        span = max(last_day - first_day + 1, 0)
+
+        daily = {field: [0] * span for field in ("count",) + self.FIELDS}
+        for activity in activities:
+            if activity.get('type') not in RUN_TYPES:
+                continue
+            day_number = activity_epoch_day(activity)
+            if day_number is None or not first_day <= day_number <= last_day:
+                continue
+            offset = day_number - first_day
+            daily["count"][offset] += 1
+            for field in self.FIELDS:
+                daily[field][offset] += activity.get(field, 0) or 0
+
+        # prefix[field][i] = sum of the first i days
+        self.prefix = {field: list(accumulate(values, initial=0)) for field, values in daily.items()}
+
+    def totals(self, start_day, end_day):
+        """Run count and metric sums for days start_day..end_day (clipped to the indexed range)"""
+        start = min(max(start_day, self.first_day), self.last_day + 1) - self.first_day
+        end = min(max(end_day + 1, self.first_day), self.last_day + 1) - self.first_day
+        end = max(start, end)
+        return {field: values[end] - values[start] for field, values in self.prefix.items()}
+
+    def averages(self, start_day, end_day):
+        """Per-run averages of each metric in the window (0 if there were no runs), plus 'count'"""
+        totals = self.totals(start_day, end_day)
+        count = totals["count"]
+        averages = {field: totals[field] / count if count else 0 for field in self.FIELDS}
+        averages["count"] = count
+        return averages
+
+    def trailing(self, end_day, days):
+        """Averages over the `days` days ending on end_day, e.g. trailing(today, 7)"""
+        return self.averages(end_day - days + 1, end_day)
+
+    def week_vs_baseline(self, week_start_day, today_day):
+        """
+        Scoring windows: this week's averages against the trailing 28 days before
+        the week, or the trailing 90 days if the last 28 had no runs.
+
+        Returns:
+            (current, baseline, baseline_days) - baseline_days is 28, 90, or None
+            when neither window has a run (baseline is then None)
+        """
+        current = self.averages(week_start_day, today_day)
+        for days in (28, 90):
+            baseline = self.trailing(week_start_day - 1, days)
+            if baseline["count"]:
+                return current, baseline, days
+        return current, None, None
@@ -50,8 +50,25 @@ class DataDuelAPI {
     // Data Sync
     // ========================================================================
 
-    async syncActivities() {
-        return this._fetch('/api/sync', { method: 'POST' });
+    /**
+     * Queue a sync and wait for it: the backend answers with a job id right away
+     * and runs the sync in the background, so poll the job until it finishes
+     * (giving up with an error after maxWait milliseconds)
+     */
+    async syncActivities(pollInterval = 1000, maxWait = 120000) {
+        const job = await this._fetch('/api/sync', { method: 'POST' });
+        const deadline = Date.now() + maxWait;
+        while (Date.now() < deadline) {
+            const status = await this._fetch(`/api/sync/${job.job_id}`);
+            if (status.state === 'done') {
+                return status.result;
+            }
+            if (status.state === 'failed') {
+                throw new Error((status.result && status.result.error) || status.error || 'Sync failed');
+            }
+            await new Promise(resolve => setTimeout(resolve, pollInterval));
+        }
+        throw new Error(`Sync did not finish within ${Math.round(maxWait / 1000)} seconds, please try again later`);
     }
 
     // ========================================================================